@@ -0,0 +1,50 @@
+"""
+CRT Decryption Benchmark
+
+This script compares the plain private-key exponentiation with the CRT decryption path
+for several key sizes. Run it from the project directory:
+
+    python -m benchmarks.bench_crt
+
+"""
+
+import argparse
+import random
+import time
+from encryption.rsa import decrypt_block, decrypt_block_crt, generate_key_pair
+
+def run(key_sizes: list[int], blocks: int) -> None:
+    """
+    Time both decryption paths for each key size and print a summary table.
+
+    Args:
+        key_sizes (list[int]): Modulus sizes in bits.
+        blocks (int): Number of ciphertext blocks to decrypt per key size.
+
+    Returns:
+        None
+    """
+    print(f"{'bits':>6} | {'plain (ms/block)':>17} | {'crt (ms/block)':>15} | {'speedup':>7}")
+    for bits in key_sizes:
+        e, d, n, crt = generate_key_pair(bits)
+        ciphertexts = [pow(random.randrange(n), e, n) for _ in range(blocks)]
+
+        start = time.perf_counter()
+        plain = [decrypt_block(c, d, n) for c in ciphertexts]
+        plain_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fast = [decrypt_block_crt(c, *crt) for c in ciphertexts]
+        crt_time = time.perf_counter() - start
+
+        assert plain == fast, "CRT and plain decryption disagree"
+        print(f"{bits:>6} | {plain_time / blocks * 1000:>17.4f} | {crt_time / blocks * 1000:>15.4f} | "
+              f"{plain_time / crt_time:>6.2f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare plain and CRT RSA decryption")
+    parser.add_argument('--bits', type=int, nargs='+', default=[512, 1024, 2048, 3072, 4096],
+                        help="Modulus sizes to benchmark")
+    parser.add_argument('--blocks', type=int, default=200, help="Blocks to decrypt per key size")
+    args = parser.parse_args()
+    run(args.bits, args.blocks)
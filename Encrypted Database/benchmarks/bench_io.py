@@ -0,0 +1,185 @@
+"""
+I/O Pattern Benchmark
+
+This script counts the read and write calls that reach the operating system while a file
+is encrypted and decrypted, and measures the throughput, for the original block-by-block
+loop and for the chunked container pipeline at several buffer sizes. Run it from the
+project directory:
+
+    python -m benchmarks.bench_io
+
+"""
+
+import argparse
+import io
+import os
+import tempfile
+import time
+from encryption.container import CHUNK_SIZE, LAYOUT_PACKED, read_header
+from encryption.rsa import (IO_BUFFER_SIZE, ENCRYPTION_MODES, MODE_ENVELOPE, encrypt_block, _write_container,
+                            _iter_container_decrypt)
+from file_handler.file_ops import _write_chunks
+
+# The key of the existing encrypted files: public (5, n), private (1596269, n)
+LEGACY_E, LEGACY_D, LEGACY_N = 5, 1596269, 7990271
+
+class CountingFileIO(io.FileIO):
+    """
+    A raw file that counts its read and write calls, each of which is one system call.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        """
+        Opens the file like io.FileIO and starts the counters at zero.
+
+        Args:
+            *args: Positional arguments of io.FileIO.
+            **kwargs: Keyword arguments of io.FileIO.
+
+        Returns:
+            None
+        """
+        super().__init__(*args, **kwargs)
+        self.reads = 0
+        self.writes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        """Count and perform a read."""
+        self.reads += 1
+        return super().read(size)
+
+    def readinto(self, buffer) -> int:
+        """Count and perform a read into a buffer."""
+        self.reads += 1
+        return super().readinto(buffer)
+
+    def readall(self) -> bytes:
+        """Count and perform a read of the rest of the file."""
+        self.reads += 1
+        return super().readall()
+
+    def write(self, data) -> int:
+        """Count and perform a write."""
+        self.writes += 1
+        return super().write(data)
+
+def open_counted(path: str, mode: str) -> tuple[io.BufferedIOBase, CountingFileIO]:
+    """
+    Open a file the way open() does in binary mode, keeping a handle on the counting raw file.
+
+    Args:
+        path (str): Path of the file.
+        mode (str): 'rb' or 'wb'.
+
+    Returns:
+        tuple[io.BufferedIOBase, CountingFileIO]: The buffered file and its raw file.
+    """
+    raw = CountingFileIO(path, mode)
+    buffered = io.BufferedReader(raw) if 'r' in mode else io.BufferedWriter(raw)
+    return buffered, raw
+
+def per_block(source: str, target: str) -> tuple[int, int]:
+    """
+    Encrypt with the original loop: one read and one write per 2-byte block.
+
+    Args:
+        source (str): Plaintext file.
+        target (str): Encrypted file to create.
+
+    Returns:
+        tuple[int, int]: Read and write system calls.
+    """
+    block_size = (LEGACY_N.bit_length() - 1) // 8
+    out_size = (LEGACY_N.bit_length() + 7) // 8
+    f_in, raw_in = open_counted(source, 'rb')
+    f_out, raw_out = open_counted(target, 'wb')
+    with f_in, f_out:
+        while block := f_in.read(block_size):
+            f_out.write(encrypt_block(int.from_bytes(block, byteorder='big'), LEGACY_E, LEGACY_N)
+                        .to_bytes(out_size, byteorder='big'))
+    return raw_in.reads, raw_out.writes
+
+def container_encrypt(source: str, target: str, mode: str, buffer_size: int) -> tuple[int, int]:
+    """
+    Encrypt with the container pipeline.
+
+    Args:
+        source (str): Plaintext file.
+        target (str): Encrypted file to create.
+        mode (str): Encryption mode, 'rsa' or 'envelope'.
+        buffer_size (int): Bytes read or written per I/O call.
+
+    Returns:
+        tuple[int, int]: Read and write system calls.
+    """
+    f_in, raw_in = open_counted(source, 'rb')
+    f_out, raw_out = open_counted(target, 'wb')
+    with f_in, f_out:
+        _write_container(f_in, f_out, LEGACY_E, LEGACY_N, mode, layout=LAYOUT_PACKED, buffer_size=buffer_size)
+    return raw_in.reads, raw_out.writes
+
+def container_decrypt(source: str, target: str, buffer_size: int) -> tuple[int, int]:
+    """
+    Decrypt a container file to another file.
+
+    Args:
+        source (str): Encrypted file.
+        target (str): Plaintext file to create.
+        buffer_size (int): Bytes read or written per I/O call.
+
+    Returns:
+        tuple[int, int]: Read and write system calls.
+    """
+    f_in, raw_in = open_counted(source, 'rb')
+    f_out, raw_out = open_counted(target, 'wb')
+    with f_in, f_out:
+        header = read_header(f_in)
+        chunks = _iter_container_decrypt(f_in, header, LEGACY_D, LEGACY_N, buffer_size=buffer_size)
+        _write_chunks(chunks, f_out, buffer_size)
+    return raw_in.reads, raw_out.writes
+
+def run(size_mb: float, mode: str, buffer_sizes: list[int]) -> None:
+    """
+    Run every variant on a random file and print a summary table.
+
+    Args:
+        size_mb (float): Size of the plaintext file in MiB.
+        mode (str): Encryption mode of the container runs.
+        buffer_sizes (list[int]): Buffer sizes to compare.
+
+    Returns:
+        None
+    """
+    size = int(size_mb * (1 << 20))
+    with tempfile.TemporaryDirectory() as work:
+        plain, encrypted, decrypted = (os.path.join(work, name) for name in ('plain', 'enc', 'dec'))
+        with open(plain, 'wb') as f:
+            f.write(os.urandom(size))
+
+        def report(label: str, action) -> None:
+            """Time one variant and print its row."""
+            start = time.perf_counter()
+            reads, writes = action()
+            elapsed = time.perf_counter() - start
+            print(f"{label:<26} | {reads:>8} | {writes:>8} | {size / elapsed / (1 << 20):>8.2f}")
+
+        print(f"{size_mb:g} MiB, container mode '{mode}'")
+        print(f"{'variant':<26} | {'reads':>8} | {'writes':>8} | {'MiB/s':>8}")
+        report("per-block encrypt (rsa)", lambda: per_block(plain, encrypted))
+        for buffer_size in buffer_sizes:
+            report(f"encrypt, buffer {buffer_size}",
+                   lambda: container_encrypt(plain, encrypted, mode, buffer_size))
+            report(f"decrypt, buffer {buffer_size}",
+                   lambda: container_decrypt(encrypted, decrypted, buffer_size))
+            with open(plain, 'rb') as f_a, open(decrypted, 'rb') as f_b:
+                assert f_a.read() == f_b.read(), "Round trip failed"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count I/O calls and measure throughput of encryption")
+    parser.add_argument('--size', type=float, default=4, help="Size of the test file in MiB")
+    parser.add_argument('--mode', choices=ENCRYPTION_MODES, default=MODE_ENVELOPE,
+                        help="Encryption mode of the container runs")
+    parser.add_argument('--buffer-sizes', type=int, nargs='+', default=[CHUNK_SIZE, IO_BUFFER_SIZE, 4 * IO_BUFFER_SIZE],
+                        help="Buffer sizes to compare")
+    args = parser.parse_args()
+    run(args.size, args.mode, args.buffer_sizes)
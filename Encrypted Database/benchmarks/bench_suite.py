@@ -0,0 +1,370 @@
+"""
+Benchmark Suite
+
+This script measures the whole project against a temporary database and directory:
+key generation latency per key size, encryption and decryption throughput across file
+sizes, key sizes and modes, the rate at which each storage backend takes and returns many
+tiny files, the throughput of integrity verification, and the latency of the database operations as the files table grows. Results are written as JSON, and a saved result can be given as a baseline
+to flag regressions. Run it from the project directory:
+
+    python -m benchmarks.bench_suite --output baseline.json
+    python -m benchmarks.bench_suite --baseline baseline.json
+
+The exit status is 1 when a metric regressed by more than the tolerance.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from typing import Callable
+import database.db_handler as db_handler
+import encryption.codebook as codebook
+import encryption.rsa as rsa
+from encryption.vectorized import vectorized_available
+from file_handler.storage import STORAGE_BACKENDS
+from file_handler.verify import verify_containers
+
+BENCH_USER = 'bench'
+
+# Rows inserted per transaction while the files table is filled
+FILL_BATCH = 10000
+
+# Direction in which a metric improves
+LOWER_IS_BETTER = 'lower'
+HIGHER_IS_BETTER = 'higher'
+
+def _median_time(action: Callable[[], None], repeats: int) -> float:
+    """Run an action several times and return its median duration in seconds."""
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        action()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+def _metric(value: float, unit: str, better: str) -> dict:
+    """Build the JSON record of one measurement."""
+    return {'value': value, 'unit': unit, 'better': better}
+
+def bench_keygen(key_sizes: list[int], repeats: int) -> dict[str, dict]:
+    """
+    Time generate_keys, including saving the key, for each key size.
+
+    Args:
+        key_sizes (list[int]): Modulus sizes in bits.
+        repeats (int): Keys generated per size.
+
+    Returns:
+        dict[str, dict]: Metrics named keygen/<bits>.
+    """
+    results = {}
+    for bits in key_sizes:
+        elapsed = _median_time(lambda: rsa.generate_keys(BENCH_USER, bits), repeats)
+        results[f"keygen/{bits}"] = _metric(elapsed * 1000, 'ms', LOWER_IS_BETTER)
+    return results
+
+def bench_cipher(work: str, key_sizes: list[int], file_sizes: list[int], modes: list[str],
+                 repeats: int) -> dict[str, dict]:
+    """
+    Measure encrypt_file and decrypt_file throughput for every key size, file size and mode.
+
+    Every encryption gets fresh random content, so it is never served by deduplication.
+    The 'duplicate' metric encrypts a copy of an already encrypted file, which is.
+
+    Args:
+        work (str): Temporary directory for the plaintext and decrypted files.
+        key_sizes (list[int]): Modulus sizes in bits.
+        file_sizes (list[int]): Plaintext sizes in bytes.
+        modes (list[str]): Encryption modes.
+        repeats (int): Runs per combination.
+
+    Returns:
+        dict[str, dict]: Metrics named cipher/<mode>/<bits>/<size>/<direction>, in MiB/s.
+    """
+    results = {}
+    for bits in key_sizes:
+        e, d, n, crt = rsa.generate_key_pair(bits)
+        db_handler.save_keys(BENCH_USER, e, d, n, crt)
+        public_key = f"({e}, {n})"
+        for size in file_sizes:
+            for mode in modes:
+                plains = [os.path.join(work, f"plain-{bits}-{size}-{mode}-{i}.bin") for i in range(repeats + 1)]
+                for plain in plains[:-1]:
+                    with open(plain, 'wb') as f:
+                        f.write(os.urandom(size))
+                with open(plains[-1], 'wb') as f, open(plains[0], 'rb') as f_copy:
+                    f.write(f_copy.read())
+                decrypted = os.path.join(work, f"plain-{size}.dec")
+
+                queue = iter(plains)
+                encrypt_time = _median_time(lambda: rsa.encrypt_file(BENCH_USER, next(queue), public_key, mode=mode),
+                                            repeats)
+                duplicate_time = _median_time(lambda: rsa.encrypt_file(BENCH_USER, next(queue), public_key, mode=mode),
+                                              1)
+                encrypted = db_handler.get_encrypted_file(BENCH_USER, plains[0])
+                decrypt_time = _median_time(lambda: rsa.decrypt_file(encrypted, decrypted, d, n, crt, mode=mode),
+                                            repeats)
+                with open(plains[0], 'rb') as f_a, open(decrypted, 'rb') as f_b:
+                    assert f_a.read() == f_b.read(), f"Round trip failed for {mode}, {bits} bits, {size} bytes"
+                for direction, elapsed in (('encrypt', encrypt_time), ('decrypt', decrypt_time),
+                                           ('duplicate', duplicate_time)):
+                    results[f"cipher/{mode}/{bits}/{size}/{direction}"] = _metric(
+                        size / elapsed / (1 << 20), 'MiB/s', HIGHER_IS_BETTER)
+    return results
+
+def bench_storage(work: str, file_count: int, file_size: int, repeats: int) -> dict[str, dict]:
+    """
+    Measure how many tiny files per second each storage backend encrypts and reads back.
+
+    Args:
+        work (str): Temporary directory for the plaintext files.
+        file_count (int): Files encrypted per run.
+        file_size (int): Plaintext size of each file in bytes.
+        repeats (int): Runs per backend.
+
+    Returns:
+        dict[str, dict]: Metrics named storage/<backend>/<direction>, in files/s.
+    """
+    e, d, n, crt = rsa.generate_key_pair(512)
+    db_handler.save_keys(BENCH_USER, e, d, n, crt)
+    public_key = f"({e}, {n})"
+    results = {}
+    for storage in STORAGE_BACKENDS:
+        runs = iter(range(repeats))
+        paths = []
+
+        def encrypt() -> None:
+            """Write a fresh set of files, so nothing is deduplicated, and encrypt them."""
+            directory = os.path.join(work, f"small-{storage}-{next(runs)}")
+            os.makedirs(directory)
+            paths[:] = [os.path.join(directory, f"{i:06d}.txt") for i in range(file_count)]
+            for path in paths:
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(file_size))
+            rsa.encrypt_files(BENCH_USER, paths, public_key, storage=storage)
+
+        def read() -> None:
+            """Decrypt every file of the last run."""
+            for path in paths:
+                stored = db_handler.get_stored_file(BENCH_USER, path)
+                b''.join(rsa.iter_decrypt(stored.location, d, n, crt))
+
+        encrypt_time = _median_time(encrypt, repeats)
+        read_time = _median_time(read, repeats)
+        for direction, elapsed in (('encrypt', encrypt_time), ('read', read_time)):
+            results[f"storage/{storage}/{direction}"] = _metric(file_count / elapsed, 'files/s', HIGHER_IS_BETTER)
+    return results
+
+def bench_verify(work: str, file_count: int, file_size: int, thread_counts: list[int],
+                 repeats: int) -> dict[str, dict]:
+    """
+    Measure how fast the verify command reads and checks encrypted files, per number of threads.
+
+    The files are read from the page cache after the first run, so this measures the hashing
+    and the overhead of the thread pool rather than the disks.
+
+    Args:
+        work (str): Temporary directory for the plaintext files.
+        file_count (int): Files encrypted before verifying.
+        file_size (int): Plaintext size of each file in bytes.
+        thread_counts (list[int]): Numbers of threads to compare.
+        repeats (int): Runs per number of threads.
+
+    Returns:
+        dict[str, dict]: Metrics named verify/<threads>, in MiB/s.
+    """
+    e, d, n, crt = rsa.generate_key_pair(512)
+    db_handler.save_keys(BENCH_USER, e, d, n, crt)
+    directory = os.path.join(work, 'verify')
+    os.makedirs(directory)
+    paths = [os.path.join(directory, f"{i:06d}.bin") for i in range(file_count)]
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write(os.urandom(file_size))
+    rsa.encrypt_files(BENCH_USER, paths, f"({e}, {n})", mode=rsa.MODE_ENVELOPE)
+    results = {}
+    for threads in thread_counts:
+        totals = {}
+        elapsed = _median_time(lambda: totals.update(verify_containers(rsa.ENCRYPTED_DIR, BENCH_USER, threads)),
+                               repeats)
+        results[f"verify/{threads}"] = _metric(totals['bytes'] / elapsed / (1 << 20), 'MiB/s', HIGHER_IS_BETTER)
+    return results
+
+def bench_db(row_counts: list[int], operations: int) -> dict[str, dict]:
+    """
+    Measure the per-call latency of the db_handler functions as the files table grows.
+
+    The table is filled up to each row count in turn, then every function is called
+    `operations` times on random existing files.
+
+    Args:
+        row_counts (list[int]): Sizes of the files table to measure at, in increasing order.
+        operations (int): Calls per function and row count.
+
+    Returns:
+        dict[str, dict]: Metrics named db/<function>/<rows>, in microseconds per call.
+    """
+    e, d, n, crt = rsa.generate_key_pair(64)
+    db_handler.save_keys(BENCH_USER, e, d, n, crt)
+    public_key, private_key = f"({e}, {n})", f"({d}, {n})"
+    key_id = db_handler.get_key_id_by_public_key(public_key)
+    path_of = lambda i: f"/bench/files/{i:07d}.txt"
+
+    results = {}
+    rows = 0
+    for target in sorted(row_counts):
+        for start in range(rows, target, FILL_BATCH):
+            stop = min(start + FILL_BATCH, target)
+            db_handler.save_files_info(BENCH_USER, [(path_of(i), path_of(i) + '.enc', key_id, rsa.MODE_RSA)
+                                                    for i in range(start, stop)])
+        rows = target
+        paths = [path_of(random.randrange(rows)) for _ in range(operations)]
+
+        def per_call(name: str, call: Callable[[str], object], arguments: list[str]) -> None:
+            """Time one function over its arguments and record the mean latency."""
+            start = time.perf_counter()
+            for argument in arguments:
+                call(argument)
+            elapsed = time.perf_counter() - start
+            results[f"db/{name}/{target}"] = _metric(elapsed / len(arguments) * 1e6, 'us', LOWER_IS_BETTER)
+
+        per_call('get_public_key', lambda _: db_handler.get_public_key(BENCH_USER), paths)
+        per_call('get_key_id_by_public_key', lambda _: db_handler.get_key_id_by_public_key(public_key), paths)
+        per_call('get_crt_params', lambda _: db_handler.get_crt_params(private_key), paths)
+        per_call('get_public_key_by_file', lambda path: db_handler.get_public_key_by_file(BENCH_USER, path), paths)
+        per_call('get_encrypted_file', lambda path: db_handler.get_encrypted_file(BENCH_USER, path), paths)
+        per_call('get_encryption_mode', lambda path: db_handler.get_encryption_mode(BENCH_USER, path), paths)
+        new_paths = [f"/bench/new/{i}.txt" for i in range(operations)]
+        per_call('save_file_info', lambda path: db_handler.save_file_info(BENCH_USER, path, path + '.enc', key_id),
+                 new_paths)
+        per_call('delete_file_from_db', lambda path: db_handler.delete_file_from_db(BENCH_USER, path), new_paths)
+        per_call('iter_files_page', lambda _: list(db_handler.iter_files(BENCH_USER, 100, random.randrange(rows))),
+                 paths)
+        per_call('list_all_files', lambda _: db_handler.list_all_files(BENCH_USER), paths[:3])
+    return results
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    """
+    Print every metric next to its baseline value and return the ones that regressed.
+
+    Args:
+        results (dict[str, dict]): Metrics of this run.
+        baseline (dict[str, dict]): Metrics of the saved run.
+        tolerance (float): Relative change allowed before a metric counts as a regression.
+
+    Returns:
+        list[str]: Names of the regressed metrics.
+    """
+    regressions = []
+    print(f"{'metric':<48} | {'baseline':>12} | {'current':>12} | {'change':>8}")
+    for name, metric in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], metric['value']
+        change = (new - old) / old if old else 0.0
+        worse = change > tolerance if metric['better'] == LOWER_IS_BETTER else change < -tolerance / (1 + tolerance)
+        if worse:
+            regressions.append(name)
+        print(f"{name:<48} | {old:>12.3f} | {new:>12.3f} | {change:>+7.1%}{'  REGRESSION' if worse else ''}")
+    return regressions
+
+def run(args: argparse.Namespace) -> int:
+    """
+    Run the selected benchmarks in a temporary directory and report the results.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line options.
+
+    Returns:
+        int: 1 if a metric regressed against the baseline, otherwise 0.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as work:
+        db_handler.DB_NAME = os.path.join(work, 'bench.db')
+        rsa.ENCRYPTED_DIR = os.path.join(work, 'encrypted_files')
+        codebook.CODEBOOK_DIR = os.path.join(work, 'codebooks')
+        os.makedirs(rsa.ENCRYPTED_DIR)
+        try:
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                db_handler.init_db()
+                db_handler.add_user(BENCH_USER)
+                if 'keygen' in args.only:
+                    results.update(bench_keygen(args.keygen_bits, args.repeats))
+                if 'cipher' in args.only:
+                    results.update(bench_cipher(work, args.cipher_bits, args.file_sizes, args.modes, args.repeats))
+                if 'storage' in args.only:
+                    results.update(bench_storage(work, args.small_files, args.small_file_size, args.repeats))
+                if 'verify' in args.only:
+                    results.update(bench_verify(work, args.verify_files, args.verify_file_size, args.verify_threads,
+                                                args.repeats))
+                if 'db' in args.only:
+                    results.update(bench_db(args.rows, args.operations))
+        finally:
+            # nothing may be written into the directory once it is gone
+            codebook.save_codebooks()
+            codebook._codebooks.clear()
+            db_handler.close_session()
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': bool(vectorized_available(3)),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to '{args.output}'")
+
+    if not args.baseline:
+        print(f"{'metric':<48} | {'value':>12} | unit")
+        for name, metric in results.items():
+            print(f"{name:<48} | {metric['value']:>12.3f} | {metric['unit']}")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+        return 1
+    print("No regressions.")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark key generation, encryption and database operations")
+    parser.add_argument('--only', nargs='+', choices=('keygen', 'cipher', 'storage', 'verify', 'db'),
+                        default=['keygen', 'cipher', 'storage', 'verify', 'db'], help="Benchmarks to run")
+    parser.add_argument('--keygen-bits', type=int, nargs='+', default=[512, 1024, 2048],
+                        help="Key sizes for key generation")
+    parser.add_argument('--cipher-bits', type=int, nargs='+', default=[23, 512, 2048],
+                        help="Key sizes for encryption and decryption")
+    parser.add_argument('--file-sizes', type=int, nargs='+', default=[1 << 16, 1 << 20],
+                        help="Plaintext sizes in bytes")
+    parser.add_argument('--modes', nargs='+', choices=rsa.ENCRYPTION_MODES, default=list(rsa.ENCRYPTION_MODES),
+                        help="Encryption modes")
+    parser.add_argument('--small-files', type=int, default=1000, help="Files per run of the storage benchmark")
+    parser.add_argument('--small-file-size', type=int, default=40, help="Plaintext size of those files in bytes")
+    parser.add_argument('--verify-files', type=int, default=16, help="Files checked by the verify benchmark")
+    parser.add_argument('--verify-file-size', type=int, default=4 << 20, help="Plaintext size of those files in bytes")
+    parser.add_argument('--verify-threads', type=int, nargs='+', default=[1, 4],
+                        help="Numbers of threads the verify benchmark compares")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6],
+                        help="Sizes of the files table for the database benchmarks")
+    parser.add_argument('--operations', type=int, default=200, help="Calls per database function and table size")
+    parser.add_argument('--repeats', type=int, default=3, help="Runs per key generation or file, the median is kept")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', help="Compare against the results saved in this JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Relative slowdown tolerated before a metric is a regression")
+    sys.exit(run(parser.parse_args()))
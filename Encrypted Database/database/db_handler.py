@@ -1,223 +1,1420 @@
-"""
-Database Handler Module
-
-This module manages all database operations for user data, RSA keys, and encrypted file information.
-
-"""
-
-import sqlite3
-import os
-
-DB_NAME = r'C:\Users\ioana\OneDrive\Desktop\Encrypted Database\database\encrypted_database.db'
-
-def init_db() -> None:
-    """
-    Initializes the SQLite database and creates necessary tables if they do not exist.
-
-    Tables:
-        - users: Stores user information.
-        - keys: Stores RSA keys for each user.
-        - files: Stores file paths and encryption details.
-
-    Returns:
-        None
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL)''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS keys (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    public_key TEXT,
-                    private_key TEXT,
-                    FOREIGN KEY(user_id) REFERENCES users(id))''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS files (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    file_path TEXT,
-                    encrypted_path TEXT,
-                    key_id INTEGER,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY(user_id) REFERENCES users(id),
-                    FOREIGN KEY(key_id) REFERENCES keys(id))''')
-
-    conn.commit()
-    conn.close()
-
-def add_user(username: str) -> None:
-    """
-    Adds a new user to the database if not already present.
-
-    Args:
-        username (str): Username to add to the database.
-
-    Returns:
-        None
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
-    conn.commit()
-    conn.close()
-
-def save_keys(username: str, e: int, d: int, n: int) -> None:
-    """
-    Saves the generated RSA public and private keys for a user.
-
-    Args:
-        username (str): Username of the key owner.
-        e (int): Public exponent.
-        d (int): Private exponent.
-        n (int): Modulus.
-
-    Returns:
-        None
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT id FROM users WHERE username = ?", (username,))
-    user_id = c.fetchone()[0]
-    public_key = f"({e}, {n})"
-    private_key = f"({d}, {n})"
-    c.execute("INSERT INTO keys (user_id, public_key, private_key) VALUES (?, ?, ?)",
-              (user_id, public_key, private_key))
-    conn.commit()
-    conn.close()
-
-def save_file_info(username: str, original_path: str, encrypted_path: str, key_id: int) -> None:
-    """
-    Saves information about an encrypted file in the database.
-
-    Args:
-        username (str): Username of the file owner.
-        original_path (str): Path to the original file.
-        encrypted_path (str): Path to the encrypted file.
-        key_id (int): ID of the key used for encryption.
-
-    Returns:
-        None
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT id FROM users WHERE username = ?", (username,))
-    user_id = c.fetchone()[0]
-    c.execute("INSERT INTO files (user_id, file_path, encrypted_path, key_id) VALUES (?, ?, ?, ?)",
-              (user_id, original_path, encrypted_path, key_id))
-    conn.commit()
-    conn.close()
-
-def get_public_key(username: str) -> str | None:
-    """
-    Retrieves the public key of a given user.
-
-    Args:
-        username (str): Username of the key owner.
-
-    Returns:
-        str | None: Public key if found, otherwise None.
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT public_key FROM keys INNER JOIN users ON keys.user_id = users.id WHERE users.username = ?", (username,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
-
-def get_public_key_by_file(username: str, file_path: str) -> str | None:
-    """
-    Retrieves the public key used to encrypt a specific file.
-
-    Args:
-        username (str): Username of the key owner.
-        file_path (str): Path to the original file.
-
-    Returns:
-        str | None: Public key if found, otherwise None.
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT keys.public_key FROM keys INNER JOIN files ON keys.id = files.key_id INNER JOIN users ON keys.user_id = users.id WHERE users.username = ? AND files.file_path = ?", (username, file_path))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
-
-def get_key_id_by_public_key(public_key_str: str) -> int | None:
-    """
-    Retrieves the key ID associated with a given public key.
-
-    Args:
-        public_key_str (str): The public key in string format.
-
-    Returns:
-        int | None: Key ID if found, otherwise None.
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT id FROM keys WHERE public_key = ?", (public_key_str,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
-
-def list_all_files(username: str) -> None:
-    """
-    Lists all encrypted files associated with a user.
-
-    Args:
-        username (str): Username to list files for.
-
-    Returns:
-        None
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT encrypted_path, timestamp FROM files INNER JOIN users ON files.user_id = users.id WHERE users.username = ?", (username,))
-    files = c.fetchall()
-    conn.close()
-    if files:
-        print("Encrypted files:")
-        for file in files:
-            encrypted_file_name = os.path.basename(file[0])
-            print(f"{encrypted_file_name} | {file[1]}")
-    else:
-        print("There are no encrypted files!")
-
-
-def get_encrypted_file(username: str, file_path: str) -> str | None:
-    """
-    Retrieves the encrypted file path for a given user and file.
-
-    Args:
-        username (str): Username of the file owner.
-        file_path (str): Path to the original file.
-
-    Returns:
-        str | None: Path to the encrypted file if found, otherwise None.
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT encrypted_path FROM files INNER JOIN users ON files.user_id = users.id WHERE users.username = ? AND files.file_path = ?", (username, file_path))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
-
-def delete_file_from_db(username: str, file_path: str) -> None:
-    """
-    Deletes the record of a file from the database for a specific user.
-
-    Args:
-        username (str): Username of the file owner.
-        file_path (str): Path to the original file.
-
-    Returns:
-        None
-    """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("DELETE FROM files WHERE user_id = (SELECT id FROM users WHERE username = ?) AND file_path = ?", (username, file_path))
-    conn.commit()
-    conn.close()
+"""
+Database Handler Module
+
+This module manages all database operations for user data, RSA keys, and encrypted file information.
+
+"""
+
+import atexit
+import json
+import sqlite3
+import sys
+import os
+import threading
+from collections import OrderedDict
+from contextlib import AbstractContextManager, contextmanager
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, NamedTuple
+from encryption.keys import RSAKey, make_key, parse_key, int_to_blob, blob_to_int, key_fingerprint
+from instrumentation import metrics
+
+DB_NAME = r'C:\Users\ioana\OneDrive\Desktop\Encrypted Database\database\encrypted_database.db'
+
+BUSY_TIMEOUT = 30.0
+CACHED_STATEMENTS = 256
+
+# Parsed keys kept in memory, so repeated commands with the same key run no SQL for it
+KEY_CACHE_SIZE = 64
+
+# Columns of the keys table making up an RSAKey, in the order _row_to_key expects
+KEY_COLUMNS = "id, e, n, d, p, q, dp, dq, qinv"
+
+# Rows fetched from SQLite per call while listing, so memory does not grow with the catalog
+LIST_BATCH = 1000
+LIST_SORTS = ('time', 'path')
+LIST_FORMATS = ('text', 'json', 'tsv')
+# Format of files.timestamp, as written by CURRENT_TIMESTAMP (UTC)
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Columns of the files table making up a StoredFile, for a query on files aliased as f
+STORED_FILE_COLUMNS = "f.id, f.file_path, f.encrypted_path, f.key_id, COALESCE(f.mode, 'rsa'), f.size, f.content_hash"
+# Columns of the files table making up a ContainerLocation, for a query on files aliased as f
+LOCATION_COLUMNS = ("f.storage, f.encrypted_path, f.pack_path, f.pack_offset, f.pack_length, f.inline_data, "
+                    "f.checksum, f.encrypted_size")
+LOCATION_UPDATE = ("storage = ?, encrypted_path = ?, pack_path = ?, pack_offset = ?, pack_length = ?, inline_data = ?, "
+                   "checksum = ?, encrypted_size = ?")
+
+class DatabaseSession:
+    """
+    A long-lived SQLite connection shared by all database operations.
+
+    The connection runs in WAL journal mode with synchronous=NORMAL, so a commit
+    no longer waits for a full fsync, and it keeps a cache of prepared statements.
+    Operations are grouped with transaction(); nested transactions join the
+    outermost one, so many writes can share a single commit.
+    """
+
+    def __init__(self, db_name: str, busy_timeout: float = BUSY_TIMEOUT,
+                 cached_statements: int = CACHED_STATEMENTS) -> None:
+        """
+        Opens the connection and applies the connection settings.
+
+        Args:
+            db_name (str): Path to the SQLite database file.
+            busy_timeout (float): Seconds to wait for a lock held by another process.
+            cached_statements (int): Number of prepared statements kept per connection.
+
+        Returns:
+            None
+        """
+        self.db_name = db_name
+        self.conn = sqlite3.connect(db_name, timeout=busy_timeout, isolation_level=None,
+                                    cached_statements=cached_statements, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+        self._depth = 0
+
+    def execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        """
+        Runs a single statement.
+
+        Args:
+            sql (str): SQL statement with ? placeholders.
+            params (tuple): Values bound to the placeholders.
+
+        Returns:
+            sqlite3.Cursor: Cursor over the results.
+        """
+        if not metrics.ENABLED:
+            return self.conn.execute(sql, params)
+        metrics.count('db.statements')
+        with metrics.stage('db.execute', sql=sql):
+            return self.conn.execute(sql, params)
+
+    def executemany(self, sql: str, rows) -> sqlite3.Cursor:
+        """
+        Runs a statement once per row of parameters.
+
+        Args:
+            sql (str): SQL statement with ? placeholders.
+            rows: Iterable of parameter tuples.
+
+        Returns:
+            sqlite3.Cursor: Cursor of the last execution.
+        """
+        if not metrics.ENABLED:
+            return self.conn.executemany(sql, rows)
+        rows = list(rows)
+        metrics.count('db.statements', len(rows))
+        with metrics.stage('db.executemany', sql=sql, rows=len(rows)):
+            return self.conn.executemany(sql, rows)
+
+    @contextmanager
+    def transaction(self) -> Iterator["DatabaseSession"]:
+        """
+        Groups the statements run inside the block into one transaction.
+
+        The outermost block commits on success and rolls back on error, inner
+        blocks simply join it.
+
+        Returns:
+            Iterator[DatabaseSession]: This session.
+        """
+        if self._depth == 0:
+            self.execute("BEGIN IMMEDIATE")
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            if self._depth == 0:
+                self.execute("ROLLBACK")
+            raise
+        self._depth -= 1
+        if self._depth == 0:
+            self.execute("COMMIT")
+
+    def close(self) -> None:
+        """
+        Closes the underlying connection.
+
+        Returns:
+            None
+        """
+        self.conn.close()
+
+_local = threading.local()
+_sessions: list[DatabaseSession] = []
+_sessions_lock = threading.Lock()
+
+def get_session() -> DatabaseSession:
+    """
+    Returns the calling thread's session, opening it on first use or when DB_NAME has changed.
+
+    Each thread gets its own connection, so threads never interleave statements
+    inside each other's transactions.
+
+    Returns:
+        DatabaseSession: The open session.
+    """
+    session = getattr(_local, 'session', None)
+    if session is not None and session.db_name == DB_NAME and session in _sessions:
+        return session
+    with _sessions_lock:
+        if session in _sessions:
+            session.close()
+            _sessions.remove(session)
+        session = _local.session = DatabaseSession(DB_NAME)
+        _sessions.append(session)
+    return session
+
+def close_session() -> None:
+    """
+    Closes every open session.
+
+    Returns:
+        None
+    """
+    with _sessions_lock:
+        for session in _sessions:
+            session.close()
+        _sessions.clear()
+
+def transaction() -> AbstractContextManager[DatabaseSession]:
+    """
+    Groups several database operations into a single transaction on the shared session.
+
+    Example:
+        with transaction():
+            for path in paths:
+                save_file_info(username, path, encrypted_path(path), key_id)
+
+    Returns:
+        AbstractContextManager[DatabaseSession]: Context manager committing once when the block ends.
+    """
+    return get_session().transaction()
+
+atexit.register(close_session)
+
+def init_db() -> None:
+    """
+    Initializes the SQLite database and brings its schema up to date.
+
+    When PRAGMA user_version already equals SCHEMA_VERSION no DDL runs at all.
+
+    Tables:
+        - users: Stores user information.
+        - keys: Stores RSA keys for each user, as integers encoded in BLOBs.
+        - files: Stores file paths and encryption details.
+
+    Returns:
+        None
+    """
+    migrate(get_session())
+
+def migrate(session: DatabaseSession) -> int:
+    """
+    Applies every migration newer than the database's PRAGMA user_version.
+
+    Each migration runs in its own transaction together with the version bump,
+    so an interrupted upgrade resumes from the last completed step. The version is
+    read again once the transaction holds the write lock, so a step another process
+    applied in the meantime is skipped instead of run twice.
+
+    Args:
+        session (DatabaseSession): Session on the database to upgrade.
+
+    Returns:
+        int: The schema version after the upgrade.
+    """
+    version = session.execute("PRAGMA user_version").fetchone()[0]
+    for target, migration in MIGRATIONS:
+        if version < target:
+            with session.transaction():
+                version = session.execute("PRAGMA user_version").fetchone()[0]
+                if version < target:
+                    migration(session)
+                    session.execute(f"PRAGMA user_version = {target}")
+                    version = target
+    return version
+
+def _migration_1_base_tables(c: DatabaseSession) -> None:
+    """
+    Creates the tables and adds any columns missing from database files written before migrations existed.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+
+    Returns:
+        None
+    """
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS keys (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    public_key TEXT,
+                    private_key TEXT,
+                    p TEXT,
+                    q TEXT,
+                    dp TEXT,
+                    dq TEXT,
+                    qinv TEXT,
+                    FOREIGN KEY(user_id) REFERENCES users(id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    file_path TEXT,
+                    encrypted_path TEXT,
+                    key_id INTEGER,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    mode TEXT DEFAULT 'rsa',
+                    FOREIGN KEY(user_id) REFERENCES users(id),
+                    FOREIGN KEY(key_id) REFERENCES keys(id))''')
+
+    _add_missing_columns(c, 'keys', {'p': 'TEXT', 'q': 'TEXT', 'dp': 'TEXT', 'dq': 'TEXT', 'qinv': 'TEXT'})
+    _add_missing_columns(c, 'files', {'mode': "TEXT DEFAULT 'rsa'"})
+
+def _migration_2_lookup_indexes(c: DatabaseSession) -> None:
+    """
+    Adds the secondary indexes used by the per-user file and key lookups.
+
+    Duplicate rows of one user for the same public key are merged first, pointing
+    their files at the user's oldest row, so the public key can be indexed as unique.
+    A public key saved by several users is never moved from one user to another: the
+    migration stops instead, and the database stays at the previous version.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+
+    Returns:
+        None
+
+    Raises:
+        sqlite3.IntegrityError: If several users saved the same public key.
+    """
+    c.execute('''UPDATE files SET key_id = (
+                    SELECT MIN(k2.id) FROM keys k1 INNER JOIN keys k2
+                        ON k1.public_key = k2.public_key AND k2.user_id IS k1.user_id
+                    WHERE k1.id = files.key_id)
+                 WHERE key_id IS NOT NULL AND key_id IN (SELECT id FROM keys)''')
+    c.execute("DELETE FROM keys WHERE id NOT IN (SELECT MIN(id) FROM keys GROUP BY user_id, public_key)")
+    shared = c.execute("SELECT COUNT(*) FROM (SELECT public_key FROM keys GROUP BY public_key HAVING COUNT(*) > 1)").fetchone()[0]
+    if shared:
+        raise sqlite3.IntegrityError(f"{shared} public key(s) are saved by several users; remove the duplicates "
+                                     "before upgrading the database")
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_path ON files(user_id, file_path)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_keys_user ON keys(user_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_keys_public_key ON keys(public_key)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_keys_private_key ON keys(private_key)")
+
+def _add_missing_columns(c: DatabaseSession, table: str, columns: dict[str, str]) -> None:
+    """
+    Adds columns introduced after a table was first created, so older database files keep working.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+        table (str): Name of the table to upgrade.
+        columns (dict[str, str]): Column names mapped to their SQL types.
+
+    Returns:
+        None
+    """
+    existing = {row[1] for row in c.execute(f"PRAGMA table_info({table})").fetchall()}
+    for name, sql_type in columns.items():
+        if name not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {sql_type}")
+
+def _migration_3_binary_keys(c: DatabaseSession) -> None:
+    """
+    Rebuilds the keys table with the key components stored as big-endian BLOBs.
+
+    The '(e, n)' and '(d, n)' strings are parsed once here and replaced by the
+    integers and a unique fingerprint of the public key. Row ids are kept, so
+    files.key_id stays valid.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+
+    Returns:
+        None
+    """
+    c.execute('''CREATE TABLE keys_v3 (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    fingerprint BLOB NOT NULL,
+                    e BLOB NOT NULL,
+                    n BLOB NOT NULL,
+                    d BLOB,
+                    p BLOB,
+                    q BLOB,
+                    dp BLOB,
+                    dq BLOB,
+                    qinv BLOB,
+                    FOREIGN KEY(user_id) REFERENCES users(id))''')
+    rows = c.execute("SELECT id, user_id, public_key, private_key, p, q, dp, dq, qinv FROM keys").fetchall()
+    converted = []
+    for key_id, user_id, public_key, private_key, *crt in rows:
+        e, n = parse_key(public_key)
+        d = parse_key(private_key)[0] if private_key else None
+        converted.append((key_id, user_id, key_fingerprint(e, n), int_to_blob(e), int_to_blob(n), int_to_blob(d))
+                         + tuple(int_to_blob(int(value)) if value else None for value in crt))
+    c.executemany("INSERT INTO keys_v3 (id, user_id, fingerprint, e, n, d, p, q, dp, dq, qinv) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", converted)
+    c.execute("DROP TABLE keys")
+    c.execute("ALTER TABLE keys_v3 RENAME TO keys")
+
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_keys_fingerprint ON keys(fingerprint)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_keys_user ON keys(user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_keys_modulus ON keys(n)")
+
+def _migration_4_listing_indexes(c: DatabaseSession) -> None:
+    """
+    Adds the indexes behind the paginated and filtered file listing.
+
+    idx_files_user_path already serves the path order and the prefix filter.
+    idx_files_user gives the time order (file ids), idx_files_user_key keeps it
+    under the key filter, and idx_files_user_time finds the ends of a time range.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+
+    Returns:
+        None
+    """
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user ON files(user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_key ON files(user_id, key_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_time ON files(user_id, timestamp)")
+
+def _migration_5_content_hashes(c: DatabaseSession) -> None:
+    """
+    Adds the plaintext hash and size of each file, used to find identical plaintexts.
+
+    Rows written before this migration have no hash and are never deduplicated.
+    The index on encrypted_path counts the rows sharing an encrypted file.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+
+    Returns:
+        None
+    """
+    _add_missing_columns(c, 'files', {'content_hash': 'BLOB', 'size': 'INTEGER'})
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_content ON files(key_id, size, content_hash)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_encrypted_path ON files(encrypted_path)")
+
+def _migration_6_chunk_digests(c: DatabaseSession) -> None:
+    """
+    Adds the digests of each plaintext chunk, used to re-encrypt only the chunks that changed.
+
+    Rows written before this migration have none and are re-encrypted in full by their first update.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+
+    Returns:
+        None
+    """
+    _add_missing_columns(c, 'files', {'chunk_digests': 'BLOB'})
+
+def _migration_7_key_rotations(c: DatabaseSession) -> None:
+    """
+    Adds the table checkpointing key rotations, so an interrupted rotation resumes where it stopped.
+
+    At most one rotation per user and pair of keys is unfinished at a time.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+
+    Returns:
+        None
+    """
+    c.execute('''CREATE TABLE IF NOT EXISTS key_rotations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    from_key_id INTEGER NOT NULL,
+                    to_key_id INTEGER NOT NULL,
+                    last_file_id INTEGER NOT NULL DEFAULT 0,
+                    rotated INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    started DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    finished DATETIME,
+                    FOREIGN KEY(user_id) REFERENCES users(id),
+                    FOREIGN KEY(from_key_id) REFERENCES keys(id),
+                    FOREIGN KEY(to_key_id) REFERENCES keys(id))''')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_key_rotations_open ON key_rotations(user_id, from_key_id, to_key_id)
+                 WHERE finished IS NULL''')
+
+def _migration_8_storage_backends(c: DatabaseSession) -> None:
+    """
+    Adds where each file's container is kept: its own file, a range of a packfile, or the row itself.
+
+    Existing rows keep their own files. The partial index finds the rows sharing a
+    packfile object and the objects of a packfile being compacted.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+
+    Returns:
+        None
+    """
+    _add_missing_columns(c, 'files', {'storage': "TEXT NOT NULL DEFAULT 'file'", 'pack_path': 'TEXT',
+                                      'pack_offset': 'INTEGER', 'pack_length': 'INTEGER', 'inline_data': 'BLOB'})
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_pack ON files(pack_path, pack_offset) WHERE pack_path IS NOT NULL")
+
+def _migration_9_container_checksums(c: DatabaseSession) -> None:
+    """
+    Adds the checksum and size of each encrypted container, recorded when it is written.
+
+    They let the verify command find damaged containers without decrypting them. Rows
+    written before this migration have none and are only checked for existence.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+
+    Returns:
+        None
+    """
+    _add_missing_columns(c, 'files', {'checksum': 'BLOB', 'encrypted_size': 'INTEGER'})
+
+def _migration_10_search_tokens(c: DatabaseSession) -> None:
+    """
+    Adds the blind index: one row per keyed token of a word and file containing it.
+
+    The primary key answers a search with one index range per token. The second index
+    finds a file's tokens when the file is deleted or its content changes.
+
+    Args:
+        c (DatabaseSession): Session inside an open transaction.
+
+    Returns:
+        None
+    """
+    c.execute('''CREATE TABLE IF NOT EXISTS file_tokens (
+                    token BLOB NOT NULL,
+                    file_id INTEGER NOT NULL,
+                    PRIMARY KEY (token, file_id),
+                    FOREIGN KEY(file_id) REFERENCES files(id)) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_file_tokens_file ON file_tokens(file_id)")
+
+MIGRATIONS = [
+    (1, _migration_1_base_tables),
+    (2, _migration_2_lookup_indexes),
+    (3, _migration_3_binary_keys),
+    (4, _migration_4_listing_indexes),
+    (5, _migration_5_content_hashes),
+    (6, _migration_6_chunk_digests),
+    (7, _migration_7_key_rotations),
+    (8, _migration_8_storage_backends),
+    (9, _migration_9_container_checksums),
+    (10, _migration_10_search_tokens),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def add_user(username: str) -> None:
+    """
+    Adds a new user to the database if not already present.
+
+    The user is looked up first, so the usual case of an existing user takes no write lock.
+
+    Args:
+        username (str): Username to add to the database.
+
+    Returns:
+        None
+    """
+    session = get_session()
+    if session.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+        return
+    with session.transaction():
+        session.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+
+def save_keys(username: str, e: int, d: int, n: int,
+              crt: tuple[int, int, int, int, int] | None = None) -> int:
+    """
+    Saves the generated RSA public and private keys for a user.
+
+    Args:
+        username (str): Username of the key owner.
+        e (int): Public exponent.
+        d (int): Private exponent.
+        n (int): Modulus.
+        crt (tuple[int, int, int, int, int] | None): CRT parameters (p, q, dP, dQ, qInv), if known.
+
+    Returns:
+        int: ID of the new key.
+    """
+    crt_values = tuple(int_to_blob(value) for value in crt) if crt else (None,) * 5
+    session = get_session()
+    with session.transaction():
+        user_id = session.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()[0]
+        cursor = session.execute("INSERT INTO keys (user_id, fingerprint, e, n, d, p, q, dp, dq, qinv) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (user_id, key_fingerprint(e, n), int_to_blob(e), int_to_blob(n), int_to_blob(d)) + crt_values)
+    return cursor.lastrowid
+
+class ContainerLocation(NamedTuple):
+    """
+    Where the encrypted container of a file is kept.
+
+    Attributes:
+        storage (str): Backend holding it, 'file', 'pack' or 'inline'.
+        encrypted_path (str): Path to the encrypted file; for the other backends, the name it is listed under.
+        pack_path (str | None): Path to the packfile holding it.
+        pack_offset (int | None): Offset of the container in the packfile.
+        pack_length (int | None): Length of the container in the packfile.
+        inline_data (bytes | None): The container itself, when it is stored in the row.
+        checksum (bytes | None): SHA-256 of the container as computed by container_checksum(), if known.
+        encrypted_size (int | None): Size of the container in bytes, if known.
+    """
+    storage: str
+    encrypted_path: str
+    pack_path: str | None = None
+    pack_offset: int | None = None
+    pack_length: int | None = None
+    inline_data: bytes | None = None
+    checksum: bytes | None = None
+    encrypted_size: int | None = None
+
+def as_location(location: "ContainerLocation | str") -> ContainerLocation:
+    """
+    Turns the path of an encrypted file into its location, leaving locations unchanged.
+
+    Args:
+        location (ContainerLocation | str): A location, or the path of a container stored in its own file.
+
+    Returns:
+        ContainerLocation: The location.
+    """
+    return location if isinstance(location, ContainerLocation) else ContainerLocation('file', location)
+
+def save_file_info(username: str, original_path: str, encrypted_path: ContainerLocation | str, key_id: int,
+                   mode: str = 'rsa', content_hash: bytes | None = None, size: int | None = None,
+                   chunk_digests: bytes | None = None, tokens: list[bytes] | None = None) -> None:
+    """
+    Saves information about an encrypted file in the database.
+
+    Args:
+        username (str): Username of the file owner.
+        original_path (str): Path to the original file.
+        encrypted_path (ContainerLocation | str): Location of the container, or the path of the encrypted file.
+        key_id (int): ID of the key used for encryption.
+        mode (str): Encryption mode the file was written with.
+        content_hash (bytes | None): SHA-256 of the plaintext, if known.
+        size (int | None): Size of the plaintext in bytes, if known.
+        chunk_digests (bytes | None): Concatenated digests of the plaintext chunks, if known.
+        tokens (list[bytes] | None): Blind index tokens of the words of the plaintext, if it is indexed.
+
+    Returns:
+        None
+    """
+    save_files_info(username, [(original_path, encrypted_path, key_id, mode, content_hash, size, chunk_digests,
+                                tokens)])
+
+def save_files_info(username: str, rows: list[tuple]) -> None:
+    """
+    Saves information about many encrypted files in a single transaction.
+
+    Args:
+        username (str): Username of the file owner.
+        rows (list[tuple]): (original_path, encrypted_path, key_id, mode) for each file, where encrypted_path
+            is a ContainerLocation or the path of the encrypted file, optionally followed by the plaintext's
+            content_hash, size and chunk_digests, and by its blind index tokens.
+
+    Returns:
+        None
+    """
+    session = get_session()
+    sql = ("INSERT INTO files (user_id, file_path, key_id, mode, content_hash, size, chunk_digests, "
+           "storage, encrypted_path, pack_path, pack_offset, pack_length, inline_data, checksum, encrypted_size) "
+           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+    with session.transaction():
+        user_id = session.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()[0]
+        values = [(user_id, row[0]) + tuple(row[2:7]) + (None,) * (7 - len(row[:7])) + as_location(row[1])
+                  for row in rows]
+        if not any(row[7:8] and row[7] for row in rows):
+            session.executemany(sql, values)
+            return
+        # the tokens need the id of their row
+        for row, row_values in zip(rows, values):
+            file_id = session.execute(sql, row_values).lastrowid
+            if row[7:8] and row[7]:
+                session.executemany("INSERT OR IGNORE INTO file_tokens (token, file_id) VALUES (?, ?)",
+                                    [(token, file_id) for token in row[7]])
+
+def has_plaintext_size(username: str, key_id: int, size: int) -> bool:
+    """
+    Checks whether a user has any hashed file of this size encrypted with a key.
+
+    This tells, without reading the file, whether hashing it can find a duplicate.
+
+    Args:
+        username (str): Username of the file owner.
+        key_id (int): ID of the key.
+        size (int): Size of the plaintext in bytes.
+
+    Returns:
+        bool: True if such a file exists.
+    """
+    return get_session().execute("""SELECT 1 FROM files f INNER JOIN users ON f.user_id = users.id
+                                    WHERE users.username = ? AND f.key_id = ? AND f.size = ?
+                                    AND f.content_hash IS NOT NULL LIMIT 1""",
+                                 (username, key_id, size)).fetchone() is not None
+
+def find_encrypted_copy(username: str, key_id: int, size: int,
+                        content_hash: bytes) -> tuple[ContainerLocation, str] | None:
+    """
+    Finds an encrypted container of a user holding the same plaintext under the same key.
+
+    Containers are only shared between the files of one user, so no user learns through
+    deduplication which files another user stores.
+
+    Args:
+        username (str): Username of the file owner.
+        key_id (int): ID of the key.
+        size (int): Size of the plaintext in bytes.
+        content_hash (bytes): SHA-256 of the plaintext.
+
+    Returns:
+        tuple[ContainerLocation, str] | None: Location and mode of the container if one exists, otherwise None.
+    """
+    result = get_session().execute(f"""SELECT {LOCATION_COLUMNS}, COALESCE(f.mode, 'rsa')
+                                       FROM files f INNER JOIN users ON f.user_id = users.id
+                                       WHERE users.username = ? AND f.key_id = ? AND f.size = ? AND f.content_hash = ?
+                                       LIMIT 1""",
+                                   (username, key_id, size, content_hash)).fetchone()
+    return (ContainerLocation(*result[:-1]), result[-1]) if result else None
+
+def count_file_references(location: ContainerLocation | str) -> int:
+    """
+    Counts the file rows of all users pointing at an encrypted container.
+
+    A container stored inline belongs to its row alone, so nothing else points at it.
+
+    Args:
+        location (ContainerLocation | str): Location of the container, or the path of the encrypted file.
+
+    Returns:
+        int: Number of rows; the container may only be removed when it is 0.
+    """
+    location = as_location(location)
+    if location.storage == 'inline':
+        return 0
+    if location.storage == 'pack':
+        sql, params = "SELECT COUNT(*) FROM files WHERE pack_path = ? AND pack_offset = ?", (location.pack_path,
+                                                                                           location.pack_offset)
+    else:
+        sql, params = "SELECT COUNT(*) FROM files WHERE encrypted_path = ? AND storage = 'file'", (location.encrypted_path,)
+    return get_session().execute(sql, params).fetchone()[0]
+
+def get_pack_objects(pack_path: str) -> list[tuple[int, int]]:
+    """
+    Retrieves the objects of a packfile still used by a row, in file order.
+
+    Args:
+        pack_path (str): Path to the packfile.
+
+    Returns:
+        list[tuple[int, int]]: Offset and length of each object, once however many rows share it.
+    """
+    return [tuple(row) for row in get_session().execute(
+        "SELECT DISTINCT pack_offset, pack_length FROM files WHERE pack_path = ? ORDER BY pack_offset",
+        (pack_path,)).fetchall()]
+
+def move_pack_objects(pack_path: str, new_pack_path: str, moves: list[tuple[int, int]]) -> None:
+    """
+    Points the rows of packfile objects at their copies in another packfile, in a single transaction.
+
+    Args:
+        pack_path (str): Path to the packfile the objects are in.
+        new_pack_path (str): Path to the packfile they were copied to.
+        moves (list[tuple[int, int]]): Old and new offset of each object.
+
+    Returns:
+        None
+    """
+    session = get_session()
+    with session.transaction():
+        session.executemany("UPDATE files SET pack_path = ?, pack_offset = ? WHERE pack_path = ? AND pack_offset = ?",
+                            [(new_pack_path, new_offset, pack_path, offset) for offset, new_offset in moves])
+
+def iter_containers(username: str | None = None) -> Iterator[tuple[str, str, ContainerLocation]]:
+    """
+    Iterates over the containers of the catalog, or of one user, in id order.
+
+    Rows are fetched LIST_BATCH at a time, so memory stays constant.
+
+    Args:
+        username (str | None): Only this user's files, every user's when None.
+
+    Returns:
+        Iterator[tuple[str, str, ContainerLocation]]: Username, original path and container location of each row.
+    """
+    sql = f"SELECT users.username, f.file_path, {LOCATION_COLUMNS} FROM files f INNER JOIN users ON f.user_id = users.id"
+    params: tuple = ()
+    if username is not None:
+        sql += " WHERE users.username = ?"
+        params = (username,)
+    cursor = get_session().execute(sql + " ORDER BY f.id", params)
+    while rows := cursor.fetchmany(LIST_BATCH):
+        for row in rows:
+            yield row[0], row[1], ContainerLocation(*row[2:])
+
+def get_referenced_paths() -> set[str]:
+    """
+    Retrieves the path of every encrypted file and packfile some row of any user points at.
+
+    Returns:
+        set[str]: The paths.
+    """
+    session = get_session()
+    paths = {row[0] for row in session.execute("SELECT DISTINCT encrypted_path FROM files WHERE storage = 'file'")}
+    paths.update(row[0] for row in session.execute("SELECT DISTINCT pack_path FROM files WHERE pack_path IS NOT NULL"))
+    return paths
+
+class StoredFile(NamedTuple):
+    """
+    What the database knows about the current encrypted version of a file.
+
+    Attributes:
+        id (int): ID of the row.
+        file_path (str): Path to the original file.
+        encrypted_path (str): Path to the encrypted file.
+        key_id (int | None): ID of the key used for encryption.
+        mode (str): Encryption mode the file was written with.
+        size (int | None): Size of the plaintext in bytes, None for rows older than content hashes.
+        content_hash (bytes | None): SHA-256 of the plaintext, if known.
+        chunk_digests (bytes | None): Concatenated digests of the plaintext chunks, if known.
+        location (ContainerLocation): Where the encrypted container is kept.
+    """
+    id: int
+    file_path: str
+    encrypted_path: str
+    key_id: int | None
+    mode: str
+    size: int | None
+    content_hash: bytes | None
+    chunk_digests: bytes | None
+    location: ContainerLocation
+
+def _stored_file(row: tuple) -> StoredFile:
+    """Build a StoredFile from the STORED_FILE_COLUMNS, chunk digests and LOCATION_COLUMNS of a files row."""
+    return StoredFile(*row[:8], ContainerLocation(*row[8:]))
+
+def get_stored_file(username: str, file_path: str) -> StoredFile | None:
+    """
+    Retrieves the newest row recorded for a user's file.
+
+    A row reusing another row's encrypted file takes the chunk digests from that row.
+
+    Args:
+        username (str): Username of the file owner.
+        file_path (str): Path to the original file.
+
+    Returns:
+        StoredFile | None: The row if the file is known, otherwise None.
+    """
+    result = get_session().execute(f'''SELECT {STORED_FILE_COLUMNS},
+                                          COALESCE(f.chunk_digests, (SELECT c.chunk_digests FROM files c
+                                                                     WHERE c.encrypted_path = f.encrypted_path AND c.chunk_digests IS NOT NULL
+                                                                     LIMIT 1)),
+                                          {LOCATION_COLUMNS}
+                                      FROM files f INNER JOIN users ON f.user_id = users.id
+                                      WHERE users.username = ? AND f.file_path = ? ORDER BY f.id DESC LIMIT 1''',
+                                   (username, file_path)).fetchone()
+    return _stored_file(result) if result else None
+
+def update_file_info(file_id: int, encrypted_path: ContainerLocation | str, key_id: int | None, mode: str,
+                     content_hash: bytes, size: int, chunk_digests: bytes | None) -> list[ContainerLocation]:
+    """
+    Points a file row at the new version of its encrypted file, in a single transaction.
+
+    The row keeps its id and timestamp. Older rows of the same user for the same path,
+    left behind by encrypting a file again, are removed. The row's blind index tokens
+    are removed when its content changed, see save_file_tokens().
+
+    Args:
+        file_id (int): ID of the row to update.
+        encrypted_path (ContainerLocation | str): Location of the container, or the path of the encrypted file.
+        key_id (int | None): ID of the key used for encryption.
+        mode (str): Encryption mode the file was written with.
+        content_hash (bytes): SHA-256 of the plaintext.
+        size (int): Size of the plaintext in bytes.
+        chunk_digests (bytes | None): Concatenated digests of the plaintext chunks, if known.
+
+    Returns:
+        list[ContainerLocation]: Containers of the removed rows, which may no longer be used by any row.
+    """
+    session = get_session()
+    with session.transaction():
+        user_id, file_path, old_hash = session.execute("SELECT user_id, file_path, content_hash FROM files WHERE id = ?",
+                                                       (file_id,)).fetchone()
+        removed = session.execute(f"SELECT {LOCATION_COLUMNS} FROM files f WHERE f.user_id = ? AND f.file_path = ? AND f.id != ?",
+                                  (user_id, file_path, file_id)).fetchall()
+        session.execute("DELETE FROM file_tokens WHERE file_id IN (SELECT id FROM files WHERE user_id = ? AND file_path = ? AND id != ?)",
+                        (user_id, file_path, file_id))
+        session.execute("DELETE FROM files WHERE user_id = ? AND file_path = ? AND id != ?", (user_id, file_path, file_id))
+        if old_hash != content_hash:
+            session.execute("DELETE FROM file_tokens WHERE file_id = ?", (file_id,))
+        session.execute(f"UPDATE files SET key_id = ?, mode = ?, content_hash = ?, size = ?, chunk_digests = ?, {LOCATION_UPDATE} "
+                        "WHERE id = ?",
+                        (key_id, mode, content_hash, size, chunk_digests) + as_location(encrypted_path) + (file_id,))
+    return [ContainerLocation(*row) for row in removed]
+
+def save_file_tokens(file_id: int, tokens: list[bytes]) -> None:
+    """
+    Replaces the blind index tokens of a file row, in a single transaction.
+
+    Args:
+        file_id (int): ID of the row.
+        tokens (list[bytes]): Tokens of the words of its plaintext.
+
+    Returns:
+        None
+    """
+    session = get_session()
+    with session.transaction():
+        session.execute("DELETE FROM file_tokens WHERE file_id = ?", (file_id,))
+        session.executemany("INSERT OR IGNORE INTO file_tokens (token, file_id) VALUES (?, ?)",
+                            [(token, file_id) for token in tokens])
+
+def get_files_by_key(username: str, key_id: int, after: int = 0, limit: int = LIST_BATCH) -> list[StoredFile]:
+    """
+    Retrieves one page of a user's files encrypted with a key, in id order.
+
+    The page is read in full before it is returned, so its rows may be updated while it is processed.
+
+    Args:
+        username (str): Username of the file owner.
+        key_id (int): ID of the key.
+        after (int): Only files with a greater id.
+        limit (int): Maximum number of files returned.
+
+    Returns:
+        list[StoredFile]: The files.
+    """
+    rows = get_session().execute(f"SELECT {STORED_FILE_COLUMNS}, f.chunk_digests, {LOCATION_COLUMNS} "
+                                 "FROM files f INNER JOIN users ON f.user_id = users.id "
+                                 "WHERE users.username = ? AND f.key_id = ? AND f.id > ? ORDER BY f.id LIMIT ?",
+                                 (username, key_id, after, limit)).fetchall()
+    return [_stored_file(row) for row in rows]
+
+def start_rotation(username: str, from_key_id: int, to_key_id: int) -> tuple[int, int] | None:
+    """
+    Finds the unfinished rotation of a user's files between two keys, or starts one.
+
+    Args:
+        username (str): Username of the file owner.
+        from_key_id (int): ID of the key the files are encrypted with.
+        to_key_id (int): ID of the key they are moved to.
+
+    Returns:
+        tuple[int, int] | None: ID of the rotation and the id of the last file it handled,
+        0 for a new rotation, or None if the user is unknown.
+    """
+    session = get_session()
+    with session.transaction():
+        user = session.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+        if user is None:
+            return None
+        row = session.execute("SELECT id, last_file_id FROM key_rotations WHERE user_id = ? AND from_key_id = ? AND to_key_id = ? AND finished IS NULL",
+                              (user[0], from_key_id, to_key_id)).fetchone()
+        if row:
+            return tuple(row)
+        cursor = session.execute("INSERT INTO key_rotations (user_id, from_key_id, to_key_id) VALUES (?, ?, ?)",
+                                 (user[0], from_key_id, to_key_id))
+    return cursor.lastrowid, 0
+
+def save_rotation_batch(rotation_id: int, key_id: int, rows: list[tuple], last_file_id: int, failed: int) -> None:
+    """
+    Moves a batch of files to their new key and checkpoints the rotation, in a single transaction.
+
+    Args:
+        rotation_id (int): ID of the rotation.
+        key_id (int): ID of the key the files were encrypted with again.
+        rows (list[tuple]): (file_id, encrypted_path, mode, content_hash, size, chunk_digests) of each rotated file,
+            where encrypted_path is a ContainerLocation or the path of the encrypted file.
+        last_file_id (int): Id of the last file handled, rotated or not.
+        failed (int): Number of files of the batch that could not be rotated.
+
+    Returns:
+        None
+    """
+    session = get_session()
+    with session.transaction():
+        session.executemany(f"UPDATE files SET key_id = ?, mode = ?, content_hash = ?, size = ?, chunk_digests = ?, "
+                            f"{LOCATION_UPDATE} WHERE id = ?",
+                            [(key_id,) + tuple(row[2:]) + as_location(row[1]) + (row[0],) for row in rows])
+        session.execute("UPDATE key_rotations SET last_file_id = ?, rotated = rotated + ?, failed = failed + ? WHERE id = ?",
+                        (last_file_id, len(rows), failed, rotation_id))
+
+def finish_rotation(rotation_id: int) -> tuple[int, int]:
+    """
+    Marks a rotation as finished.
+
+    Args:
+        rotation_id (int): ID of the rotation.
+
+    Returns:
+        tuple[int, int]: Number of files rotated and of files that failed, over all its runs.
+    """
+    session = get_session()
+    with session.transaction():
+        session.execute("UPDATE key_rotations SET finished = CURRENT_TIMESTAMP WHERE id = ?", (rotation_id,))
+        return tuple(session.execute("SELECT rotated, failed FROM key_rotations WHERE id = ?", (rotation_id,)).fetchone())
+
+_key_cache: OrderedDict[tuple, RSAKey] = OrderedDict()
+_key_cache_lock = threading.Lock()
+
+def _row_to_key(row: tuple) -> RSAKey:
+    """Build an RSAKey from the KEY_COLUMNS of a keys row."""
+    key_id, e, n, d, *crt = row
+    crt = tuple(blob_to_int(value) for value in crt) if crt[0] is not None else None
+    return make_key(blob_to_int(n), blob_to_int(e), blob_to_int(d), crt, key_id)
+
+def _cached_key(cache_key: tuple, load: Callable[[], RSAKey | None]) -> RSAKey | None:
+    """
+    Return a key from the LRU cache, loading and caching it on a miss.
+
+    Only stored keys are cached: keys are never modified once saved, so a cached
+    entry stays valid, while a key that is missing now may be saved later.
+
+    Args:
+        cache_key (tuple): What the key was looked up by.
+        load (Callable[[], RSAKey | None]): Function reading the key from the database.
+
+    Returns:
+        RSAKey | None: The key, or None if load() found nothing.
+    """
+    cache_key = (DB_NAME,) + cache_key
+    with _key_cache_lock:
+        key = _key_cache.get(cache_key)
+        if key is not None:
+            _key_cache.move_to_end(cache_key)
+            return key
+    key = load()
+    if key is not None and key.key_id is not None:
+        with _key_cache_lock:
+            _key_cache[cache_key] = key
+            if len(_key_cache) > KEY_CACHE_SIZE:
+                _key_cache.popitem(last=False)
+    return key
+
+def get_key(key_id: int) -> RSAKey | None:
+    """
+    Retrieves a stored key by its ID.
+
+    Args:
+        key_id (int): ID of the key.
+
+    Returns:
+        RSAKey | None: The key if found, otherwise None.
+    """
+    def load() -> RSAKey | None:
+        """Read the key with this ID."""
+        row = get_session().execute(f"SELECT {KEY_COLUMNS} FROM keys WHERE id = ?", (key_id,)).fetchone()
+        return _row_to_key(row) if row else None
+    return _cached_key(('id', key_id), load)
+
+def lookup_public_key(public_key_str: str) -> RSAKey:
+    """
+    Parses a public key '(e, n)' and finds it in the database by fingerprint.
+
+    Args:
+        public_key_str (str): The public key in string format.
+
+    Returns:
+        RSAKey: The stored key, or the parsed key with key_id None if it is not stored.
+
+    Raises:
+        ValueError: If the string is not a valid key.
+    """
+    def load() -> RSAKey:
+        """Parse the key and read it by fingerprint."""
+        e, n = parse_key(public_key_str)
+        row = get_session().execute(f"SELECT {KEY_COLUMNS} FROM keys WHERE fingerprint = ?",
+                                    (key_fingerprint(e, n),)).fetchone()
+        return _row_to_key(row) if row else make_key(n, e)
+    return _cached_key(('public', public_key_str), load)
+
+def lookup_private_key(private_key_str: str) -> RSAKey:
+    """
+    Parses a private key '(d, n)' and finds it in the database by modulus.
+
+    Args:
+        private_key_str (str): The private key in string format.
+
+    Returns:
+        RSAKey: The stored key, or the parsed key with key_id None if it is not stored.
+
+    Raises:
+        ValueError: If the string is not a valid key.
+    """
+    def load() -> RSAKey:
+        """Parse the key and read it by modulus and private exponent."""
+        d, n = parse_key(private_key_str)
+        row = get_session().execute(f"SELECT {KEY_COLUMNS} FROM keys WHERE n = ? AND d = ?",
+                                    (int_to_blob(n), int_to_blob(d))).fetchone()
+        return _row_to_key(row) if row else make_key(n, d=d)
+    return _cached_key(('private', private_key_str), load)
+
+def get_public_key(username: str) -> str | None:
+    """
+    Retrieves the public key of a given user.
+
+    Args:
+        username (str): Username of the key owner.
+
+    Returns:
+        str | None: Public key '(e, n)' if found, otherwise None.
+    """
+    result = get_session().execute("SELECT keys.e, keys.n FROM keys INNER JOIN users ON keys.user_id = users.id WHERE users.username = ?", (username,)).fetchone()
+    return f"({blob_to_int(result[0])}, {blob_to_int(result[1])})" if result else None
+
+def get_public_key_by_file(username: str, file_path: str) -> str | None:
+    """
+    Retrieves the public key used to encrypt a specific file.
+
+    Args:
+        username (str): Username of the key owner.
+        file_path (str): Path to the original file.
+
+    Returns:
+        str | None: Public key '(e, n)' if found, otherwise None.
+    """
+    result = get_session().execute("SELECT files.key_id FROM files INNER JOIN users ON files.user_id = users.id INNER JOIN keys ON keys.id = files.key_id WHERE users.username = ? AND files.file_path = ? AND keys.user_id = users.id", (username, file_path)).fetchone()
+    return get_key(result[0]).public_key_str if result else None
+
+def get_key_id_by_public_key(public_key_str: str) -> int | None:
+    """
+    Retrieves the key ID associated with a given public key.
+
+    Whitespace in the string does not matter, the key is matched by fingerprint.
+
+    Args:
+        public_key_str (str): The public key in string format.
+
+    Returns:
+        int | None: Key ID if found, otherwise None.
+    """
+    try:
+        return lookup_public_key(public_key_str).key_id
+    except ValueError:
+        return None
+
+def get_crt_params(private_key_str: str) -> tuple[int, int, int, int, int] | None:
+    """
+    Retrieves the CRT parameters stored alongside a private key.
+
+    Args:
+        private_key_str (str): The private key in string format '(d, n)'.
+
+    Returns:
+        tuple[int, int, int, int, int] | None: (p, q, dP, dQ, qInv) if stored, otherwise None.
+    """
+    try:
+        return lookup_private_key(private_key_str).crt
+    except ValueError:
+        return None
+
+class FileRecord(NamedTuple):
+    """
+    One row of the files table.
+
+    Attributes:
+        id (int): ID of the row, also the pagination cursor.
+        file_path (str): Path to the original file.
+        encrypted_path (str): Path to the encrypted file.
+        key_id (int | None): ID of the key used for encryption.
+        mode (str): Encryption mode the file was written with.
+        timestamp (str): When the row was written, as 'YYYY-MM-DD HH:MM:SS' in UTC.
+        storage (str): Backend holding the encrypted container, 'file', 'pack' or 'inline'.
+    """
+    id: int
+    file_path: str
+    encrypted_path: str
+    key_id: int | None
+    mode: str
+    timestamp: str
+    storage: str
+
+def parse_timestamp(value: str) -> str:
+    """
+    Normalizes an ISO 8601 date or date and time to the format stored in files.timestamp.
+
+    Args:
+        value (str): Date such as '2024-05-01' or date and time such as '2024-05-01T12:30'.
+
+    Returns:
+        str: The time as 'YYYY-MM-DD HH:MM:SS'.
+
+    Raises:
+        ValueError: If the value is not an ISO 8601 date.
+    """
+    return datetime.fromisoformat(value).strftime(TIMESTAMP_FORMAT)
+
+def _first_file_at(session: DatabaseSession, user_id: int, timestamp: str) -> int | None:
+    """Return the id of a user's first file written at or after a time, with a single index seek."""
+    row = session.execute("SELECT id FROM files WHERE user_id = ? AND timestamp >= ? ORDER BY timestamp, id LIMIT 1",
+                          (user_id, timestamp)).fetchone()
+    return row[0] if row else None
+
+def _prefix_successor(prefix: str) -> str | None:
+    """
+    Returns the smallest string greater than every string starting with a prefix.
+
+    Trailing U+10FFFF characters have no successor and are dropped, and surrogates, which
+    cannot be stored, are skipped.
+
+    Args:
+        prefix (str): The prefix.
+
+    Returns:
+        str | None: The bound, None when the prefix only holds U+10FFFF and no bound exists.
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+        code = 0xE000
+    return prefix[:-1] + chr(code)
+
+def iter_files(username: str, limit: int | None = None, after: int | None = None,
+               path_prefix: str | None = None, since: str | None = None, until: str | None = None,
+               key_id: int | None = None, sort: str = 'time', descending: bool = False) -> Iterator[FileRecord]:
+    """
+    Iterates over a user's files, one page of the catalog at a time.
+
+    Pagination is by keyset: pass the id of the last record seen as `after` to
+    get the next page, which stays cheap however deep into the catalog it is.
+    Rows are fetched LIST_BATCH at a time, so memory stays constant.
+
+    The time order is the insertion order, i.e. file ids, whose timestamps never
+    decrease; a time range is therefore turned into a range of ids with one index
+    seek per bound. Every listing streams straight from an index, except a path
+    prefix in the time order and a time range in the path order, where SQLite
+    sorts the matching rows first.
+
+    Args:
+        username (str): Username to list files for.
+        limit (int | None): Maximum number of records, all of them when None.
+        after (int | None): ID of the record the listing continues after.
+        path_prefix (str | None): Only files whose original path starts with this.
+        since (str | None): Only files written at or after this time, see parse_timestamp().
+        until (str | None): Only files written before this time, see parse_timestamp().
+        key_id (int | None): Only files encrypted with this key.
+        sort (str): 'time' orders by encryption time, 'path' by original path then id.
+        descending (bool): Whether the order is reversed.
+
+    Returns:
+        Iterator[FileRecord]: Matching records in order.
+
+    Raises:
+        ValueError: If `after` names no file of the user in the path order, or a time is invalid.
+    """
+    session = get_session()
+    user = session.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+    if not user:
+        return
+    conditions = ["user_id = ?"]
+    params: list = [user[0]]
+    if path_prefix:
+        # every string starting with the prefix sorts between the prefix and its successor
+        upper = _prefix_successor(path_prefix)
+        conditions.append("file_path >= ?" if upper is None else "file_path >= ? AND file_path < ?")
+        params += [path_prefix] if upper is None else [path_prefix, upper]
+    if since:
+        first = _first_file_at(session, user[0], parse_timestamp(since))
+        if first is None:
+            return
+        conditions.append("id >= ?")
+        params.append(first)
+    if until:
+        first = _first_file_at(session, user[0], parse_timestamp(until))
+        if first is not None:
+            conditions.append("id < ?")
+            params.append(first)
+    if key_id is not None:
+        conditions.append("key_id = ?")
+        params.append(key_id)
+
+    direction, compare = ('DESC', '<') if descending else ('ASC', '>')
+    if sort == 'path':
+        order = f"file_path {direction}, id {direction}"
+        if after is not None:
+            row = session.execute("SELECT file_path FROM files WHERE id = ? AND user_id = ?",
+                                  (after, user[0])).fetchone()
+            if not row:
+                raise ValueError(f"There is no file with id {after} to continue after!")
+            conditions.append(f"(file_path, id) {compare} (?, ?)")
+            params += [row[0], after]
+    else:
+        order = f"id {direction}"
+        if after is not None:
+            conditions.append(f"id {compare} ?")
+            params.append(after)
+    sql = (f"SELECT id, file_path, encrypted_path, key_id, COALESCE(mode, 'rsa'), timestamp, storage FROM files "
+           f"WHERE {' AND '.join(conditions)} ORDER BY {order}")
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+
+    cursor = session.execute(sql, tuple(params))
+    while rows := cursor.fetchmany(LIST_BATCH):
+        for row in rows:
+            yield FileRecord(*row)
+
+def find_files_by_tokens(username: str, tokens: list[bytes]) -> list[FileRecord]:
+    """
+    Finds a user's files whose plaintext contains every word of a search, with one indexed query.
+
+    Each token is an index range of the file_tokens primary key; only the newest row of
+    each path is returned, older ones describe content the path no longer has.
+
+    Args:
+        username (str): Username of the file owner.
+        tokens (list[bytes]): Distinct blind index tokens of the searched words.
+
+    Returns:
+        list[FileRecord]: Matching files in id order.
+    """
+    if not tokens:
+        return []
+    placeholders = ", ".join("?" * len(tokens))
+    rows = get_session().execute(f'''SELECT f.id, f.file_path, f.encrypted_path, f.key_id, COALESCE(f.mode, 'rsa'), f.timestamp, f.storage
+                                      FROM file_tokens t INNER JOIN files f ON f.id = t.file_id
+                                      WHERE t.token IN ({placeholders})
+                                        AND f.user_id = (SELECT id FROM users WHERE username = ?)
+                                        AND f.id = (SELECT MAX(l.id) FROM files l WHERE l.user_id = f.user_id AND l.file_path = f.file_path)
+                                      GROUP BY f.id HAVING COUNT(*) = ? ORDER BY f.id''',
+                                 tuple(tokens) + (username, len(tokens))).fetchall()
+    return [FileRecord(*row) for row in rows]
+
+def print_records(records: Iterable[FileRecord], output_format: str) -> None:
+    """
+    Prints file records as one JSON object per line, or as a header line followed by tab-separated rows.
+
+    Args:
+        records (Iterable[FileRecord]): The records.
+        output_format (str): 'json' or 'tsv'.
+
+    Returns:
+        None
+    """
+    if output_format == 'json':
+        for record in records:
+            print(json.dumps(record._asdict()))
+        return
+    print("\t".join(FileRecord._fields))
+    for record in records:
+        print("\t".join(_tsv_field("" if value is None else value) for value in record))
+
+def _tsv_field(value) -> str:
+    """Escape a value for a tab-separated line."""
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+def list_files(username: str, output_format: str = 'text', limit: int | None = None, **filters) -> None:
+    """
+    Prints a user's encrypted files as they are read from the database.
+
+    The 'text' format prints the encrypted file names and times and, when a limit
+    cut the listing short, the --after value continuing it. 'json' prints one JSON
+    object per line and 'tsv' a header line followed by tab-separated rows; both
+    include the id to continue after.
+
+    Args:
+        username (str): Username to list files for.
+        output_format (str): 'text', 'json' or 'tsv'.
+        limit (int | None): Maximum number of files, all of them when None.
+        **filters: Pagination, filter and order arguments of iter_files().
+
+    Returns:
+        None
+    """
+    try:
+        if output_format != 'text':
+            print_records(iter_files(username, limit, **filters), output_format)
+            return
+
+        # one extra record tells whether there is a next page
+        last = None
+        for count, record in enumerate(iter_files(username, None if limit is None else limit + 1, **filters)):
+            if count == limit:
+                print(f"More files follow, continue with --after {last.id}")
+                break
+            if last is None:
+                print("Encrypted files:")
+            print(f"{os.path.basename(record.encrypted_path)} | {record.timestamp}")
+            last = record
+        if last is None:
+            print("There are no encrypted files!")
+    except ValueError as error:
+        print(error)
+
+def list_all_files(username: str) -> None:
+    """
+    Lists all encrypted files associated with a user.
+
+    Args:
+        username (str): Username to list files for.
+
+    Returns:
+        None
+    """
+    list_files(username)
+
+
+def get_encrypted_file(username: str, file_path: str) -> str | None:
+    """
+    Retrieves the encrypted file path for a given user and file.
+
+    Args:
+        username (str): Username of the file owner.
+        file_path (str): Path to the original file.
+
+    Returns:
+        str | None: Path to the encrypted file if found, otherwise None.
+    """
+    result = get_session().execute("SELECT encrypted_path FROM files INNER JOIN users ON files.user_id = users.id WHERE users.username = ? AND files.file_path = ?", (username, file_path)).fetchone()
+    return result[0] if result else None
+
+def get_encryption_mode(username: str, file_path: str) -> str | None:
+    """
+    Retrieves the encryption mode a file was written with.
+
+    Args:
+        username (str): Username of the file owner.
+        file_path (str): Path to the original file.
+
+    Returns:
+        str | None: 'rsa' or 'envelope' if the file is known, otherwise None.
+    """
+    result = get_session().execute("SELECT mode FROM files INNER JOIN users ON files.user_id = users.id WHERE users.username = ? AND files.file_path = ?", (username, file_path)).fetchone()
+    return (result[0] or 'rsa') if result else None
+
+def delete_file_from_db(username: str, file_path: str) -> list[ContainerLocation]:
+    """
+    Deletes every record of a file from the database for a specific user.
+
+    Args:
+        username (str): Username of the file owner.
+        file_path (str): Path to the original file.
+
+    Returns:
+        list[ContainerLocation]: Containers of the deleted rows, once each, newest first; they may
+        no longer be used by any row.
+    """
+    session = get_session()
+    with session.transaction():
+        rows = session.execute(f"""SELECT {LOCATION_COLUMNS} FROM files f
+                                   WHERE f.user_id = (SELECT id FROM users WHERE username = ?) AND f.file_path = ?
+                                   ORDER BY f.id DESC""", (username, file_path)).fetchall()
+        session.execute("DELETE FROM file_tokens WHERE file_id IN (SELECT id FROM files WHERE user_id = (SELECT id FROM users WHERE username = ?) AND file_path = ?)",
+                        (username, file_path))
+        session.execute("DELETE FROM files WHERE user_id = (SELECT id FROM users WHERE username = ?) AND file_path = ?", (username, file_path))
+    return list(dict.fromkeys(ContainerLocation(*row) for row in rows))
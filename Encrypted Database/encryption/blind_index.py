@@ -0,0 +1,185 @@
+"""
+Blind Index Module
+
+This module builds a keyed index of the words in the plaintexts, so the files containing a
+term are found with one indexed lookup instead of decrypting every file. The database only
+holds tokens: truncated HMAC-SHA256 values of the words under an index key derived from a
+passphrase the user supplies. Without the passphrase the tokens cannot be tested against
+guessed words; what they do reveal is which files share a word and how many distinct words
+a file has.
+
+Words are runs of Unicode letters, digits and underscores, compared case-insensitively. They
+are collected while the plaintext streams through encryption, so indexing adds no reads,
+only the cost of splitting the plaintext into words.
+
+"""
+
+import hashlib
+import hmac
+import re
+from itertools import islice
+from typing import BinaryIO, Iterable
+
+# Derivation of the index key from the passphrase; slow on purpose, it runs once per command
+INDEX_KEY_ITERATIONS = 100_000
+INDEX_KEY_SALT = b'encrypted-database blind index '
+# Bytes kept of each HMAC-SHA256; collisions between 128-bit tokens are negligible
+TOKEN_SIZE = 16
+
+# Shorter words are too common to be worth indexing, longer ones are rarely words
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+# Distinct words indexed per file at most, bounding memory on large or binary files
+MAX_FILE_TERMS = 100_000
+# Leading bytes searched for a NUL byte, which marks a file as binary and leaves it out of the index
+BINARY_SNIFF_SIZE = 8000
+
+_WORD = re.compile(r'\w+')
+# Maps the bytes that may belong to a word to themselves, ASCII letters lowered, and the others to a space
+_RUN_BYTES = bytes(byte if byte >= 0x80 or chr(byte).isalnum() or byte == 0x5f else 0x20
+                   for byte in bytes(range(256)).lower())
+# Longest run of bytes kept across pieces: a word of MAX_TERM_LENGTH characters of up to 4 UTF-8 bytes each
+MAX_RUN_LENGTH = 4 * MAX_TERM_LENGTH
+
+def derive_index_key(username: str, passphrase: str) -> bytes:
+    """
+    Derive a user's index key from their passphrase.
+
+    The username salts the derivation, so users sharing a passphrase still get different tokens.
+
+    Args:
+        username (str): Username of the file owner.
+        passphrase (str): Passphrase given with --index-key.
+
+    Returns:
+        bytes: The 32-byte index key.
+    """
+    return hashlib.pbkdf2_hmac('sha256', passphrase.encode('utf-8'), INDEX_KEY_SALT + username.encode('utf-8'),
+                               INDEX_KEY_ITERATIONS)
+
+def _terms(words: list[str]) -> set[str]:
+    """Keep the distinct words that are indexed, as they are compared."""
+    return {word for word in set(words) if MIN_TERM_LENGTH <= len(word) <= MAX_TERM_LENGTH}
+
+def split_terms(text: str) -> set[str]:
+    """
+    Split a search query into the terms it is looked up by.
+
+    Args:
+        text (str): The query.
+
+    Returns:
+        set[str]: Its indexed words, case-folded.
+    """
+    return _terms(_WORD.findall(text.casefold()))
+
+def make_tokens(index_key: bytes, terms: Iterable[str]) -> list[bytes]:
+    """
+    Turn terms into the tokens stored in the index.
+
+    Args:
+        index_key (bytes): Key from derive_index_key().
+        terms (Iterable[str]): Case-folded terms.
+
+    Returns:
+        list[bytes]: The TOKEN_SIZE-byte token of each term, in order.
+    """
+    return [hmac.digest(index_key, term.encode('utf-8'), 'sha256')[:TOKEN_SIZE] for term in terms]
+
+class TermCollector:
+    """
+    Collects the distinct words of a plaintext fed to it piece by piece, like a hash.
+
+    Pieces are split into runs of ASCII letters, digits, underscores and non-ASCII bytes
+    with C-level bytes operations, and only the distinct runs are decoded as UTF-8 and
+    split into words at the end. A run cut by the end of a piece is completed by the next one.
+    Binary data yields no words, and collection stops once MAX_FILE_TERMS runs were seen,
+    keeping the first ones in file order.
+    """
+
+    def __init__(self) -> None:
+        """
+        Starts with no words.
+
+        Returns:
+            None
+        """
+        self.binary = False
+        self.truncated = False
+        self._started = False
+        # distinct runs in file order, a dict used as an ordered set
+        self._runs: dict[bytes, None] = {}
+        self._tail = b''
+        self._overlong = False
+
+    def update(self, data) -> None:
+        """
+        Add the words of the next piece of the plaintext.
+
+        Args:
+            data: Bytes-like piece of the plaintext.
+
+        Returns:
+            None
+        """
+        data = bytes(data)
+        if not self._started:
+            self._started = True
+            # like most tools, take a NUL byte near the start for binary data, whose "words" are noise
+            self.binary = b'\x00' in data[:BINARY_SNIFF_SIZE]
+        if not (self.binary or self.truncated):
+            self._add(data.translate(_RUN_BYTES))
+
+    def finish(self) -> set[str]:
+        """
+        Add the last word once the whole plaintext was fed.
+
+        Returns:
+            set[str]: The distinct terms, case-folded, empty for binary data.
+        """
+        if not (self.binary or self.truncated):
+            self._add(b' ')
+        terms = set()
+        for run in self._runs:
+            terms |= _terms([run.decode('ascii')] if run.isascii()
+                            else _WORD.findall(run.decode('utf-8', errors='replace').casefold()))
+        return terms
+
+    def _add(self, text: bytes) -> None:
+        """Add the runs of a translated piece, holding back one that may continue in the next piece."""
+        if self._overlong:
+            # the rest of a run already too long to hold a word
+            end = text.find(b' ')
+            if end < 0:
+                return
+            text = text[end:]
+            self._overlong = False
+        text = self._tail + text
+        runs = text.split()
+        self._tail = b''
+        if runs and text[-1] != 0x20:
+            self._tail = runs.pop()
+            if len(self._tail) > MAX_RUN_LENGTH:
+                self._tail = b''
+                self._overlong = True
+        self._runs.update(dict.fromkeys(runs))
+        if len(self._runs) >= MAX_FILE_TERMS:
+            # keep the first runs of the file, so the indexed words do not depend on hash order
+            self.truncated = True
+            self._runs = dict.fromkeys(islice(self._runs, MAX_FILE_TERMS))
+
+def file_terms(f_in: BinaryIO, buffer_size: int) -> TermCollector:
+    """
+    Collect the words of a file that is not being encrypted, such as one reusing an encrypted copy.
+
+    Args:
+        f_in (BinaryIO): Plaintext opened for binary reading.
+        buffer_size (int): Bytes per read call.
+
+    Returns:
+        TermCollector: The collector, to be finished by the caller.
+    """
+    terms = TermCollector()
+    while data := f_in.read(buffer_size):
+        terms.update(data)
+    return terms
@@ -0,0 +1,318 @@
+"""
+Codebook Module
+
+This module keeps per-key lookup tables for keys with a small modulus. When the modulus
+is at most the codebook limit (--codebook-max-modulus, CODEBOOK_MAX_MODULUS by default),
+every possible block value fits in a compact array, so each modular exponentiation only
+has to be computed once per key: later occurrences of the same block are a table lookup.
+Tables are split into pages of PAGE_ENTRIES entries, which are allocated, read from the
+table file under CODEBOOK_DIR and written back only when a block falls in them, so a small
+read touches a few pages rather than the whole table. A table is saved when the process
+exits, and only if new entries were computed. Worker processes (--workers) leave without
+running atexit handlers, so init_worker() has them save the pages they changed to a part
+file of their own, which is merged into the table the next time it is loaded.
+
+The decryption table maps ciphertext blocks back to plaintext, so it is as sensitive as
+the private key stored in the database: table files are only readable by their owner.
+
+"""
+
+import atexit
+import glob
+import os
+import tempfile
+from array import array
+from typing import BinaryIO, Callable
+from encryption.defaults import CODEBOOK_MAX_MODULUS
+
+CODEBOOK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'codebooks')
+
+# Table entries are unsigned 32-bit integers
+ENTRY_TYPE = 'I'
+ENTRY_SIZE = array(ENTRY_TYPE).itemsize
+
+# Entries per page, 16 KiB of table
+PAGE_SHIFT = 12
+PAGE_ENTRIES = 1 << PAGE_SHIFT
+PAGE_SIZE = PAGE_ENTRIES * ENTRY_SIZE
+
+# Table files start with the exponent and the modulus, as two unsigned 64-bit integers
+PARAMS_SIZE = 16
+
+# Largest modulus served from a table in this process, see set_max_modulus()
+_max_modulus = CODEBOOK_MAX_MODULUS
+
+class Codebook:
+    """
+    A lazily filled table of a modular exponentiation over every block value below size.
+
+    Unfilled entries hold 0. Since the modulus is a product of two primes, only block 0
+    maps to 0, so a 0 entry is simply recomputed. The table file holds the entries at
+    fixed offsets; the pages past its end, or in its holes, are unfilled.
+    """
+
+    def __init__(self, path: str | None, exponent: int, n: int, size: int) -> None:
+        """
+        Starts an empty table, merging in the part files of worker processes, if any exist.
+
+        Args:
+            path (str | None): File the table is saved to, None to keep it in memory only.
+            exponent (int): Exponent of the tabulated operation.
+            n (int): Modulus.
+            size (int): Number of block values covered by the table.
+
+        Returns:
+            None
+        """
+        self.path = path
+        self.exponent = exponent
+        self.n = n
+        self.size = size
+        self.pages: dict[int, array] = {}
+        # indexes of the pages holding entries the table file lacks
+        self.dirty: set[int] = set()
+        if path:
+            self._merge_parts()
+
+    def _open(self, path: str) -> BinaryIO | None:
+        """Open a table file positioned after its parameters, if it holds a table of this exponent and modulus."""
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+        params = array('Q')
+        try:
+            params.fromfile(f, 2)
+        except (OSError, EOFError):
+            params = None
+        if params is None or list(params) != [self.exponent, self.n]:
+            f.close()
+            return None
+        return f
+
+    def _read_page(self, f: BinaryIO | None, index: int) -> array:
+        """Read one page of a table file, unfilled past its end."""
+        data = b''
+        if f is not None:
+            f.seek(PARAMS_SIZE + index * PAGE_SIZE)
+            data = f.read(PAGE_SIZE)
+        return array(ENTRY_TYPE, data.ljust(PAGE_SIZE, b'\x00'))
+
+    def _page(self, index: int) -> array:
+        """Return a page of the table, reading it from the table file on first use."""
+        page = self.pages.get(index)
+        if page is None:
+            f = self._open(self.path) if self.path else None
+            try:
+                page = self.pages[index] = self._read_page(f, index)
+            finally:
+                if f is not None:
+                    f.close()
+        return page
+
+    def _merge_parts(self) -> None:
+        """Merge the part files of worker processes into the pages they changed, and remove them."""
+        for part_path in glob.glob(f"{glob.escape(self.path)}.*.part"):
+            f = self._open(part_path)
+            if f is not None:
+                with f:
+                    # a part file holds (page index, page) records
+                    while len(record := f.read(8 + PAGE_SIZE)) == 8 + PAGE_SIZE:
+                        index = int.from_bytes(record[:8], 'little')
+                        self.pages[index] = _merge_page(self._page(index), record[8:])
+                        # saved again with the table when the process exits
+                        self.dirty.add(index)
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+
+    def operation(self) -> Callable[[int], int]:
+        """
+        Build the block function backed by this table.
+
+        Args:
+            None
+
+        Returns:
+            Callable[[int], int]: Function returning pow(block, exponent, n).
+        """
+        pages, dirty, exponent, n = self.pages, self.dirty, self.exponent, self.n
+        mask = PAGE_ENTRIES - 1
+
+        def lookup(block: int) -> int:
+            """Return the tabulated result, computing and storing it on first use."""
+            page = pages.get(block >> PAGE_SHIFT)
+            if page is None:
+                page = self._page(block >> PAGE_SHIFT)
+            value = page[block & mask]
+            if not value and block:
+                value = page[block & mask] = pow(block, exponent, n)
+                dirty.add(block >> PAGE_SHIFT)
+            return value
+
+        return lookup
+
+    def save(self, part: bool = False) -> None:
+        """
+        Write the pages with new entries to the table file, if there are any.
+
+        The table file is rewritten a page at a time, merging the changed pages with the
+        entries other processes saved meanwhile; unfilled pages are left as holes and the
+        file ends with its last filled page. It is created readable by its owner only and
+        replaced atomically, so concurrent writers never leave a torn table.
+
+        Args:
+            part (bool): Write the changed pages to a part file of this process instead, merged
+                on the next load.
+
+        Returns:
+            None
+        """
+        if not self.path or not self.dirty:
+            return
+        path = f"{self.path}.{os.getpid()}.part" if part else self.path
+        temp_path = None
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            # mkstemp creates the file with mode 0o600
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                array('Q', [self.exponent, self.n]).tofile(f)
+                if part:
+                    for index in sorted(self.dirty):
+                        f.write(index.to_bytes(8, 'little') + self.pages[index].tobytes())
+                else:
+                    self._write_table(f)
+            os.replace(temp_path, path)
+            self.dirty.clear()
+        except OSError as error:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+            print(f"Could not save codebook '{path}': {error}")
+
+    def _write_table(self, f_out: BinaryIO) -> None:
+        """Write the saved table merged with the changed pages, one page at a time."""
+        f_in = self._open(self.path)
+        try:
+            end = PARAMS_SIZE
+            for index in range((self.size + PAGE_ENTRIES - 1) // PAGE_ENTRIES):
+                data = self._read_page(f_in, index).tobytes() if f_in is not None else bytes(PAGE_SIZE)
+                if index in self.dirty:
+                    data = _merge_page(self.pages[index], data).tobytes()
+                if data.count(0) != PAGE_SIZE:
+                    f_out.seek(PARAMS_SIZE + index * PAGE_SIZE)
+                    f_out.write(data)
+                    end = f_out.tell()
+            f_out.truncate(end)
+        finally:
+            if f_in is not None:
+                f_in.close()
+
+def _merge_page(page: array, data: bytes) -> array:
+    """
+    Merge two copies of a page.
+
+    Filled entries of both copies hold the same value and unfilled ones 0, so OR merges them.
+
+    Args:
+        page (array): Page of a table.
+        data (bytes): Another copy of the page.
+
+    Returns:
+        array: The merged page.
+    """
+    merged = int.from_bytes(page.tobytes(), 'little') | int.from_bytes(data, 'little')
+    return array(ENTRY_TYPE, merged.to_bytes(PAGE_SIZE, 'little'))
+
+_codebooks: dict[tuple[str, int, int], Codebook] = {}
+
+def codebook_eligible(n: int) -> bool:
+    """
+    Check whether blocks of a modulus are served from a codebook.
+
+    Args:
+        n (int): Modulus.
+
+    Returns:
+        bool: True if the modulus is small enough for a table.
+    """
+    return 0 < n <= _max_modulus
+
+def set_max_modulus(limit: int) -> None:
+    """
+    Set the largest modulus served from a codebook in this process.
+
+    Args:
+        limit (int): Largest modulus, 0 to always compute blocks directly.
+
+    Returns:
+        None
+    """
+    global _max_modulus
+    _max_modulus = limit
+
+def get_max_modulus() -> int:
+    """
+    Get the largest modulus served from a codebook in this process.
+
+    Args:
+        None
+
+    Returns:
+        int: The limit set with set_max_modulus(), CODEBOOK_MAX_MODULUS by default.
+    """
+    return _max_modulus
+
+def get_codebook(kind: str, exponent: int, n: int, key_id: int = 0) -> Codebook:
+    """
+    Get the codebook of one direction of a key, loading or creating it on first use.
+
+    Args:
+        kind (str): 'enc' for the public operation, 'dec' for the private one.
+        exponent (int): Public or private exponent.
+        n (int): Modulus.
+        key_id (int): ID of the key, 0 to keep the table in memory only.
+
+    Returns:
+        Codebook: The table of the operation.
+    """
+    cache_key = (kind, exponent, n)
+    if cache_key not in _codebooks:
+        # plaintext blocks are below 2**(bits - 1), ciphertext blocks below n
+        size = 1 << (n.bit_length() - 1) if kind == 'enc' else n
+        path = os.path.join(CODEBOOK_DIR, f"{key_id}-{kind}.bin") if key_id else None
+        _codebooks[cache_key] = Codebook(path, exponent, n, size)
+    return _codebooks[cache_key]
+
+def save_codebooks(part: bool = False) -> None:
+    """
+    Save every codebook that gained entries in this process.
+
+    Args:
+        part (bool): Write part files of this process, as worker processes do.
+
+    Returns:
+        None
+    """
+    for codebook in _codebooks.values():
+        codebook.save(part)
+
+def init_worker(max_modulus: int = CODEBOOK_MAX_MODULUS) -> None:
+    """
+    Prepare a worker process of a ProcessPoolExecutor to save the codebook entries it computes.
+
+    Workers end with os._exit(), which skips atexit handlers, but multiprocessing runs its
+    own finalizers before that.
+
+    Args:
+        max_modulus (int): Codebook limit of the parent process, see get_max_modulus().
+
+    Returns:
+        None
+    """
+    from multiprocessing import util
+    set_max_modulus(max_modulus)
+    util.Finalize(None, save_codebooks, kwargs={'part': True}, exitpriority=0)
+
+atexit.register(save_codebooks)
@@ -0,0 +1,274 @@
+"""
+Encrypted Container Format Module
+
+This module defines the versioned on-disk layout of encrypted files: a fixed-size header
+describing the key and block geometry, the encrypted chunks, and a chunk index that lets
+readers seek straight to the chunks covering a byte range. From version 2 on, the index
+is followed by the SHA-256 digest of every encrypted chunk, so the checksum of a container
+is computed from its metadata and a patched container's checksum needs no full read. From
+version 3 on, 'envelope' containers carry HMAC tags over their header and every chunk.
+
+"""
+
+import hashlib
+import struct
+from typing import BinaryIO, Iterable, NamedTuple
+from encryption.defaults import LAYOUT_FIXED, LAYOUT_PACKED, LAYOUT_CODES
+
+MAGIC = b'EDBC'
+VERSION = 3
+# First version whose chunk index is followed by the digest table
+DIGEST_TABLE_VERSION = 2
+# First version whose 'envelope' containers are authenticated, see encryption.rsa
+AUTHENTICATED_ENVELOPE_VERSION = 3
+# Bytes per digest table entry, the SHA-256 of one encrypted chunk
+CHUNK_CHECKSUM_SIZE = 32
+
+# Header: magic, version, mode, layout, flags, key id, plaintext length, plaintext block size,
+# ciphertext block size, chunk size, chunk count, index offset, extra header length
+HEADER_FORMAT = '>4sBBBBQQIIIIQI'
+HEADER_SIZE = 64
+INDEX_ENTRY = struct.Struct('>Q')
+
+MODE_CODES = {'rsa': 0, 'envelope': 1}
+MODE_NAMES = {code: name for name, code in MODE_CODES.items()}
+
+# Set while a file is being patched in place; such a file is only readable again once the patch completes
+FLAG_INCOMPLETE = 1
+
+# Blocks per packed group: 8 blocks of any bit width always fill a whole number of bytes
+PACKED_GROUP = 8
+
+# Plaintext bytes per chunk: small enough that a range read decrypts little more than it needs
+CHUNK_SIZE = 1 << 16
+
+class ContainerHeader(NamedTuple):
+    """
+    Geometry and metadata stored at the start of every container file.
+
+    Attributes:
+        mode (str): Encryption mode, 'rsa' or 'envelope'.
+        layout (int): How ciphertext blocks are laid out inside a chunk.
+        key_id (int): ID of the key used for encryption, 0 if unknown.
+        plaintext_length (int): Exact length of the original file in bytes.
+        plain_block (int): Plaintext bytes per RSA block, or per group of blocks in the packed layout.
+        cipher_block (int): Ciphertext bytes per RSA block, or per group of blocks in the packed layout.
+        chunk_size (int): Plaintext bytes per chunk, a multiple of plain_block.
+        chunk_count (int): Number of chunks in the file.
+        index_offset (int): Absolute offset of the chunk index.
+        extra_length (int): Length of the mode-specific data following the header.
+        flags (int): FLAG_ bits describing the state of the file.
+        version (int): Format version the file was written with.
+    """
+    mode: str
+    layout: int
+    key_id: int
+    plaintext_length: int
+    plain_block: int
+    cipher_block: int
+    chunk_size: int
+    chunk_count: int
+    index_offset: int
+    extra_length: int
+    flags: int = 0
+    version: int = VERSION
+
+def pack_header(header: ContainerHeader) -> bytes:
+    """
+    Serialize a container header to its fixed-size binary form.
+
+    Args:
+        header (ContainerHeader): Header to serialize.
+
+    Returns:
+        bytes: HEADER_SIZE bytes.
+    """
+    packed = struct.pack(HEADER_FORMAT, MAGIC, header.version, MODE_CODES[header.mode], header.layout, header.flags,
+                         header.key_id, header.plaintext_length, header.plain_block, header.cipher_block,
+                         header.chunk_size, header.chunk_count, header.index_offset, header.extra_length)
+    return packed.ljust(HEADER_SIZE, b'\x00')
+
+def read_header(f: BinaryIO) -> ContainerHeader | None:
+    """
+    Read the container header at the start of a file.
+
+    Args:
+        f (BinaryIO): File opened for binary reading, positioned at its start.
+
+    Returns:
+        ContainerHeader | None: The header, or None for a legacy headerless file, in which
+        case the file position is left at its start.
+    """
+    data = f.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE or data[:4] != MAGIC:
+        f.seek(0)
+        return None
+    fields = struct.unpack_from(HEADER_FORMAT, data)
+    if fields[1] > VERSION:
+        raise ValueError(f"Unsupported container version {fields[1]}")
+    return ContainerHeader(MODE_NAMES[fields[2]], fields[3], *fields[5:], fields[4], fields[1])
+
+def write_index(f: BinaryIO, offsets: Iterable[int], digests: bytes = b'') -> bytes:
+    """
+    Append the chunk index and the digest table at the current file position.
+
+    Args:
+        f (BinaryIO): File opened for binary writing.
+        offsets (Iterable[int]): Absolute offset of each chunk.
+        digests (bytes): chunk_checksum() of each chunk, in order, empty before version 2.
+
+    Returns:
+        bytes: The index and digest table as written.
+    """
+    trailer = b''.join(INDEX_ENTRY.pack(offset) for offset in offsets) + digests
+    f.write(trailer)
+    return trailer
+
+def chunk_checksum(chunk) -> bytes:
+    """
+    Compute the digest table entry of an encrypted chunk.
+
+    Args:
+        chunk: Bytes-like encrypted chunk.
+
+    Returns:
+        bytes: Its CHUNK_CHECKSUM_SIZE-byte SHA-256.
+    """
+    return hashlib.sha256(chunk).digest()
+
+def metadata_checksum(extra: bytes, trailer: bytes, header: bytes) -> bytes:
+    """
+    Compute the checksum of a version 2 container from its metadata.
+
+    The digest table covers the chunks, so hashing the mode-specific data, the index with
+    the table and the final header covers the whole container.
+
+    Args:
+        extra (bytes): Mode-specific data following the header.
+        trailer (bytes): Chunk index and digest table, as returned by write_index().
+        header (bytes): The packed final header.
+
+    Returns:
+        bytes: The SHA-256 recorded for the container.
+    """
+    return hashlib.sha256(extra + trailer + header).digest()
+
+def container_checksum(f: BinaryIO, buffer_size: int = 1 << 20) -> tuple[bytes, int]:
+    """
+    Compute the checksum of a container, reading it sequentially from its start.
+
+    A version 2 container is checked chunk by chunk against its digest table, then
+    summarized by metadata_checksum(); a chunk that does not match its digest yields
+    a different checksum. Older containers are hashed whole: the bytes following the
+    header, then the header, which is only final once everything after it is written.
+
+    Args:
+        f (BinaryIO): Container opened for binary reading, positioned at its start.
+        buffer_size (int): Bytes per read call.
+
+    Returns:
+        tuple[bytes, int]: SHA-256 of the container and its size in bytes.
+    """
+    header_bytes = f.read(HEADER_SIZE)
+    f.seek(0)
+    header = read_header(f)
+    if header is not None and header.version >= DIGEST_TABLE_VERSION:
+        return _digest_table_checksum(f, header, header_bytes, buffer_size)
+
+    checksum = hashlib.sha256()
+    f.seek(len(header_bytes))
+    size = len(header_bytes)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while count := f.readinto(buffer):
+        checksum.update(view[:count])
+        size += count
+    checksum.update(header_bytes)
+    return checksum.digest(), size
+
+def _digest_table_checksum(f: BinaryIO, header: ContainerHeader, header_bytes: bytes,
+                           buffer_size: int) -> tuple[bytes, int]:
+    """Check the chunks of a version 2 container against its digest table and compute its checksum."""
+    extra = f.read(header.extra_length)
+    f.seek(header.index_offset)
+    trailer = f.read(header.chunk_count * (INDEX_ENTRY.size + CHUNK_CHECKSUM_SIZE))
+    size = f.seek(0, 2)
+    intact = len(trailer) == header.chunk_count * (INDEX_ENTRY.size + CHUNK_CHECKSUM_SIZE)
+    if intact and header.chunk_count:
+        index_size = header.chunk_count * INDEX_ENTRY.size
+        offsets = [INDEX_ENTRY.unpack_from(trailer, i * INDEX_ENTRY.size)[0] for i in range(header.chunk_count)]
+        ends = offsets[1:] + [header.index_offset]
+        position = HEADER_SIZE + header.extra_length
+        intact = offsets[0] == position and all(start <= end for start, end in zip(offsets, ends))
+        f.seek(position)
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        i, digest = 0, hashlib.sha256()
+        # chunks are contiguous, so each read is split at the chunk ends and fed to one digest per chunk
+        while intact and i < header.chunk_count:
+            count = f.readinto(view[:min(buffer_size, header.index_offset - position)]) if position < header.index_offset else 0
+            piece = view[:count]
+            while True:
+                take = min(len(piece), ends[i] - position)
+                digest.update(piece[:take])
+                position += take
+                piece = piece[take:]
+                if position < ends[i]:
+                    break
+                entry = index_size + i * CHUNK_CHECKSUM_SIZE
+                intact = digest.digest() == trailer[entry:entry + CHUNK_CHECKSUM_SIZE]
+                i, digest = i + 1, hashlib.sha256()
+                if not intact or i == header.chunk_count:
+                    break
+            if not count and i < header.chunk_count:
+                intact = False
+    checksum = metadata_checksum(extra, trailer, header_bytes)
+    if not intact:
+        # no recorded checksum can match a container whose chunks disagree with their digests
+        checksum = hashlib.sha256(b'damaged' + checksum).digest()
+    return checksum, size
+
+def read_chunk_offsets(f: BinaryIO, header: ContainerHeader, first: int, last: int) -> list[int]:
+    """
+    Read the slice of the chunk index needed to locate chunks first..last.
+
+    Args:
+        f (BinaryIO): File opened for binary reading.
+        header (ContainerHeader): Header of the file.
+        first (int): Index of the first chunk.
+        last (int): Index of the last chunk, inclusive.
+
+    Returns:
+        list[int]: Offsets of chunks first..last followed by the end offset of chunk last.
+    """
+    f.seek(header.index_offset + first * INDEX_ENTRY.size)
+    count = last - first + 1
+    data = f.read(count * INDEX_ENTRY.size)
+    offsets = [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)[0] for i in range(count)]
+    if last + 1 < header.chunk_count:
+        offsets.append(INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))[0])
+    else:
+        offsets.append(header.index_offset)
+    return offsets
+
+def chunk_range(header: ContainerHeader, offset: int, length: int | None) -> tuple[int, int] | None:
+    """
+    Find the chunks covering a plaintext byte range.
+
+    Args:
+        header (ContainerHeader): Header of the file.
+        offset (int): First plaintext byte wanted.
+        length (int | None): Number of bytes wanted, up to the end of the file when None.
+
+    Returns:
+        tuple[int, int] | None: Indexes of the first and last chunk, or None if the range is empty.
+
+    Raises:
+        ValueError: If the offset or the length is negative.
+    """
+    if offset < 0 or (length is not None and length < 0):
+        raise ValueError(f"The range must not be negative, got offset {offset} and length {length}")
+    end = header.plaintext_length if length is None else min(header.plaintext_length, offset + length)
+    if offset >= end:
+        return None
+    return offset // header.chunk_size, (end - 1) // header.chunk_size
@@ -0,0 +1,31 @@
+"""
+Encryption Defaults Module
+
+This module holds the encryption modes and the default values of the encryption options.
+They live apart from encryption.rsa so the command-line parser can show them without
+importing the encryption code, which only the commands that encrypt or decrypt need.
+
+"""
+
+DEFAULT_KEY_BITS = 2048
+# Bytes read or written per I/O call
+IO_BUFFER_SIZE = 1 << 20
+# Segments (or files per worker) held in memory with --workers
+DEFAULT_MAX_INFLIGHT = 4
+# File records committed per transaction
+DEFAULT_BATCH_SIZE = 1000
+
+# Largest modulus whose blocks are served from a codebook (4 bytes per entry, so up to
+# 32 MiB for a decryption table at this limit), see encryption.codebook
+CODEBOOK_MAX_MODULUS = 1 << 23
+
+MODE_RSA = 'rsa'
+MODE_ENVELOPE = 'envelope'
+ENCRYPTION_MODES = (MODE_RSA, MODE_ENVELOPE)
+
+# Fixed: every RSA block padded to whole bytes. Packed: groups of 8 blocks stored at their exact bit width.
+LAYOUT_FIXED = 0
+LAYOUT_PACKED = 1
+LAYOUT_CODES = {'fixed': LAYOUT_FIXED, 'packed': LAYOUT_PACKED}
+# Smallest modulus 'envelope' mode wraps its session key with; the key is wrapped with unpadded RSA
+MIN_ENVELOPE_KEY_BITS = 1024
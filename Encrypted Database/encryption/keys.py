@@ -0,0 +1,130 @@
+"""
+RSA Key Module
+
+This module turns the key strings accepted on the command line into integers, derives the
+fingerprint that identifies a key in the database, and converts key components to and
+from the binary form they are stored in. Parsed keys carry their block sizes, so callers
+do not recompute them from the modulus.
+
+"""
+
+import hashlib
+from functools import lru_cache
+from typing import NamedTuple
+
+# Bytes of the SHA-256 digest kept as the key fingerprint
+FINGERPRINT_SIZE = 16
+
+class RSAKey(NamedTuple):
+    """
+    A parsed RSA key, public or private, with the block geometry of its modulus.
+
+    Attributes:
+        key_id (int | None): ID of the key in the database, None if it is not stored there.
+        e (int | None): Public exponent, None for a private key that is not stored.
+        n (int): Modulus.
+        d (int | None): Private exponent, None for a public key that is not stored.
+        crt (tuple[int, int, int, int, int] | None): CRT parameters (p, q, dP, dQ, qInv), if known.
+        fingerprint (bytes | None): Fingerprint of (e, n), None when e is unknown.
+        bits (int): Bit length of the modulus.
+        plain_size (int): Plaintext bytes per RSA block.
+        cipher_size (int): Ciphertext bytes per RSA block.
+    """
+    key_id: int | None
+    e: int | None
+    n: int
+    d: int | None
+    crt: tuple[int, int, int, int, int] | None
+    fingerprint: bytes | None
+    bits: int
+    plain_size: int
+    cipher_size: int
+
+    @property
+    def public_key_str(self) -> str:
+        """The public key in the '(e, n)' form printed by generate-keys."""
+        return f"({self.e}, {self.n})"
+
+def make_key(n: int, e: int | None = None, d: int | None = None,
+             crt: tuple[int, int, int, int, int] | None = None, key_id: int | None = None) -> RSAKey:
+    """
+    Build an RSAKey, computing its fingerprint and block sizes.
+
+    Args:
+        n (int): Modulus.
+        e (int | None): Public exponent, if known.
+        d (int | None): Private exponent, if known.
+        crt (tuple[int, int, int, int, int] | None): CRT parameters (p, q, dP, dQ, qInv), if known.
+        key_id (int | None): ID of the key in the database, if stored.
+
+    Returns:
+        RSAKey: The key.
+    """
+    fingerprint = key_fingerprint(e, n) if e is not None else None
+    bits = n.bit_length()
+    return RSAKey(key_id, e, n, d, crt, fingerprint, bits, (bits - 1) // 8, (bits + 7) // 8)
+
+@lru_cache(maxsize=256)
+def parse_key(key_str: str) -> tuple[int, int]:
+    """
+    Parse a key given as '(x, n)', ignoring whitespace and the parentheses.
+
+    Args:
+        key_str (str): Public key '(e, n)' or private key '(d, n)'.
+
+    Returns:
+        tuple[int, int]: The exponent and the modulus.
+
+    Raises:
+        ValueError: If the string is not two comma-separated positive integers.
+    """
+    parts = key_str.strip().strip("()").split(",")
+    if len(parts) != 2:
+        raise ValueError(f"Invalid key '{key_str}', expected '(exponent, modulus)'")
+    exponent, n = (int(part) for part in parts)
+    if exponent <= 0 or n <= 1:
+        raise ValueError(f"Invalid key '{key_str}', expected '(exponent, modulus)'")
+    return exponent, n
+
+def int_to_blob(value: int | None) -> bytes | None:
+    """
+    Encode a non-negative integer as minimal big-endian bytes for a BLOB column.
+
+    Args:
+        value (int | None): Integer to encode.
+
+    Returns:
+        bytes | None: Its encoding, None for None.
+    """
+    if value is None:
+        return None
+    return value.to_bytes(max(1, (value.bit_length() + 7) // 8), byteorder='big')
+
+def blob_to_int(blob: bytes | None) -> int | None:
+    """
+    Decode an integer written by int_to_blob.
+
+    Args:
+        blob (bytes | None): Stored bytes.
+
+    Returns:
+        int | None: The integer, None for None.
+    """
+    return None if blob is None else int.from_bytes(blob, byteorder='big')
+
+def key_fingerprint(e: int, n: int) -> bytes:
+    """
+    Compute the fingerprint identifying a public key.
+
+    Args:
+        e (int): Public exponent.
+        n (int): Modulus.
+
+    Returns:
+        bytes: The first FINGERPRINT_SIZE bytes of SHA-256 over the length-prefixed e and n.
+    """
+    digest = hashlib.sha256()
+    for value in (e, n):
+        encoded = int_to_blob(value)
+        digest.update(len(encoded).to_bytes(4, byteorder='big') + encoded)
+    return digest.digest()[:FINGERPRINT_SIZE]
@@ -0,0 +1,266 @@
+"""
+Key Rotation Module
+
+This module moves a user's files from one key to another. Every file is decrypted as a
+stream and encrypted again with the new key into a temporary file, which is renamed into
+place, or into memory for a packfile or inline container; the plaintext never reaches the
+disk. Files are rotated by a bounded pool of worker processes and their rows are switched
+to the new key batch by batch, each batch committed together with a checkpoint, so an
+interrupted rotation resumes after the last committed batch instead of starting over.
+
+"""
+
+import io
+from collections import deque
+from typing import Iterable, Iterator
+from database.db_handler import (get_key, lookup_public_key, lookup_private_key, get_files_by_key, start_rotation,
+                                 save_rotation_batch, finish_rotation, find_encrypted_copy, transaction, StoredFile)
+from encryption import rsa
+from encryption.codebook import get_max_modulus, init_worker
+from encryption.container import LAYOUT_PACKED
+from encryption.keys import RSAKey
+from encryption.rsa import iter_decrypt, _encrypt_to, DEFAULT_MAX_INFLIGHT, DEFAULT_BATCH_SIZE, IO_BUFFER_SIZE
+from file_handler.storage import backend_for, store_containers, container_exists, release_containers
+from instrumentation import metrics
+
+class _ChunkReader(io.RawIOBase):
+    """
+    A read-only stream over an iterator of byte chunks, such as the plaintext from iter_decrypt.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        """
+        Prepares the stream.
+
+        Args:
+            chunks (Iterable[bytes]): Data of the stream, in order.
+
+        Returns:
+            None
+        """
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+        self.position = 0
+
+    def readable(self) -> bool:
+        """The stream can be read."""
+        return True
+
+    def readinto(self, buffer) -> int:
+        """Copy the next bytes of the stream into a buffer, returning their number, 0 at the end."""
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        self.position += size
+        return size
+
+    def tell(self) -> int:
+        """Number of bytes read so far."""
+        return self.position
+
+def resolve_key(value: str, private: bool = False) -> RSAKey | None:
+    """
+    Finds a stored key given by its id or as a key string, printing why when it cannot be used.
+
+    Args:
+        value (str): ID of the key, or the key as '(d, n)' when private, '(e, n)' otherwise.
+        private (bool): Whether the private exponent is needed.
+
+    Returns:
+        RSAKey | None: The key, or None if it is not stored or lacks its private exponent.
+    """
+    try:
+        if value.strip().isdigit():
+            key = get_key(int(value))
+        else:
+            key = lookup_private_key(value) if private else lookup_public_key(value)
+    except ValueError as error:
+        print(error)
+        return None
+    if key is None or key.key_id is None:
+        print(f"Key '{value}' is not stored in the database!")
+        return None
+    if private and key.d is None:
+        print(f"The private key of key {key.key_id} is not stored, pass it as '(d, n)'")
+        return None
+    return key
+
+def rotate_key(username: str, from_key: str, to_key: str, workers: int = 1,
+               max_inflight: int = DEFAULT_MAX_INFLIGHT, batch_size: int = DEFAULT_BATCH_SIZE,
+               layout: int = LAYOUT_PACKED, buffer_size: int = IO_BUFFER_SIZE, storage: str | None = None) -> None:
+    """
+    Encrypts all of a user's files under one key again with another key.
+
+    Files keep their encryption mode. A file whose recorded plaintext hash does not match
+    what was decrypted is left on the old key and reported. Files sharing an encrypted
+    container are encrypted once. Encrypted files that no row uses any more are removed
+    after their batch is committed; old packfile objects are left to compaction.
+
+    Args:
+        username (str): Username of the file owner.
+        from_key (str): Key the files are encrypted with, its id or private key '(d, n)'.
+        to_key (str): Key to encrypt them with, its id or public key '(e, n)'.
+        workers (int): Number of worker processes, each rotating whole files.
+        max_inflight (int): Maximum number of queued files per worker.
+        batch_size (int): Number of files switched to the new key per transaction.
+        layout (int): Block layout of 'rsa' mode files, LAYOUT_PACKED or LAYOUT_FIXED.
+        buffer_size (int): Bytes read or written per I/O call.
+        storage (str | None): Backend of small files, 'file', 'pack' or 'inline'; None keeps each file's
+            current backend.
+
+    Returns:
+        None
+    """
+    old_key = resolve_key(from_key, private=True)
+    new_key = resolve_key(to_key)
+    if old_key is None or new_key is None:
+        return
+    if old_key.key_id == new_key.key_id:
+        print("The files are already encrypted with this key.")
+        return
+    started = start_rotation(username, old_key.key_id, new_key.key_id)
+    if started is None:
+        # the keys were found, but no file or key was ever saved under this username
+        print(f"User '{username}' is not in the database!")
+        return
+    rotation_id, last_file_id = started
+    if last_file_id:
+        print(f"Resuming the rotation from key {old_key.key_id} to key {new_key.key_id} after file {last_file_id}")
+
+    rows = []
+    old_locations = []
+    batch_failed = 0
+    # old encrypted path -> (new container, mode, content hash, size, chunk digests), for rows of this batch sharing one
+    done: dict[str, tuple] = {}
+
+    def flush() -> None:
+        """Commit the finished files and the checkpoint, then remove encrypted files left unused."""
+        nonlocal batch_failed
+        if not rows and not batch_failed:
+            return
+        with transaction():
+            locations = store_containers(rsa.ENCRYPTED_DIR, [row[1] for row in rows])
+            save_rotation_batch(rotation_id, new_key.key_id,
+                                [(row[0], location) + row[2:] for row, location in zip(rows, locations)],
+                                last_file_id, batch_failed)
+        metrics.count('rotate.files', len(rows))
+        release_containers(old_locations)
+        rows.clear()
+        old_locations.clear()
+        done.clear()
+        batch_failed = 0
+
+    def collect(stored: StoredFile, container, error: str | None, mode: str | None = None,
+                content_hash: bytes | None = None, size: int | None = None, chunk_digests: bytes | None = None) -> None:
+        """Record one handled file and flush a full batch."""
+        nonlocal batch_failed, last_file_id
+        last_file_id = stored.id
+        if error:
+            print(f"Could not rotate '{stored.file_path}': {error}")
+            if container:
+                release_containers([container])
+            batch_failed += 1
+        else:
+            rows.append((stored.id, container, mode, content_hash, size, chunk_digests))
+            old_locations.append(stored.location)
+            done[stored.encrypted_path] = (container, mode, content_hash, size, chunk_digests)
+        if len(rows) + batch_failed >= batch_size:
+            flush()
+
+    def reuse(stored: StoredFile) -> tuple | None:
+        """Return the result for a file whose plaintext is already encrypted with the new key, if it is one."""
+        hit = done.get(stored.encrypted_path)
+        if hit is None and stored.content_hash is not None:
+            copy = find_encrypted_copy(username, new_key.key_id, stored.size, stored.content_hash)
+            if copy and container_exists(copy[0]):
+                hit = (copy[0], copy[1], stored.content_hash, stored.size, None)
+        return (stored, hit[0], None) + hit[1:] if hit else None
+
+    try:
+        if workers <= 1:
+            for stored in _iter_pages(username, old_key.key_id, last_file_id, batch_size):
+                collect(*(reuse(stored) or _rotate_file_job(username, stored, old_key, new_key, layout, buffer_size,
+                                                            storage)))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                     initargs=(get_max_modulus(),)) as executor:
+                # (row, future) in file order, so the checkpoint never passes a file still in flight;
+                # a row sharing its encrypted file with one in flight waits for it instead of a future
+                pending = deque()
+                in_flight: set[str] = set()
+
+                def collect_next() -> None:
+                    """Collect the oldest queued file."""
+                    stored, future = pending.popleft()
+                    if future is None:
+                        collect(*(reuse(stored) or _rotate_file_job(username, stored, old_key, new_key, layout,
+                                                                    buffer_size, storage)))
+                        return
+                    in_flight.discard(stored.encrypted_path)
+                    collect(*future.result())
+
+                for stored in _iter_pages(username, old_key.key_id, last_file_id, batch_size):
+                    if len(pending) >= workers * max(max_inflight, 1):
+                        collect_next()
+                    if stored.encrypted_path in in_flight or reuse(stored):
+                        pending.append((stored, None))
+                    else:
+                        in_flight.add(stored.encrypted_path)
+                        pending.append((stored, executor.submit(_rotate_file_job, username, stored, old_key, new_key,
+                                                                layout, buffer_size, storage)))
+                while pending:
+                    collect_next()
+    finally:
+        # whatever finished before an interruption is kept, the next run resumes after it
+        flush()
+
+    rotated, failed = finish_rotation(rotation_id)
+    print(f"Rotated {rotated} file(s) from key {old_key.key_id} to key {new_key.key_id}"
+          + (f", {failed} could not be rotated and stay on key {old_key.key_id}" if failed else ""))
+
+def _iter_pages(username: str, key_id: int, after: int, batch_size: int) -> Iterator[StoredFile]:
+    """Yield a user's files under a key after a file id, reading them one page at a time."""
+    while page := get_files_by_key(username, key_id, after, batch_size):
+        yield from page
+        after = page[-1].id
+
+def _rotate_file_job(username: str, stored: StoredFile, old_key: RSAKey, new_key: RSAKey,
+                     layout: int = LAYOUT_PACKED, buffer_size: int = IO_BUFFER_SIZE, storage: str | None = None) -> tuple:
+    """
+    Decrypt one encrypted file and encrypt it again with the new key, reporting failures instead of raising.
+
+    Args:
+        username (str): Username of the file owner.
+        stored (StoredFile): Row of the file.
+        old_key (RSAKey): Key the file is encrypted with, including its private exponent.
+        new_key (RSAKey): Key to encrypt it with.
+        layout (int): Block layout of 'rsa' mode, LAYOUT_PACKED or LAYOUT_FIXED.
+        buffer_size (int): Bytes read or written per I/O call.
+        storage (str | None): Backend of small files, 'file', 'pack' or 'inline'; None keeps the file's
+            current backend.
+
+    Returns:
+        tuple: The row, the new encrypted file's location or the pending container if one was written,
+        an error message if the rotation failed, and the mode, SHA-256, size and chunk digests of the plaintext.
+    """
+    try:
+        chunks = iter_decrypt(stored.location, old_key.d, old_key.n, old_key.crt, mode=stored.mode,
+                              buffer_size=buffer_size)
+        reader = _ChunkReader(chunks)
+        container, content_hash, chunk_digests = _encrypt_to(username, stored.file_path, new_key.e, new_key.n,
+                                                             stored.mode, key_id=new_key.key_id, layout=layout,
+                                                             buffer_size=buffer_size,
+                                                             source=io.BufferedReader(reader, buffer_size),
+                                                             storage=backend_for(storage or stored.location.storage,
+                                                                                 stored.size))
+    except (OSError, ValueError, OverflowError, IndexError) as error:
+        return stored, None, str(error) or type(error).__name__
+    if stored.content_hash is not None and content_hash != stored.content_hash:
+        return stored, container, "the decrypted content does not match its recorded hash"
+    return stored, container, None, stored.mode, content_hash, reader.position, chunk_digests
@@ -0,0 +1,102 @@
+"""
+Vectorized Modular Exponentiation Module
+
+This module runs RSA over whole segments at once with NumPy when the modulus is below
+2**32: blocks are unpacked into an array of uint64 values and square-and-multiply is
+applied to the entire array, since the product of two residues still fits in 64 bits.
+NumPy is optional; without it, or for wider moduli, the block-by-block path is used.
+It is only imported the first time a small enough modulus is seen.
+
+"""
+
+from functools import lru_cache
+
+np = None
+
+# Residues below this bound multiply without overflowing uint64
+VECTOR_MAX_MODULUS = 1 << 32
+
+@lru_cache(maxsize=None)
+def _load_numpy() -> bool:
+    """Import NumPy on first use, returning whether it is installed."""
+    global np
+    try:
+        import numpy
+    except ImportError:
+        return False
+    np = numpy
+    return True
+
+def vectorized_available(n: int) -> bool:
+    """
+    Check whether a modulus can use the vectorized backend.
+
+    Args:
+        n (int): Modulus.
+
+    Returns:
+        bool: True if n is below 2**32 and NumPy is installed.
+    """
+    return 0 < n < VECTOR_MAX_MODULUS and _load_numpy()
+
+def powmod(values: 'np.ndarray', exponent: int, n: int) -> 'np.ndarray':
+    """
+    Raise every element of an array to a power modulo n.
+
+    Args:
+        values (np.ndarray): Block values as uint64.
+        exponent (int): Exponent.
+        n (int): Modulus, below 2**32.
+
+    Returns:
+        np.ndarray: pow(value, exponent, n) for every value.
+    """
+    modulus = np.uint64(n)
+    base = values % modulus
+    result = np.ones_like(base)
+    while exponent:
+        if exponent & 1:
+            result = result * base % modulus
+        exponent >>= 1
+        if exponent:
+            base = base * base % modulus
+    return result
+
+def _unpack_fields(data: bytes, width: int) -> 'np.ndarray':
+    """Split data into consecutive big-endian fields of width bits (at most 64)."""
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    count = len(bits) // width
+    padded = np.zeros((count, 64), dtype=np.uint8)
+    padded[:, 64 - width:] = bits[:count * width].reshape(count, width)
+    return np.packbits(padded, axis=1).view('>u8').ravel().astype(np.uint64)
+
+def _pack_fields(values: 'np.ndarray', width: int) -> bytes:
+    """Concatenate values as big-endian fields of width bits, padding the last byte with zeros."""
+    bits = np.unpackbits(values.astype('>u8').view(np.uint8).reshape(-1, 8), axis=1)
+    return np.packbits(bits[:, 64 - width:].ravel()).tobytes()
+
+def powmod_fields(data: bytes, in_width: int, out_width: int, exponent: int, n: int) -> bytes:
+    """
+    Apply an RSA operation to every block of a bit-packed segment.
+
+    The result is byte-identical to converting each field with int.from_bytes,
+    calling pow and writing it back at out_width bits.
+
+    Args:
+        data (bytes): Blocks of in_width bits each, in order.
+        in_width (int): Bits per input block.
+        out_width (int): Bits per output block.
+        exponent (int): Public or private exponent.
+        n (int): Modulus, below 2**32.
+
+    Returns:
+        bytes: Transformed blocks of out_width bits each.
+
+    Raises:
+        OverflowError: If a result does not fit in out_width bits, which happens
+        when decrypting with the wrong key.
+    """
+    result = powmod(_unpack_fields(data, in_width), exponent, n)
+    if out_width < 64 and (result >> np.uint64(out_width)).any():
+        raise OverflowError(f"RSA block does not fit in {out_width} bits")
+    return _pack_fields(result, out_width)
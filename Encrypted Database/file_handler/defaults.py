@@ -0,0 +1,21 @@
+"""
+Storage Defaults Module
+
+This module holds the storage backends and the default values of the storage and
+verification options. They live apart from file_handler.storage and file_handler.verify
+so the command-line parser can show them without importing those modules, which only
+the commands that store or check containers need.
+
+"""
+
+STORAGE_FILE = 'file'
+STORAGE_PACK = 'pack'
+STORAGE_INLINE = 'inline'
+STORAGE_BACKENDS = (STORAGE_FILE, STORAGE_PACK, STORAGE_INLINE)
+
+# Share of dead space above which compact_packs() rewrites a packfile
+DEFAULT_MIN_GARBAGE = 0.5
+
+DEFAULT_VERIFY_WORKERS = 4
+# Bytes per read call; large sequential reads let the disks stream at full speed
+VERIFY_BUFFER_SIZE = 8 << 20
@@ -1,62 +1,217 @@
-"""
-File Operations Module
-
-This module handles reading and deleting encrypted files for a secure file management system.
-
-"""
-
-from database.db_handler import get_encrypted_file, delete_file_from_db
-from encryption.rsa import decrypt_file
-import os
-
-def read_file(username: str, file_path: str, private_key_str: str) -> None:
-    """
-    Decrypts and displays the content of an encrypted file.
-
-    Args:
-        username (str): The username associated with the encrypted file.
-        file_path (str): The path to the original file.
-        private_key_str (str): The private key used for decryption in the format '(d, n)'.
-
-    Returns:
-        None
-    """
-    encrypted_file = get_encrypted_file(username, file_path)
-    if not encrypted_file or not private_key_str:
-        print("Encrypted file or private key not found!")
-        return
-
-    d, n = map(int, private_key_str.strip("() ").split(","))
-    decrypted_output = "temp_decrypted.txt"
-
-    decrypt_file(encrypted_file, decrypted_output, d, n)
-
-    with open(decrypted_output, 'r') as f:
-        content = f.read()
-    os.remove(decrypted_output)
-    print(f"\n Content of the decrypted file: \n{content}")
-
-def delete_file(username: str, file_path: str) -> None:
-    """
-    Deletes an encrypted file from disk and removes its entry from the database.
-
-    Args:
-        username (str): The username associated with the encrypted file.
-        file_path (str): The path to the original file.
-
-    Returns:
-        None
-    """
-    encrypted_file = get_encrypted_file(username, file_path)
-    if not encrypted_file:
-        print("The encrypted file was not found in the database!")
-        return
-
-    if os.path.exists(encrypted_file):
-        os.remove(encrypted_file)
-        print(f"File '{encrypted_file}' was removed.")
-    else:
-        print("This file doesn't exist.")
-
-    delete_file_from_db(username, file_path)
-    print("The information about this file was removed from the database.")
+"""
+File Operations Module
+
+This module handles reading, deleting, searching and verifying encrypted files for a secure file
+management system, whichever storage backend holds them.
+
+"""
+
+from database.db_handler import (get_stored_file, lookup_private_key, delete_file_from_db, count_file_references,
+                                 find_files_by_tokens, print_records)
+from encryption.blind_index import MIN_TERM_LENGTH, MAX_TERM_LENGTH, split_terms, make_tokens
+from encryption import rsa
+from encryption.rsa import iter_decrypt, DEFAULT_MAX_INFLIGHT, IO_BUFFER_SIZE
+from file_handler.storage import STORAGE_FILE, STORAGE_PACK, DEFAULT_MIN_GARBAGE, compact_packs, describe
+from file_handler.verify import DEFAULT_VERIFY_WORKERS, VERIFY_BUFFER_SIZE, verify_containers
+from instrumentation import metrics
+from typing import BinaryIO, Iterable, Iterator
+import glob
+import os
+import sys
+
+def expand_paths(patterns: Iterable[str], recursive: bool = False, from_stdin: bool = False) -> Iterator[str]:
+    """
+    Expands file arguments into the regular files they name, lazily.
+
+    Args:
+        patterns (Iterable[str]): File paths, directories or glob patterns ('**' matches subdirectories).
+        recursive (bool): Whether directories are walked recursively instead of only their top level.
+        from_stdin (bool): Whether more paths are read from standard input, one per line.
+
+    Returns:
+        Iterator[str]: Paths of the files to process.
+    """
+    def expand(pattern: str) -> Iterator[str]:
+        """Yield the files named by a single argument."""
+        if os.path.isdir(pattern):
+            if recursive:
+                for root, _, files in os.walk(pattern):
+                    for name in sorted(files):
+                        yield os.path.join(root, name)
+            else:
+                for entry in sorted(os.scandir(pattern), key=lambda entry: entry.name):
+                    if entry.is_file():
+                        yield entry.path
+        elif glob.has_magic(pattern):
+            for path in glob.iglob(pattern, recursive=True):
+                if os.path.isfile(path):
+                    yield path
+        else:
+            yield pattern
+
+    for pattern in patterns:
+        yield from expand(pattern)
+    if from_stdin:
+        for line in sys.stdin:
+            if path := line.rstrip("\n"):
+                yield from expand(path)
+
+def read_file(username: str, file_path: str, private_key_str: str,
+              workers: int = 1, max_inflight: int = DEFAULT_MAX_INFLIGHT, output: str | None = None,
+              offset: int = 0, length: int | None = None, buffer_size: int = IO_BUFFER_SIZE) -> None:
+    """
+    Decrypts an encrypted file and streams its content to standard output or to a file.
+
+    The plaintext is never written to a temporary file and never held in memory as a whole;
+    it is written buffer_size bytes at a time.
+
+    Args:
+        username (str): The username associated with the encrypted file.
+        file_path (str): The path to the original file.
+        private_key_str (str): The private key used for decryption in the format '(d, n)'.
+        workers (int): Number of worker processes used for decryption.
+        max_inflight (int): Maximum number of segments held in memory when workers > 1.
+        output (str | None): Path to write the plaintext to, standard output when None.
+        offset (int): First plaintext byte to return.
+        length (int | None): Number of bytes to return, up to the end of the file when None.
+        buffer_size (int): Bytes read or written per I/O call.
+
+    Returns:
+        None
+    """
+    stored = get_stored_file(username, file_path)
+    if not stored or not private_key_str:
+        print("Encrypted file or private key not found!")
+        return
+
+    key = lookup_private_key(private_key_str)
+    d, n, crt = key.d, key.n, key.crt
+    chunks = iter_decrypt(stored.location, d, n, crt, workers, max_inflight, stored.mode, offset, length, buffer_size)
+
+    try:
+        if output:
+            with open(output, 'wb') as f_out:
+                _write_chunks(chunks, f_out, buffer_size)
+            print(f"File '{os.path.basename(file_path)}' decrypted to '{output}'")
+        else:
+            sys.stdout.flush()
+            _write_chunks(chunks, sys.stdout.buffer, buffer_size)
+            sys.stdout.buffer.flush()
+    except (OverflowError, IndexError):
+        print("The private key does not match this file!")
+    except (ValueError, OSError) as error:
+        print(error)
+
+def _write_chunks(chunks: Iterable[bytes], f_out: BinaryIO, buffer_size: int = IO_BUFFER_SIZE) -> None:
+    """
+    Writes chunks to a file, gathering them into writes of at least buffer_size bytes.
+
+    Args:
+        chunks (Iterable[bytes]): Data to write, in order.
+        f_out (BinaryIO): File opened for binary writing.
+        buffer_size (int): Minimum number of bytes per write call, except for the last one.
+
+    Returns:
+        None
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        if len(pending) >= buffer_size:
+            metrics.counted_write(f_out, pending)
+            pending.clear()
+    metrics.counted_write(f_out, pending)
+
+def delete_file(username: str, file_path: str) -> None:
+    """
+    Removes a file's entries from the database and deletes their encrypted containers.
+
+    Encrypting a file again adds an entry, so older versions may still have containers
+    of their own; each one is handled like the newest. Identical plaintexts share one encrypted container, so it is only deleted once no
+    other entry refers to it. An inline container goes with its entry, and a packfile
+    object becomes dead space until the packfile is compacted.
+
+    Args:
+        username (str): The username associated with the encrypted file.
+        file_path (str): The path to the original file.
+
+    Returns:
+        None
+    """
+    locations = delete_file_from_db(username, file_path)
+    if not locations:
+        print("The encrypted file was not found in the database!")
+        return
+    print("The information about this file was removed from the database.")
+
+    # older rows of the path may point at containers of their own, each one is released like the newest
+    for location in locations:
+        encrypted_file = location.encrypted_path
+        references = count_file_references(location)
+        if references:
+            print(f"{describe(location)} is still used by {references} "
+                  f"other entr{'y' if references == 1 else 'ies'}, it was kept.")
+        elif location.storage == STORAGE_PACK:
+            print(f"{describe(location)} is no longer used, compact the packfiles to reclaim its space.")
+        elif location.storage != STORAGE_FILE:
+            print("Its encrypted content was stored in the database and was removed with it.")
+        elif os.path.exists(encrypted_file):
+            os.remove(encrypted_file)
+            print(f"File '{encrypted_file}' was removed.")
+        else:
+            print(f"File '{encrypted_file}' doesn't exist.")
+
+def search_files(username: str, query: str, index_key: bytes, output_format: str = 'text') -> None:
+    """
+    Prints the user's indexed files containing every word of a query, without decrypting any file.
+
+    Args:
+        username (str): Username of the file owner.
+        query (str): Words to look for, in any order and case.
+        index_key (bytes): Key of the user's blind index, see derive_index_key().
+        output_format (str): 'text', 'json' or 'tsv', as for the list command.
+
+    Returns:
+        None
+    """
+    terms = split_terms(query)
+    if not terms:
+        print(f"'{query}' has no word of {MIN_TERM_LENGTH} to {MAX_TERM_LENGTH} letters or digits to search for.")
+        return
+    records = find_files_by_tokens(username, make_tokens(index_key, terms))
+    if output_format != 'text':
+        print_records(records, output_format)
+        return
+    if not records:
+        print(f"No indexed file contains '{query}'.")
+        return
+    print(f"Files containing '{query}':")
+    for record in records:
+        print(f"{record.file_path} | {os.path.basename(record.encrypted_path)} | {record.timestamp}")
+
+def compact_storage(min_garbage: float = DEFAULT_MIN_GARBAGE) -> None:
+    """
+    Reclaims the dead space of the packfiles in the encrypted files directory.
+
+    Args:
+        min_garbage (float): Share of dead space, from 0 to 1, above which a packfile is compacted.
+
+    Returns:
+        None
+    """
+    compact_packs(rsa.ENCRYPTED_DIR, min_garbage)
+
+def verify_storage(username: str | None = None, workers: int = DEFAULT_VERIFY_WORKERS,
+                   buffer_size: int = VERIFY_BUFFER_SIZE) -> None:
+    """
+    Checks the encrypted files against the checksums recorded when they were written.
+
+    Args:
+        username (str | None): Only this user's files, every user's when None.
+        workers (int): Number of threads reading encrypted files.
+        buffer_size (int): Bytes per read call.
+
+    Returns:
+        None
+    """
+    verify_containers(rsa.ENCRYPTED_DIR, username, workers, buffer_size)
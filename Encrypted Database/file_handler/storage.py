@@ -0,0 +1,278 @@
+"""
+Storage Backends Module
+
+This module decides where encrypted containers are kept and reads them back. There are
+three backends:
+
+    - 'file': every container is a .enc file of its own in the encrypted files directory.
+    - 'pack': containers are appended to a shared packfile; their row in the files table
+      records the packfile, offset and length.
+    - 'inline': containers are stored in their row of the files table as a BLOB.
+
+Only small files go to the packfile and inline backends. Their containers are built in
+memory and stored when their rows are saved, so a batch of files costs one packfile write
+instead of one file creation each. A packfile object is appended inside the transaction
+that saves its row: SQLite's write lock orders the appends, and compaction never meets
+bytes whose row is not committed yet. Deleting a packfile object only leaves dead space,
+which compact_packs() reclaims.
+
+"""
+
+import glob
+import io
+import os
+from typing import BinaryIO, Iterable, NamedTuple
+from database.db_handler import (ContainerLocation, as_location, count_file_references, get_pack_objects,
+                                 move_pack_objects, transaction)
+from file_handler.defaults import STORAGE_FILE, STORAGE_PACK, STORAGE_INLINE, STORAGE_BACKENDS, DEFAULT_MIN_GARBAGE
+from instrumentation import metrics
+
+# Plaintexts up to this size may go to the packfile or inline backends, larger ones get a file of their own
+SMALL_FILE_SIZE = 1 << 20
+# Containers up to this size are stored inline, larger ones go to the packfile
+INLINE_MAX_SIZE = 4096
+# A packfile takes no more objects once it has grown to this size
+PACK_TARGET_SIZE = 1 << 30
+
+# Packfiles live in this subdirectory of the encrypted files directory
+PACK_DIR = 'packs'
+PACK_PREFIX = 'pack-'
+PACK_SUFFIX = '.pack'
+
+class PendingContainer(NamedTuple):
+    """
+    A small container built in memory, stored by store_containers() together with its row.
+
+    Attributes:
+        storage (str): Backend it goes to, 'pack' or 'inline'.
+        encrypted_path (str): Name it is listed under.
+        data (bytes): The container.
+        checksum (bytes | None): Its container_checksum(), if known.
+    """
+    storage: str
+    encrypted_path: str
+    data: bytes
+    checksum: bytes | None = None
+
+def backend_for(storage: str, size: int | None) -> str:
+    """
+    Chooses the backend of a file's container.
+
+    Args:
+        storage (str): Backend asked for, 'file', 'pack' or 'inline'.
+        size (int | None): Size of the plaintext in bytes, None if unknown.
+
+    Returns:
+        str: The backend asked for if the file is small enough for it, otherwise 'file'.
+    """
+    if storage == STORAGE_FILE or size is None or size > SMALL_FILE_SIZE:
+        return STORAGE_FILE
+    return storage
+
+def store_containers(directory: str, containers: list) -> list[ContainerLocation]:
+    """
+    Stores the pending containers of a batch of rows, appending their packfile objects with a single write.
+
+    Call it inside the transaction that saves the rows, see the module docstring. The packfile
+    is synced before returning, so the rows are never committed ahead of their bytes. Pending
+    containers with the same name hold the same plaintext under the same key and are stored once.
+
+    Args:
+        directory (str): Encrypted files directory.
+        containers (list): PendingContainer, ContainerLocation or path of an encrypted file for each row.
+
+    Returns:
+        list[ContainerLocation]: Location of each container, in order.
+    """
+    locations = []
+    packed: dict[str, ContainerLocation] = {}
+    pending = bytearray()
+    pack_path, position = None, 0
+    for container in containers:
+        if not isinstance(container, PendingContainer):
+            locations.append(as_location(container))
+        elif container.storage == STORAGE_INLINE and len(container.data) <= INLINE_MAX_SIZE:
+            locations.append(ContainerLocation(STORAGE_INLINE, container.encrypted_path, inline_data=container.data,
+                                               checksum=container.checksum, encrypted_size=len(container.data)))
+        else:
+            if container.encrypted_path not in packed:
+                if pack_path is None:
+                    pack_path = _active_pack(directory)
+                    position = os.path.getsize(pack_path) if os.path.exists(pack_path) else 0
+                packed[container.encrypted_path] = ContainerLocation(STORAGE_PACK, container.encrypted_path, pack_path,
+                                                                     position + len(pending), len(container.data),
+                                                                     checksum=container.checksum,
+                                                                     encrypted_size=len(container.data))
+                pending += container.data
+            locations.append(packed[container.encrypted_path])
+    if pending:
+        with open(pack_path, 'ab') as f_out:
+            metrics.counted_write(f_out, pending)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        metrics.count('storage.pack_objects', len(packed))
+    return locations
+
+def open_container(location: ContainerLocation | str) -> BinaryIO:
+    """
+    Opens an encrypted container for binary reading.
+
+    A packfile object is read with one seek and one read.
+
+    Args:
+        location (ContainerLocation | str): Location of the container, or the path of the encrypted file.
+
+    Returns:
+        BinaryIO: The container, to be closed by the caller.
+
+    Raises:
+        OSError: If the container's file or packfile is missing or too short.
+    """
+    location = as_location(location)
+    if location.storage == STORAGE_INLINE:
+        return io.BytesIO(location.inline_data)
+    if location.storage == STORAGE_PACK:
+        with open(location.pack_path, 'rb') as f_in:
+            f_in.seek(location.pack_offset)
+            data = f_in.read(location.pack_length)
+        if len(data) != location.pack_length:
+            raise OSError(f"'{location.pack_path}' ends inside the object at offset {location.pack_offset}")
+        return io.BytesIO(data)
+    return open(location.encrypted_path, 'rb')
+
+def container_exists(container) -> bool:
+    """
+    Checks whether a container can still be read, without reading it.
+
+    Args:
+        container: PendingContainer, ContainerLocation or path of an encrypted file.
+
+    Returns:
+        bool: False if its file or packfile is missing.
+    """
+    if isinstance(container, PendingContainer):
+        return True
+    location = as_location(container)
+    if location.storage == STORAGE_PACK:
+        return os.path.exists(location.pack_path)
+    return location.storage == STORAGE_INLINE or os.path.exists(location.encrypted_path)
+
+def release_containers(containers: Iterable) -> list[str]:
+    """
+    Removes the encrypted files no row uses any more.
+
+    Packfile objects are left as dead space for compact_packs(), inline and pending containers
+    have nothing to remove.
+
+    Args:
+        containers (Iterable): PendingContainer, ContainerLocation or path of an encrypted file
+            for each container that may have lost its last row.
+
+    Returns:
+        list[str]: Paths of the removed files.
+    """
+    removed = []
+    for location in {as_location(c) for c in containers if not isinstance(c, PendingContainer)}:
+        if (location.storage == STORAGE_FILE and os.path.exists(location.encrypted_path)
+                and not count_file_references(location)):
+            os.remove(location.encrypted_path)
+            removed.append(location.encrypted_path)
+    return removed
+
+def describe(location: ContainerLocation | str) -> str:
+    """
+    Names a container for messages.
+
+    Args:
+        location (ContainerLocation | str): Location of the container, or the path of the encrypted file.
+
+    Returns:
+        str: Its name, and the packfile or database holding it.
+    """
+    location = as_location(location)
+    name = f"'{os.path.basename(location.encrypted_path)}'"
+    if location.storage == STORAGE_PACK:
+        return f"{name} in packfile '{os.path.basename(location.pack_path)}'"
+    if location.storage == STORAGE_INLINE:
+        return f"{name} inline in the database"
+    return name
+
+def _pack_paths(directory: str) -> list[str]:
+    """Return the packfiles of an encrypted files directory, oldest first."""
+    return sorted(glob.glob(os.path.join(glob.escape(directory), PACK_DIR, f"{PACK_PREFIX}*{PACK_SUFFIX}")))
+
+def _new_pack(directory: str, packs: list[str]) -> str:
+    """Return the path of a packfile numbered after all existing ones, creating its directory."""
+    number = int(os.path.basename(packs[-1])[len(PACK_PREFIX):-len(PACK_SUFFIX)]) + 1 if packs else 1
+    os.makedirs(os.path.join(directory, PACK_DIR), exist_ok=True)
+    return os.path.join(directory, PACK_DIR, f"{PACK_PREFIX}{number:06d}{PACK_SUFFIX}")
+
+def _active_pack(directory: str) -> str:
+    """Return the packfile taking new objects: the newest one, or a new one once it is full."""
+    packs = _pack_paths(directory)
+    if packs and os.path.getsize(packs[-1]) < PACK_TARGET_SIZE:
+        return packs[-1]
+    return _new_pack(directory, packs)
+
+def compact_packs(directory: str, min_garbage: float = DEFAULT_MIN_GARBAGE) -> None:
+    """
+    Reclaims the dead space of the packfiles left by deleted and replaced files.
+
+    A packfile whose share of dead space is at least min_garbage has its live objects copied
+    to a new packfile, which is synced before the rows are pointed at it, and is then removed.
+    Each packfile is compacted in one transaction, so encryptions wait for it instead of
+    appending to a packfile being compacted.
+
+    Args:
+        directory (str): Encrypted files directory.
+        min_garbage (float): Share of dead space, from 0 to 1, above which a packfile is compacted.
+
+    Returns:
+        None
+    """
+    compacted = reclaimed = 0
+    for pack_path in _pack_paths(directory):
+        with transaction():
+            size = os.path.getsize(pack_path)
+            objects = get_pack_objects(pack_path)
+            garbage = size - sum(length for _, length in objects)
+            if not garbage or garbage < min_garbage * size:
+                continue
+            if objects:
+                new_path = _new_pack(directory, _pack_paths(directory))
+                moves = _copy_objects(pack_path, new_path, objects)
+                move_pack_objects(pack_path, new_path, moves)
+            else:
+                # nothing refers to it, not even a row about to be committed
+                os.remove(pack_path)
+        if os.path.exists(pack_path):
+            os.remove(pack_path)
+        compacted += 1
+        reclaimed += garbage
+        print(f"Compacted '{os.path.basename(pack_path)}': {len(objects)} object(s) kept, {garbage} byte(s) reclaimed")
+    if compacted:
+        print(f"Compacted {compacted} packfile(s), {reclaimed} byte(s) reclaimed")
+    else:
+        print("No packfile has enough dead space to compact.")
+
+def _copy_objects(pack_path: str, new_path: str, objects: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """
+    Copy packfile objects one after another into a new packfile and sync it.
+
+    Args:
+        pack_path (str): Path to the packfile holding the objects.
+        new_path (str): Path to the packfile to create.
+        objects (list[tuple[int, int]]): Offset and length of each object, in file order.
+
+    Returns:
+        list[tuple[int, int]]: Old and new offset of each object.
+    """
+    moves = []
+    with open(pack_path, 'rb') as f_in, open(new_path, 'wb') as f_out:
+        for offset, length in objects:
+            f_in.seek(offset)
+            moves.append((offset, f_out.tell()))
+            metrics.counted_write(f_out, metrics.counted_read(f_in, length))
+        f_out.flush()
+        os.fsync(f_out.fileno())
+    return moves
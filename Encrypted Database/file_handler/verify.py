@@ -0,0 +1,227 @@
+"""
+Integrity Verification Module
+
+This module checks the encrypted containers against the checksums and sizes recorded when
+they were written, without decrypting anything. Containers are read sequentially, in large
+reads, by a pool of threads: SHA-256 releases the GIL while it hashes, so the threads keep
+the disks busy instead of waiting on each other. The objects of a packfile are read by one
+thread, in file order, several objects per read.
+
+Missing and orphaned files are found by scanning the encrypted files directory once and
+joining the listing with the database in memory, instead of looking up every row on disk.
+Run it while no other command writes: a container written during the scan may be reported
+as orphaned.
+
+"""
+
+import io
+import os
+import time
+from collections import deque
+from database.db_handler import ContainerLocation, iter_containers, get_referenced_paths
+from encryption.container import container_checksum
+from file_handler.defaults import DEFAULT_VERIFY_WORKERS, VERIFY_BUFFER_SIZE
+from file_handler.storage import STORAGE_FILE, STORAGE_PACK, PACK_DIR, PACK_PREFIX, PACK_SUFFIX, describe
+from instrumentation import metrics
+
+# Checks queued per thread, so memory stays bounded however large the catalog is
+QUEUED_PER_WORKER = 4
+
+MISSING = 'missing'
+CORRUPT = 'corrupt'
+
+def verify_containers(directory: str, username: str | None = None, workers: int = DEFAULT_VERIFY_WORKERS,
+                      buffer_size: int = VERIFY_BUFFER_SIZE) -> dict[str, int]:
+    """
+    Checks the encrypted containers of the catalog, or of one user, and reports every problem found.
+
+    A container shared by several entries is read once. Containers written before checksums
+    were recorded are only checked for existence. Orphaned files are encrypted files and
+    packfiles no entry of any user points at, and temporary files left by interrupted writes.
+
+    Args:
+        directory (str): Encrypted files directory.
+        username (str | None): Only this user's files, every user's when None.
+        workers (int): Number of threads reading containers.
+        buffer_size (int): Bytes per read call.
+
+    Returns:
+        dict[str, int]: Number of containers 'checked' against their checksum, 'unchecked' ones,
+        'bytes' read, and 'missing', 'corrupt' and 'orphaned' containers.
+    """
+    start = time.perf_counter()
+    totals = dict.fromkeys(('checked', 'unchecked', 'bytes', MISSING, CORRUPT, 'orphaned'), 0)
+    on_disk, leftovers = _scan(directory)
+    scanned_dirs = {os.path.normpath(directory), os.path.normpath(os.path.join(directory, PACK_DIR))}
+
+    referenced = {os.path.normpath(path) for path in get_referenced_paths()}
+    for path in sorted(on_disk - referenced):
+        print(f"Orphaned: '{path}' is not used by any entry")
+    for path in sorted(leftovers):
+        print(f"Orphaned: '{path}' was left by an interrupted write")
+    totals['orphaned'] = len(on_disk - referenced) + len(leftovers)
+    del referenced
+
+    def exists(path: str) -> bool:
+        """Tell whether a file exists, from the scan when it covered the file's directory."""
+        return path in on_disk if os.path.dirname(path) in scanned_dirs else os.path.exists(path)
+
+    def collect(result: tuple) -> None:
+        """Add the outcome of one check to the totals and print its problems."""
+        checked, unchecked, read, problems = result
+        totals['checked'] += checked
+        totals['unchecked'] += unchecked
+        totals['bytes'] += read
+        for kind, message in problems:
+            totals[kind] += 1
+            print(f"{kind.capitalize()}: {message}")
+
+    # imported here so that the command-line parser can read the defaults above without loading it
+    from concurrent.futures import Future, ThreadPoolExecutor
+    seen: set[str] = set()
+    packs: dict[str, dict[int, tuple[ContainerLocation, str]]] = {}
+    queued: deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for owner, file_path, location in iter_containers(username):
+            label = f"{describe(location)} of '{file_path}' ({owner})"
+            if location.storage == STORAGE_PACK:
+                objects = packs.setdefault(os.path.normpath(location.pack_path), {})
+                objects.setdefault(location.pack_offset, (location, label))
+                continue
+            if location.storage != STORAGE_FILE:
+                collect(_check_data(location, location.inline_data, label))
+                continue
+            path = os.path.normpath(location.encrypted_path)
+            if path in seen:
+                continue
+            seen.add(path)
+            if not exists(path):
+                collect((0, 0, 0, [(MISSING, label)]))
+            elif location.checksum is None:
+                collect((0, 1, 0, []))
+            else:
+                queued.append(executor.submit(_check_file, location, label, buffer_size))
+                if len(queued) >= max(1, workers) * QUEUED_PER_WORKER:
+                    collect(queued.popleft().result())
+        del seen
+
+        for pack_path, objects in packs.items():
+            if not exists(pack_path):
+                collect((0, 0, 0, [(MISSING, label) for _, label in objects.values()]))
+            else:
+                queued.append(executor.submit(_check_pack, pack_path, objects, buffer_size))
+        while queued:
+            collect(queued.popleft().result())
+
+    metrics.count('verify.bytes_read', totals['bytes'])
+    elapsed = time.perf_counter() - start
+    print(f"Verified {totals['checked']} container(s), {totals['bytes'] / (1 << 20):.1f} MiB in {elapsed:.1f}s: "
+          f"{totals[MISSING]} missing, {totals[CORRUPT]} corrupt, {totals['orphaned']} orphaned")
+    if totals['unchecked']:
+        print(f"{totals['unchecked']} container(s) written before checksums were recorded were only checked "
+              "for existence.")
+    return totals
+
+def _scan(directory: str) -> tuple[set[str], set[str]]:
+    """
+    List the encrypted files directory and its packfiles with one pass over each directory.
+
+    Args:
+        directory (str): Encrypted files directory.
+
+    Returns:
+        tuple[set[str], set[str]]: Normalized paths of the encrypted files and packfiles, and of
+        the temporary files left by interrupted writes.
+    """
+    containers, leftovers = set(), set()
+    pack_dir = os.path.join(directory, PACK_DIR)
+    for path, suffixes in ((directory, ('.enc',)), (pack_dir, (PACK_SUFFIX,))):
+        if not os.path.isdir(path):
+            continue
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') and entry.name.endswith('.tmp'):
+                    leftovers.add(os.path.normpath(entry.path))
+                elif entry.name.endswith(suffixes) and (path != pack_dir or entry.name.startswith(PACK_PREFIX)):
+                    containers.add(os.path.normpath(entry.path))
+    return containers, leftovers
+
+def _compare(location: ContainerLocation, checksum: bytes, size: int) -> str | None:
+    """Return what differs between a container as read and as recorded, None if nothing does."""
+    if location.encrypted_size is not None and size != location.encrypted_size:
+        return f"{size} byte(s), expected {location.encrypted_size}"
+    if checksum != location.checksum:
+        return "checksum mismatch"
+    return None
+
+def _check_data(location: ContainerLocation, data: bytes, label: str) -> tuple:
+    """Check a container held in memory, see _check_file()."""
+    if location.checksum is None:
+        return 0, 1, 0, []
+    problem = _compare(location, *container_checksum(io.BytesIO(data)))
+    return 1, 0, len(data), [(CORRUPT, f"{label}: {problem}")] if problem else []
+
+def _check_file(location: ContainerLocation, label: str, buffer_size: int) -> tuple:
+    """
+    Check a container stored in its own file.
+
+    Args:
+        location (ContainerLocation): Location of the container, with its recorded checksum.
+        label (str): Name of the container and of an entry using it, for messages.
+        buffer_size (int): Bytes per read call.
+
+    Returns:
+        tuple: Containers checked against their checksum, containers only checked for existence,
+        bytes read, and the (kind, message) of each problem found.
+    """
+    try:
+        with open(location.encrypted_path, 'rb', buffering=0) as f:
+            checksum, size = container_checksum(f, buffer_size)
+    except FileNotFoundError:
+        return 0, 0, 0, [(MISSING, label)]
+    except OSError as error:
+        return 0, 0, 0, [(CORRUPT, f"{label}: unreadable, {error}")]
+    problem = _compare(location, checksum, size)
+    return 1, 0, size, [(CORRUPT, f"{label}: {problem}")] if problem else []
+
+def _check_pack(pack_path: str, objects: dict[int, tuple[ContainerLocation, str]], buffer_size: int) -> tuple:
+    """
+    Check the objects of a packfile, reading it in file order with buffer_size reads.
+
+    Args:
+        pack_path (str): Path to the packfile.
+        objects (dict[int, tuple[ContainerLocation, str]]): Location and label of each object, by offset.
+        buffer_size (int): Bytes per read call, more for a larger object.
+
+    Returns:
+        tuple: As for _check_file().
+    """
+    checked = unchecked = read = 0
+    problems = []
+    try:
+        # each check opens its own handle, so the threads never move each other's file position
+        with open(pack_path, 'rb') as f:
+            window, window_start = memoryview(b''), 0
+            for offset in sorted(objects):
+                location, label = objects[offset]
+                end = offset + location.pack_length
+                if offset < window_start or end > window_start + len(window):
+                    f.seek(offset)
+                    window = memoryview(f.read(max(buffer_size, location.pack_length)))
+                    window_start = offset
+                    read += len(window)
+                if end > window_start + len(window):
+                    problems.append((CORRUPT, f"{label}: the packfile ends inside it"))
+                elif location.checksum is None:
+                    unchecked += 1
+                else:
+                    checked += 1
+                    data = window[offset - window_start:end - window_start]
+                    problem = _compare(location, *container_checksum(io.BytesIO(data)))
+                    if problem:
+                        problems.append((CORRUPT, f"{label}: {problem}"))
+    except FileNotFoundError:
+        return 0, 0, 0, [(MISSING, label) for _, label in objects.values()]
+    except OSError as error:
+        return 0, 0, 0, [(CORRUPT, f"{label}: unreadable, {error}") for _, label in objects.values()]
+    return checked, unchecked, read, problems
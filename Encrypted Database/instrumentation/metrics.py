@@ -0,0 +1,233 @@
+"""
+Metrics Module
+
+This module collects counters and stage timings while a command runs, so a slow command
+can be broken down into file I/O, modular exponentiation and database time. Collection
+is off by default: until enable() is called, count() only tests a flag and stage() hands
+back a shared no-op context manager.
+
+Stages are timed with the monotonic perf_counter clock and may nest, so their totals are
+inclusive. When a trace file is given, every finished stage is also written to it as one
+JSON object per line. Work done in worker processes (--workers) is not collected there;
+the parent times it as the wait for the results.
+
+"""
+
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from typing import BinaryIO, TextIO
+
+ENABLED = False
+
+_counters: dict[str, int] = {}
+# stage name -> [calls, total seconds]
+_stages: dict[str, list] = {}
+_lock = threading.Lock()
+_origin = 0.0
+_trace: TextIO | None = None
+_profiler = None
+_profile_path: str | None = None
+_NULL_STAGE = nullcontext()
+
+class _Stage:
+    """
+    Context manager timing one stage and recording it when the block ends.
+    """
+
+    __slots__ = ('name', 'fields', 'start')
+
+    def __init__(self, name: str, fields: dict) -> None:
+        """
+        Prepares the stage.
+
+        Args:
+            name (str): Name of the stage.
+            fields (dict): Extra values written with the trace event.
+
+        Returns:
+            None
+        """
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self) -> "_Stage":
+        """Start the clock."""
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stop the clock and record the call."""
+        record(self.name, self.start, time.perf_counter() - self.start, **self.fields)
+
+def enable(trace_path: str | None = None, profile_path: str | None = None) -> None:
+    """
+    Start collecting counters and timings, optionally with a trace file and a profile.
+
+    Args:
+        trace_path (str | None): File receiving one JSON event per finished stage.
+        profile_path (str | None): File the cProfile statistics are saved to by finish().
+
+    Returns:
+        None
+    """
+    global ENABLED, _origin, _trace, _profiler, _profile_path
+    _counters.clear()
+    _stages.clear()
+    _origin = time.perf_counter()
+    if trace_path:
+        _trace = open(trace_path, 'w')
+    if profile_path:
+        import cProfile
+        _profile_path = profile_path
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    ENABLED = True
+
+def finish() -> None:
+    """
+    Stop collecting, close the trace file and save the profile.
+
+    The collected counters and timings stay available to summary().
+
+    Returns:
+        None
+    """
+    global ENABLED, _trace, _profiler
+    ENABLED = False
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_path)
+        _profiler = None
+    if _trace is not None:
+        _trace.close()
+        _trace = None
+
+def count(name: str, amount: int = 1) -> None:
+    """
+    Add to a counter.
+
+    Args:
+        name (str): Name of the counter.
+        amount (int): Value added.
+
+    Returns:
+        None
+    """
+    if ENABLED:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + amount
+
+def stage(name: str, **fields) -> _Stage | nullcontext:
+    """
+    Time the enclosed block as one call of a stage.
+
+    Example:
+        with metrics.stage('io.read'):
+            data = f_in.read(size)
+
+    Args:
+        name (str): Name of the stage.
+        **fields: Extra values written with the trace event.
+
+    Returns:
+        _Stage | nullcontext: Context manager doing the timing, a no-op while disabled.
+    """
+    return _Stage(name, fields) if ENABLED else _NULL_STAGE
+
+def record(name: str, start: float, duration: float, **fields) -> None:
+    """
+    Record one finished call of a stage.
+
+    Args:
+        name (str): Name of the stage.
+        start (float): perf_counter value when the call started.
+        duration (float): Seconds the call took.
+        **fields: Extra values written with the trace event.
+
+    Returns:
+        None
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        totals = _stages.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+        if _trace is not None:
+            import json
+            event = {'stage': name, 'start': round(start - _origin, 9), 'duration': round(duration, 9),
+                     'thread': threading.get_ident()}
+            event.update(fields)
+            _trace.write(json.dumps(event) + "\n")
+
+def counted_read(f_in: BinaryIO, size: int = -1) -> bytes:
+    """
+    Read from a file as an 'io.read' stage, counting the bytes read.
+
+    Args:
+        f_in (BinaryIO): File opened for binary reading.
+        size (int): Maximum number of bytes to read, -1 for the rest of the file.
+
+    Returns:
+        bytes: The data read, empty at the end of the file.
+    """
+    if not ENABLED:
+        return f_in.read(size)
+    with stage('io.read'):
+        data = f_in.read(size)
+    count('io.bytes_read', len(data))
+    return data
+
+def counted_write(f_out: BinaryIO, data) -> None:
+    """
+    Write to a file as an 'io.write' stage, counting the bytes written.
+
+    Args:
+        f_out (BinaryIO): File opened for binary writing.
+        data: Bytes-like object to write.
+
+    Returns:
+        None
+    """
+    if not ENABLED:
+        f_out.write(data)
+        return
+    with stage('io.write'):
+        f_out.write(data)
+    count('io.bytes_written', len(data))
+
+def summary() -> dict[str, dict]:
+    """
+    Return the collected counters and stage timings.
+
+    Returns:
+        dict[str, dict]: 'counters' maps names to values, 'stages' maps names to
+        (calls, total seconds).
+    """
+    with _lock:
+        return {'counters': dict(_counters), 'stages': {name: tuple(totals) for name, totals in _stages.items()}}
+
+def print_summary(file: TextIO | None = None) -> None:
+    """
+    Print the counters and stage timings as a table.
+
+    It goes to standard error by default, so it never mixes with a plaintext
+    streamed to standard output.
+
+    Args:
+        file (TextIO | None): Stream to print to, standard error when None.
+
+    Returns:
+        None
+    """
+    file = file or sys.stderr
+    collected = summary()
+    print(f"{'stage':<36} | {'calls':>8} | {'total (ms)':>12} | {'mean (ms)':>10}", file=file)
+    for name, (calls, total) in sorted(collected['stages'].items(), key=lambda item: -item[1][1]):
+        print(f"{name:<36} | {calls:>8} | {total * 1000:>12.3f} | {total / calls * 1000:>10.4f}", file=file)
+    for name, value in sorted(collected['counters'].items()):
+        print(f"{name:<36} | {value:>8}", file=file)
+    if _profile_path:
+        print(f"Profile saved to '{_profile_path}'", file=file)
@@ -1,73 +1,323 @@
-"""
-Main Entry Point for RSA File Encryption Tool
-
-This script handles command-line interactions for generating keys, encrypting, decrypting, deleting, and listing files.
-
-"""
-
-import argparse
-import os
-import getpass
-from database.db_handler import init_db, add_user, list_all_files
-from encryption.rsa import generate_keys, encrypt_file
-from file_handler.file_ops import read_file, delete_file
-
-def main() -> None:
-    """
-    Entry point for the RSA File Encryption Tool.
-    Handles commands for key generation, encryption, decryption, deletion, and listing files.
-
-    Args:
-        None
-
-    Returns:
-        None
-    """
-    #creating a parser for arguments 
-    #description appears when --help command is used 
-    parser = argparse.ArgumentParser(description="RSA File Encryption Tool")
-    
-    #subcommands, as git clone 
-    subparsers = parser.add_subparsers(dest='command')
-
-    gen_keys_parser = subparsers.add_parser('generate-keys', help="Generate RSA keys")
-
-    encrypt_parser = subparsers.add_parser('encrypt', help="Encrypt a file")
-    encrypt_parser.add_argument('file_path', type=str, help="Path to the file to encrypt")
-    encrypt_parser.add_argument('public_key', type=str, help="Public key for encryption")
-
-    read_parser = subparsers.add_parser('read', help="Read and decrypt a file")
-    read_parser.add_argument('file_path', type=str, help="Path to the encrypted file")
-    read_parser.add_argument('private_key', type=str, help="Private key for decryption")
-
-    delete_parser = subparsers.add_parser('delete', help="Delete a file")
-    delete_parser.add_argument('file_path', type=str, help="Path to the file to delete")
-
-    list_parser = subparsers.add_parser('list', help="List all encrypted files")
-
-    args = parser.parse_args()
-    username = getpass.getuser()
-
-    init_db()
-    add_user(username)
-
-    if args.command == 'generate-keys':
-        generate_keys(username)
-
-    elif args.command == 'encrypt':
-        encrypt_file(username, args.file_path, args.public_key)
-
-    elif args.command == 'read':
-        read_file(username, args.file_path, args.private_key)
-
-    elif args.command == 'delete':
-        delete_file(username, args.file_path)
-
-    elif args.command == 'list':
-        list_all_files(username)
-
-    else:
-        parser.print_help()
-
-if __name__ == "__main__":
-    main()
+"""
+Main Entry Point for RSA File Encryption Tool
+
+This script handles command-line interactions for generating keys, encrypting, updating, decrypting, deleting, listing and searching files,
+rotating keys, compacting packfiles and verifying the encrypted files.
+When a daemon started with `serve` is running, commands are forwarded to it, unless
+--stats, --trace or --profile asks to measure the command in this process.
+
+"""
+
+import argparse
+import os
+import getpass
+from database.db_handler import init_db, add_user, list_files, parse_timestamp, LIST_SORTS, LIST_FORMATS
+from encryption.defaults import (DEFAULT_KEY_BITS, DEFAULT_MAX_INFLIGHT, DEFAULT_BATCH_SIZE, ENCRYPTION_MODES, MODE_RSA,
+                                 IO_BUFFER_SIZE, MIN_ENVELOPE_KEY_BITS, CODEBOOK_MAX_MODULUS, LAYOUT_CODES)
+from file_handler.defaults import (STORAGE_BACKENDS, STORAGE_FILE, DEFAULT_MIN_GARBAGE, DEFAULT_VERIFY_WORKERS,
+                                   VERIFY_BUFFER_SIZE)
+from service.protocol import SOCKET_PATH, FORWARDED_COMMANDS, DEFAULT_THREADS
+from instrumentation import metrics
+
+# Commands that may create the user's row; the others only read it
+WRITE_COMMANDS = ('generate-keys', 'encrypt', 'update', 'sync')
+
+def positive_int(value: str) -> int:
+    """
+    Argument type accepting integers of at least 1.
+
+    Args:
+        value (str): The argument as given.
+
+    Returns:
+        int: The parsed value.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a number of at least 1, got {value}")
+    return number
+
+def non_negative_int(value: str) -> int:
+    """
+    Argument type accepting integers of at least 0.
+
+    Args:
+        value (str): The argument as given.
+
+    Returns:
+        int: The parsed value.
+    """
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"expected a number of at least 0, got {value}")
+    return number
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Builds the command-line parser with all subcommands.
+
+    Args:
+        None
+
+    Returns:
+        argparse.ArgumentParser: The parser.
+    """
+    #creating a parser for arguments 
+    #description appears when --help command is used 
+    parser = argparse.ArgumentParser(description="RSA File Encryption Tool")
+    parser.add_argument('--socket', type=str, default=SOCKET_PATH, help="Unix socket of the daemon")
+    parser.add_argument('--no-daemon', action='store_true', help="Run in this process even if a daemon is running")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print counters and per-stage timings to standard error when the command ends")
+    parser.add_argument('--trace', type=str, metavar='FILE', help="Write one JSON event per timed operation to FILE")
+    parser.add_argument('--profile', type=str, metavar='FILE', help="Save a cProfile of the command to FILE")
+    
+    #subcommands, as git clone 
+    subparsers = parser.add_subparsers(dest='command')
+
+    gen_keys_parser = subparsers.add_parser('generate-keys', help="Generate RSA keys")
+    gen_keys_parser.add_argument('--bits', type=int, default=DEFAULT_KEY_BITS, help="Size of the modulus in bits")
+
+    encrypt_parser = subparsers.add_parser('encrypt', help="Encrypt one or more files")
+    encrypt_parser.add_argument('file_paths', type=str, nargs='*', help="Files, directories or glob patterns to encrypt")
+    encrypt_parser.add_argument('public_key', type=str, help="Public key for encryption")
+    encrypt_parser.add_argument('-r', '--recursive', action='store_true', help="Encrypt directories recursively")
+    encrypt_parser.add_argument('--stdin', action='store_true', help="Read more paths from standard input, one per line")
+    encrypt_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                                help="Number of file records committed per transaction")
+    encrypt_parser.add_argument('--mode', choices=ENCRYPTION_MODES, default=MODE_RSA,
+                                help="'rsa' encrypts every block with RSA, 'envelope' wraps a session key with unpadded RSA "
+                                     f"(keys of at least {MIN_ENVELOPE_KEY_BITS} bits) and stream-encrypts and "
+                                     "authenticates the body")
+    encrypt_parser.add_argument('--layout', choices=LAYOUT_CODES, default='packed',
+                                help="'packed' stores RSA blocks at their exact bit width, 'fixed' pads each block to whole bytes")
+    encrypt_parser.add_argument('--workers', type=int, default=1,
+                                help="Number of processes used for encryption (per block for one file, per file for many)")
+    encrypt_parser.add_argument('--max-inflight', type=int, default=DEFAULT_MAX_INFLIGHT,
+                                help="Maximum number of segments (or files per worker) held in memory with --workers")
+    encrypt_parser.add_argument('--buffer-size', type=int, default=IO_BUFFER_SIZE,
+                                help="Bytes read or written per I/O call")
+    encrypt_parser.add_argument('--storage', choices=STORAGE_BACKENDS, default=STORAGE_FILE,
+                                help="Where small files are kept: 'file' one encrypted file each, 'pack' appended "
+                                     "to a shared packfile, 'inline' in the database")
+    encrypt_parser.add_argument('--index-key', type=str, metavar='PASSPHRASE',
+                                help="Index the words of the files for search under this passphrase")
+    encrypt_parser.add_argument('--codebook-max-modulus', type=non_negative_int, default=CODEBOOK_MAX_MODULUS,
+                                help="Largest modulus whose blocks are cached in a lookup table, 0 to disable the tables")
+
+    update_parser = subparsers.add_parser('update', aliases=['sync'],
+                                          help="Re-encrypt only the changed parts of files encrypted before")
+    update_parser.add_argument('file_paths', type=str, nargs='*', help="Files, directories or glob patterns to update")
+    update_parser.add_argument('public_key', type=str, help="Public key for encryption")
+    update_parser.add_argument('-r', '--recursive', action='store_true', help="Update directories recursively")
+    update_parser.add_argument('--stdin', action='store_true', help="Read more paths from standard input, one per line")
+    update_parser.add_argument('--mode', choices=ENCRYPTION_MODES, default=MODE_RSA,
+                               help="Encryption mode of files that were never encrypted")
+    update_parser.add_argument('--layout', choices=LAYOUT_CODES, default='packed',
+                               help="Block layout used when a file has to be encrypted in full")
+    update_parser.add_argument('--workers', type=int, default=1, help="Number of processes used for encryption")
+    update_parser.add_argument('--max-inflight', type=int, default=DEFAULT_MAX_INFLIGHT,
+                               help="Maximum number of segments held in memory with --workers")
+    update_parser.add_argument('--buffer-size', type=int, default=IO_BUFFER_SIZE,
+                               help="Bytes read or written per I/O call")
+    update_parser.add_argument('--storage', choices=STORAGE_BACKENDS,
+                               help="Move small files to this backend, each file keeps its own by default")
+    update_parser.add_argument('--index-key', type=str, metavar='PASSPHRASE',
+                               help="Index the words of the changed files for search under this passphrase, "
+                                    "their old words are dropped from the index without it")
+    update_parser.add_argument('--codebook-max-modulus', type=non_negative_int, default=CODEBOOK_MAX_MODULUS,
+                               help="Largest modulus whose blocks are cached in a lookup table, 0 to disable the tables")
+
+    read_parser = subparsers.add_parser('read', help="Read and decrypt a file")
+    read_parser.add_argument('file_path', type=str, help="Path to the encrypted file")
+    read_parser.add_argument('private_key', type=str, help="Private key for decryption")
+    read_parser.add_argument('-o', '--output', type=str, help="Write the plaintext to this file instead of standard output")
+    read_parser.add_argument('--offset', type=non_negative_int, default=0, help="First plaintext byte to read")
+    read_parser.add_argument('--length', type=non_negative_int, help="Number of plaintext bytes to read, to the end of the file by default")
+    read_parser.add_argument('--workers', type=int, default=1, help="Number of processes used for decryption")
+    read_parser.add_argument('--max-inflight', type=int, default=DEFAULT_MAX_INFLIGHT,
+                             help="Maximum number of segments held in memory with --workers")
+    read_parser.add_argument('--buffer-size', type=int, default=IO_BUFFER_SIZE,
+                             help="Bytes read or written per I/O call")
+    read_parser.add_argument('--codebook-max-modulus', type=non_negative_int, default=CODEBOOK_MAX_MODULUS,
+                             help="Largest modulus whose blocks are cached in a lookup table, 0 to disable the tables")
+
+    rotate_parser = subparsers.add_parser('rotate-key', help="Encrypt all files of one key again with another key")
+    rotate_parser.add_argument('--from', dest='from_key', type=str, required=True,
+                               help="Key the files are encrypted with: its id or private key '(d, n)'")
+    rotate_parser.add_argument('--to', dest='to_key', type=str, required=True,
+                               help="Key to encrypt them with: its id or public key '(e, n)'")
+    rotate_parser.add_argument('--batch-size', type=positive_int, default=DEFAULT_BATCH_SIZE,
+                               help="Number of files switched to the new key per transaction and checkpoint")
+    rotate_parser.add_argument('--layout', choices=LAYOUT_CODES, default='packed',
+                               help="Block layout of files encrypted in 'rsa' mode")
+    rotate_parser.add_argument('--workers', type=int, default=1, help="Number of processes, each rotating whole files")
+    rotate_parser.add_argument('--max-inflight', type=int, default=DEFAULT_MAX_INFLIGHT,
+                               help="Maximum number of files queued per worker")
+    rotate_parser.add_argument('--buffer-size', type=int, default=IO_BUFFER_SIZE,
+                               help="Bytes read or written per I/O call")
+    rotate_parser.add_argument('--storage', choices=STORAGE_BACKENDS,
+                               help="Move small files to this backend, each file keeps its own by default")
+    rotate_parser.add_argument('--codebook-max-modulus', type=non_negative_int, default=CODEBOOK_MAX_MODULUS,
+                               help="Largest modulus whose blocks are cached in a lookup table, 0 to disable the tables")
+
+    compact_parser = subparsers.add_parser('compact', help="Reclaim the space of deleted files in the packfiles")
+    compact_parser.add_argument('--min-garbage', type=float, default=DEFAULT_MIN_GARBAGE,
+                                help="Share of dead space, from 0 to 1, above which a packfile is rewritten")
+
+    verify_parser = subparsers.add_parser('verify', help="Check the encrypted files for missing, corrupt and orphaned ones")
+    verify_parser.add_argument('--all', action='store_true', help="Check the files of every user, not only yours")
+    verify_parser.add_argument('--workers', type=positive_int, default=DEFAULT_VERIFY_WORKERS,
+                               help="Number of threads reading encrypted files")
+    verify_parser.add_argument('--buffer-size', type=positive_int, default=VERIFY_BUFFER_SIZE,
+                               help="Bytes per read call")
+
+    delete_parser = subparsers.add_parser('delete', help="Delete a file")
+    delete_parser.add_argument('file_path', type=str, help="Path to the file to delete")
+
+    list_parser = subparsers.add_parser('list', help="List encrypted files, optionally filtered and paginated")
+    list_parser.add_argument('--limit', type=positive_int, help="Maximum number of files to list")
+    list_parser.add_argument('--after', type=int, help="Continue after the file with this id")
+    list_parser.add_argument('--prefix', type=str, help="Only files whose original path starts with this")
+    list_parser.add_argument('--since', type=parse_timestamp, help="Only files encrypted at or after this UTC time (ISO 8601)")
+    list_parser.add_argument('--until', type=parse_timestamp, help="Only files encrypted before this UTC time (ISO 8601)")
+    list_parser.add_argument('--key-id', type=int, help="Only files encrypted with this key")
+    list_parser.add_argument('--sort', choices=LIST_SORTS, default='time', help="Order by encryption time or by path")
+    list_parser.add_argument('--desc', action='store_true', help="Reverse the order")
+    list_parser.add_argument('--format', choices=LIST_FORMATS, default='text',
+                             help="'json' prints one object per line, 'tsv' tab-separated rows with a header")
+
+    search_parser = subparsers.add_parser('search', help="Find the indexed files containing words, without decrypting them")
+    search_parser.add_argument('term', type=str, help="Word to look for; with several words, files must contain all of them")
+    search_parser.add_argument('--index-key', type=str, metavar='PASSPHRASE', required=True,
+                               help="Passphrase the files were indexed with")
+    search_parser.add_argument('--format', choices=LIST_FORMATS, default='text',
+                               help="'json' prints one object per line, 'tsv' tab-separated rows with a header")
+
+    serve_parser = subparsers.add_parser('serve', help="Run a daemon that serves the other commands over a Unix socket")
+    serve_parser.add_argument('--threads', type=int, default=DEFAULT_THREADS, help="Number of commands run at the same time")
+
+    return parser
+
+def run_command(args: argparse.Namespace, username: str) -> None:
+    """
+    Runs one parsed command, in this process or inside the daemon.
+
+    The encryption and file modules are imported by the commands that use them, so
+    --help and list start without loading them.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+        username (str): User running the command.
+
+    Returns:
+        None
+    """
+    if getattr(args, 'codebook_max_modulus', None) is not None:
+        from encryption.codebook import set_max_modulus
+        set_max_modulus(args.codebook_max_modulus)
+
+    if args.command == 'generate-keys':
+        from encryption.rsa import generate_keys
+        generate_keys(username, args.bits)
+
+    elif args.command == 'encrypt':
+        from encryption.rsa import encrypt_file, encrypt_files
+        from encryption.blind_index import derive_index_key
+        from file_handler.file_ops import expand_paths
+        index_key = derive_index_key(username, args.index_key) if args.index_key else None
+        if len(args.file_paths) == 1 and os.path.isfile(args.file_paths[0]) and not args.stdin:
+            encrypt_file(username, args.file_paths[0], args.public_key, args.workers, args.max_inflight, args.mode,
+                         LAYOUT_CODES[args.layout], args.buffer_size, args.storage, index_key)
+        else:
+            input_files = expand_paths(args.file_paths, args.recursive, args.stdin)
+            encrypt_files(username, input_files, args.public_key, args.workers, args.max_inflight, args.mode,
+                          args.batch_size, LAYOUT_CODES[args.layout], args.buffer_size, args.storage, index_key)
+
+    elif args.command in ('update', 'sync'):
+        from encryption.rsa import update_files
+        from encryption.blind_index import derive_index_key
+        from file_handler.file_ops import expand_paths
+        index_key = derive_index_key(username, args.index_key) if args.index_key else None
+        input_files = expand_paths(args.file_paths, args.recursive, args.stdin)
+        update_files(username, input_files, args.public_key, args.workers, args.max_inflight, args.mode,
+                     LAYOUT_CODES[args.layout], args.buffer_size, args.storage, index_key)
+
+    elif args.command == 'read':
+        from file_handler.file_ops import read_file
+        read_file(username, args.file_path, args.private_key, args.workers, args.max_inflight, args.output,
+                  args.offset, args.length, args.buffer_size)
+
+    elif args.command == 'delete':
+        from file_handler.file_ops import delete_file
+        delete_file(username, args.file_path)
+
+    elif args.command == 'rotate-key':
+        from encryption.rotation import rotate_key
+        rotate_key(username, args.from_key, args.to_key, args.workers, args.max_inflight, args.batch_size,
+                   LAYOUT_CODES[args.layout], args.buffer_size, args.storage)
+
+    elif args.command == 'compact':
+        from file_handler.file_ops import compact_storage
+        compact_storage(args.min_garbage)
+
+    elif args.command == 'verify':
+        from file_handler.file_ops import verify_storage
+        verify_storage(None if args.all else username, args.workers, args.buffer_size)
+
+    elif args.command == 'search':
+        from encryption.blind_index import derive_index_key
+        from file_handler.file_ops import search_files
+        search_files(username, args.term, derive_index_key(username, args.index_key), args.format)
+
+    elif args.command == 'list':
+        list_files(username, args.format, args.limit, after=args.after, path_prefix=args.prefix, since=args.since,
+                   until=args.until, key_id=args.key_id, sort=args.sort, descending=args.desc)
+
+def main() -> None:
+    """
+    Entry point for the RSA File Encryption Tool.
+    Handles commands for key generation, encryption, decryption, deletion, and listing files.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    parser = build_parser()
+    args = parser.parse_args()
+    username = getpass.getuser()
+
+    if args.command is None:
+        parser.print_help()
+        return
+
+    # the daemon modules (asyncio, sockets) are only imported when they are used
+    if args.command == 'serve':
+        from service.server import serve
+        serve(run_command, username, args.socket, args.threads)
+        return
+
+    instrumented = args.stats or args.trace or args.profile
+    if args.command in FORWARDED_COMMANDS and not (args.no_daemon or instrumented) and os.path.exists(args.socket):
+        from service.client import forward
+        if forward(args, args.socket):
+            return
+
+    if instrumented:
+        metrics.enable(args.trace, args.profile)
+    try:
+        with metrics.stage('command', command=args.command):
+            init_db()
+            if args.command in WRITE_COMMANDS:
+                add_user(username)
+            run_command(args, username)
+    finally:
+        if instrumented:
+            metrics.finish()
+            if args.stats:
+                metrics.print_summary()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Daemon Client Module
+
+This module forwards a CLI command to a running daemon and replays its output, so the
+command runs in a warm process instead of paying for startup, imports and database setup.
+
+"""
+
+import argparse
+import os
+import socket
+import sys
+from service.protocol import FRAME_HEADER, FRAME_OUTPUT, FRAME_EXIT, encode_request
+
+def daemon_request(args: argparse.Namespace) -> dict:
+    """
+    Turn parsed arguments into a request the daemon can run from its own working directory.
+
+    Paths the command opens are made absolute, and paths listed on standard input are
+    read here and sent along, since the daemon sees neither the client's working
+    directory nor its standard input. Files encrypted or updated through the daemon are therefore
+    recorded under their absolute path. The path given to read and delete is a database
+    key, so it is sent as given together with its absolute form.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        dict: The request.
+    """
+    request = vars(args).copy()
+    if args.command in ('encrypt', 'update', 'sync'):
+        paths = [os.path.abspath(path) for path in args.file_paths]
+        if args.stdin:
+            paths += [os.path.abspath(line.rstrip("\n")) for line in sys.stdin if line.rstrip("\n")]
+        request.update(file_paths=paths, stdin=False)
+    elif args.command in ('read', 'delete'):
+        request['absolute_path'] = os.path.abspath(args.file_path)
+        if args.command == 'read' and args.output:
+            request['output'] = os.path.abspath(args.output)
+    return request
+
+def _receive_exactly(sock: socket.socket, size: int) -> bytes:
+    """Read exactly size bytes from the socket."""
+    data = bytearray()
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            raise ConnectionError("The daemon closed the connection")
+        data += part
+    return bytes(data)
+
+def forward(args: argparse.Namespace, socket_path: str) -> bool:
+    """
+    Run a command in the daemon listening on socket_path, if there is one.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+        socket_path (str): Path of the daemon's Unix socket.
+
+    Returns:
+        bool: True if the daemon handled the command, False if no daemon is running
+        and the command should run in this process.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return False
+
+    with sock:
+        sock.sendall(encode_request(daemon_request(args)))
+        try:
+            while True:
+                kind, length = FRAME_HEADER.unpack(_receive_exactly(sock, FRAME_HEADER.size))
+                payload = _receive_exactly(sock, length)
+                if kind == FRAME_OUTPUT:
+                    sys.stdout.buffer.write(payload)
+                elif kind == FRAME_EXIT:
+                    break
+        except ConnectionError as error:
+            print(f"Lost the connection to the daemon: {error}")
+            return True
+        finally:
+            sys.stdout.buffer.flush()
+
+    if payload and payload[0]:
+        sys.exit(payload[0])
+    return True
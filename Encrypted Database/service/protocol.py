@@ -0,0 +1,66 @@
+"""
+Daemon Protocol Module
+
+This module defines how the CLI talks to the daemon over its Unix socket. A client sends
+one request, the parsed command-line arguments as a JSON object on a single line, and the
+daemon answers with frames: a one-byte kind and a four-byte length followed by the payload.
+Output frames carry what the command writes to standard output; the final exit frame
+carries its status.
+
+"""
+
+import getpass
+import json
+import os
+import struct
+import tempfile
+
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), f"encrypted-database-{getpass.getuser()}.sock")
+
+# Commands the daemon runs at the same time
+DEFAULT_THREADS = 4
+
+FRAME_HEADER = struct.Struct('>cI')
+FRAME_OUTPUT = b'o'
+FRAME_EXIT = b'x'
+
+# Commands the CLI hands over to a running daemon
+FORWARDED_COMMANDS = ('generate-keys', 'encrypt', 'update', 'sync', 'read', 'delete', 'list', 'rotate-key', 'compact',
+                      'verify', 'search')
+
+def pack_frame(kind: bytes, payload: bytes) -> bytes:
+    """
+    Build a response frame.
+
+    Args:
+        kind (bytes): FRAME_OUTPUT or FRAME_EXIT.
+        payload (bytes): Frame data.
+
+    Returns:
+        bytes: Header followed by the payload.
+    """
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+def encode_request(request: dict) -> bytes:
+    """
+    Serialize a request as a single JSON line.
+
+    Args:
+        request (dict): Command-line arguments of the command, by name.
+
+    Returns:
+        bytes: The encoded request, newline included.
+    """
+    return json.dumps(request).encode() + b'\n'
+
+def decode_request(line: bytes) -> dict:
+    """
+    Parse a request line.
+
+    Args:
+        line (bytes): Line received from the client.
+
+    Returns:
+        dict: Command-line arguments of the command, by name.
+    """
+    return json.loads(line)
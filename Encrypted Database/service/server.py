@@ -0,0 +1,264 @@
+"""
+Daemon Server Module
+
+This module implements the `serve` command: a long-running process that keeps its imports,
+database sessions and key tables warm and runs CLI commands sent over a local Unix socket.
+Clients are served concurrently by asyncio; each command runs in a worker thread with its
+own database session, and whatever it writes to standard output is streamed back to the
+client that sent it.
+
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import signal
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from database.db_handler import init_db, add_user, get_encrypted_file
+from service.protocol import DEFAULT_THREADS, FRAME_OUTPUT, FRAME_EXIT, pack_frame, decode_request
+
+# Output is sent to the client in frames of about this size
+OUTPUT_FRAME_SIZE = 1 << 16
+
+class _BinaryRouter:
+    """
+    Binary side of _OutputRouter, standing in for sys.stdout.buffer.
+    """
+
+    def __init__(self, router: "_OutputRouter") -> None:
+        """
+        Binds the binary stream to its text router.
+
+        Args:
+            router (_OutputRouter): Router owning the per-thread sinks.
+
+        Returns:
+            None
+        """
+        self.router = router
+
+    def write(self, data) -> int:
+        """Send bytes to the current thread's client, or to the real standard output."""
+        return self.router.write_bytes(bytes(data))
+
+    def flush(self) -> None:
+        """Flush the current thread's pending output."""
+        self.router.flush()
+
+class _OutputRouter(io.TextIOBase):
+    """
+    Replacement for sys.stdout that sends each worker thread's output to its own client.
+
+    Threads that are not serving a client write to the original standard output.
+    """
+
+    def __init__(self, fallback: io.TextIOBase) -> None:
+        """
+        Wraps the original standard output.
+
+        Args:
+            fallback (io.TextIOBase): Stream used by threads without a client.
+
+        Returns:
+            None
+        """
+        self.fallback = fallback
+        self.local = threading.local()
+        self._buffer = _BinaryRouter(self)
+
+    @property
+    def buffer(self) -> _BinaryRouter:
+        """Binary stream for commands that write raw bytes."""
+        return self._buffer
+
+    def bind(self, send: Callable[[bytes], None]) -> None:
+        """
+        Send the calling thread's output to a client until unbind() is called.
+
+        Args:
+            send (Callable[[bytes], None]): Function delivering output bytes to the client.
+
+        Returns:
+            None
+        """
+        self.local.send = send
+        self.local.pending = bytearray()
+
+    def unbind(self) -> None:
+        """
+        Flush the calling thread's output and return it to the original standard output.
+
+        Returns:
+            None
+        """
+        self.flush()
+        self.local.__dict__.clear()
+
+    def writable(self) -> bool:
+        """Report the stream as writable."""
+        return True
+
+    def write(self, text: str) -> int:
+        """Write text to the current thread's client, or to the real standard output."""
+        if getattr(self.local, 'send', None) is None:
+            return self.fallback.write(text)
+        self.write_bytes(text.encode())
+        return len(text)
+
+    def write_bytes(self, data: bytes) -> int:
+        """Queue bytes for the current thread's client, sending them once a frame is full."""
+        if getattr(self.local, 'send', None) is None:
+            self.fallback.flush()
+            return self.fallback.buffer.write(data)
+        self.local.pending += data
+        if len(self.local.pending) >= OUTPUT_FRAME_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        """Send the current thread's pending output."""
+        if getattr(self.local, 'send', None) is None:
+            self.fallback.flush()
+        elif self.local.pending:
+            self.local.send(bytes(self.local.pending))
+            self.local.pending.clear()
+
+def _resolve_record_path(username: str, request: dict) -> None:
+    """Use the absolute form of a read/delete path when only that one is in the database."""
+    absolute_path = request.pop('absolute_path', None)
+    if absolute_path and not get_encrypted_file(username, request['file_path']) \
+            and get_encrypted_file(username, absolute_path):
+        request['file_path'] = absolute_path
+
+async def _handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                         run: Callable[[argparse.Namespace, str], None], username: str,
+                         router: _OutputRouter, executor: ThreadPoolExecutor) -> None:
+    """
+    Run one client's command and stream its output back.
+
+    Args:
+        reader (asyncio.StreamReader): Incoming side of the connection.
+        writer (asyncio.StreamWriter): Outgoing side of the connection.
+        run (Callable[[argparse.Namespace, str], None]): Function running a parsed command for a user.
+        username (str): User the daemon acts for.
+        router (_OutputRouter): The installed standard output router.
+        executor (ThreadPoolExecutor): Threads running the commands.
+
+    Returns:
+        None
+    """
+    loop = asyncio.get_running_loop()
+
+    async def send(kind: bytes, payload: bytes) -> None:
+        """Write one frame, waiting while the client is slow to read."""
+        writer.write(pack_frame(kind, payload))
+        await writer.drain()
+
+    def job(request: dict) -> int:
+        """Run the command in a worker thread, with its output routed to this client."""
+        router.bind(lambda data: asyncio.run_coroutine_threadsafe(send(FRAME_OUTPUT, data), loop).result())
+        try:
+            _resolve_record_path(username, request)
+            run(argparse.Namespace(**request), username)
+            return 0
+        except Exception as error:
+            print(f"Error: {error}")
+            return 1
+        finally:
+            router.unbind()
+
+    try:
+        line = await reader.readline()
+        if not line:
+            return
+        status = await loop.run_in_executor(executor, job, decode_request(line))
+        await send(FRAME_EXIT, bytes([status]))
+    except (ConnectionError, ValueError) as error:
+        print(f"Dropped a client: {error}")
+    finally:
+        writer.close()
+
+def _claim_socket(socket_path: str) -> bool:
+    """Remove a stale socket file, returning False if a daemon is already listening on it."""
+    if not os.path.exists(socket_path):
+        return True
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+        return False
+    except OSError:
+        os.remove(socket_path)
+        return True
+    finally:
+        probe.close()
+
+def serve(run: Callable[[argparse.Namespace, str], None], username: str, socket_path: str,
+          threads: int = DEFAULT_THREADS) -> None:
+    """
+    Serve CLI commands on a Unix socket until SIGINT or SIGTERM.
+
+    The database schema and the user are set up once at startup. The socket is only
+    accessible to the user running the daemon.
+
+    Args:
+        run (Callable[[argparse.Namespace, str], None]): Function running a parsed command for a user.
+        username (str): User the daemon acts for.
+        socket_path (str): Path of the Unix socket to listen on.
+        threads (int): Number of commands run at the same time.
+
+    Returns:
+        None
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        print("The daemon needs Unix domain sockets, which this platform does not support.")
+        return
+    if not _claim_socket(socket_path):
+        print(f"A daemon is already listening on '{socket_path}'.")
+        return
+
+    init_db()
+    add_user(username)
+    router = _OutputRouter(sys.stdout)
+    sys.stdout = router
+
+    async def main() -> None:
+        """Listen until a stop signal arrives, then let running commands finish."""
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+        active = set()
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            """Serve one connection, keeping track of it until it is done."""
+            task = asyncio.current_task()
+            active.add(task)
+            try:
+                await _handle_client(reader, writer, run, username, router, executor)
+            finally:
+                active.discard(task)
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # create the socket as owner read/write only
+            umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(handle, path=socket_path)
+            finally:
+                os.umask(umask)
+            print(f"Serving on '{socket_path}' with {threads} thread(s), press Ctrl+C to stop", flush=True)
+            async with server:
+                await stop.wait()
+            # running commands still need the event loop to send their output
+            await asyncio.gather(*active, return_exceptions=True)
+
+    try:
+        asyncio.run(main())
+    finally:
+        sys.stdout = router.fallback
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        print("Daemon stopped.")
@@ -0,0 +1,61 @@
+"""
+Shared fixtures of the test suite.
+
+Every test runs against its own database, encrypted files directory and codebook
+directory inside pytest's temporary directory, so the paths configured in the
+modules are never touched.
+
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import db_handler
+from encryption import codebook, rsa
+
+USERNAME = 'alice'
+# Small keys keep the block-by-block 'rsa' mode fast; 'envelope' mode needs MIN_ENVELOPE_KEY_BITS
+KEY_BITS = 256
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """Point the database, the encrypted files and the codebooks at a fresh temporary directory."""
+    monkeypatch.setattr(db_handler, 'DB_NAME', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(rsa, 'ENCRYPTED_DIR', str(tmp_path / 'encrypted'))
+    monkeypatch.setattr(codebook, 'CODEBOOK_DIR', str(tmp_path / 'codebooks'))
+    os.makedirs(rsa.ENCRYPTED_DIR)
+    monkeypatch.chdir(tmp_path)
+    db_handler.init_db()
+    db_handler.add_user(USERNAME)
+    yield tmp_path
+    db_handler.close_session()
+    codebook._codebooks.clear()
+
+def make_keys(username: str = USERNAME, bits: int = KEY_BITS) -> tuple[str, str]:
+    """Generate and save a key pair, returning the public and private key strings."""
+    e, d, n, crt = rsa.generate_key_pair(bits)
+    db_handler.save_keys(username, e, d, n, crt)
+    return f"({e}, {n})", f"({d}, {n})"
+
+@pytest.fixture
+def keys(workspace):
+    """A saved key pair of USERNAME, as (public key, private key) strings."""
+    return make_keys()
+
+def write_file(directory, name: str, data: bytes) -> str:
+    """Write a plaintext file and return its path."""
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def decrypt(username: str, path: str, private_key: str, offset: int = 0, length: int | None = None) -> bytes:
+    """Decrypt the stored copy of a file, or a range of it."""
+    stored = db_handler.get_stored_file(username, path)
+    key = db_handler.lookup_private_key(private_key)
+    return b''.join(rsa.iter_decrypt(stored.location, key.d, key.n, key.crt, mode=stored.mode, offset=offset,
+                                     length=length))
@@ -0,0 +1,58 @@
+"""
+Tests of database.db_handler: schema migrations.
+
+"""
+
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from database import db_handler
+
+# A database written before PRAGMA user_version was used, with one key saved four times
+VERSION_0_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'database', 'encrypted_database.db')
+
+@pytest.fixture
+def version_0_db(tmp_path, monkeypatch):
+    """A copy of the version 0 database, opened by the session."""
+    path = str(tmp_path / 'old.db')
+    shutil.copyfile(VERSION_0_DB, path)
+    monkeypatch.setattr(db_handler, 'DB_NAME', path)
+    yield path
+    db_handler.close_session()
+
+def test_migrate_version_0(version_0_db):
+    db_handler.init_db()
+
+    session = db_handler.get_session()
+    assert session.execute("PRAGMA user_version").fetchone()[0] == db_handler.SCHEMA_VERSION
+    # the duplicate keys were merged and the files point at the one kept
+    key_ids = [row[0] for row in session.execute("SELECT id FROM keys")]
+    assert len(key_ids) == 1
+    assert {row[0] for row in session.execute("SELECT key_id FROM files")} == set(key_ids)
+    key = db_handler.get_key(key_ids[0])
+    assert (key.e, key.d, key.n) == (5, 1596269, 7990271)
+    assert [record.key_id for record in db_handler.iter_files('ioana')] == key_ids * 2
+
+def test_migrate_is_idempotent(version_0_db):
+    db_handler.init_db()
+    db_handler.close_session()
+
+    db_handler.init_db()
+
+    assert db_handler.migrate(db_handler.get_session()) == db_handler.SCHEMA_VERSION
+
+def test_migrate_refuses_keys_shared_by_users(version_0_db):
+    with sqlite3.connect(version_0_db) as connection:
+        connection.execute("INSERT INTO users (username) VALUES ('bob')")
+        connection.execute("INSERT INTO keys (user_id, public_key, private_key) "
+                           "SELECT 2, public_key, private_key FROM keys WHERE id = 1")
+
+    with pytest.raises(sqlite3.IntegrityError):
+        db_handler.init_db()
+
+    # the step that failed was rolled back, the upgrade resumes there once the duplicates are removed
+    assert db_handler.get_session().execute("PRAGMA user_version").fetchone()[0] == 1
@@ -0,0 +1,98 @@
+"""
+Tests of file_handler: shared containers and deletion, verification and search.
+
+"""
+
+import os
+
+from conftest import USERNAME, write_file, decrypt
+from database import db_handler
+from database.db_handler import count_file_references, get_stored_file
+from encryption import rsa
+from encryption.blind_index import derive_index_key
+from file_handler.file_ops import delete_file, search_files
+from file_handler.verify import verify_containers
+
+def test_identical_files_share_a_container_until_deleted(workspace, keys):
+    public_key, private_key = keys
+    data = os.urandom(5000)
+    first = write_file(workspace, 'first.bin', data)
+    second = write_file(workspace, 'second.bin', data)
+    rsa.encrypt_file(USERNAME, first, public_key)
+    rsa.encrypt_file(USERNAME, second, public_key)
+
+    location = get_stored_file(USERNAME, first).location
+    assert get_stored_file(USERNAME, second).location.encrypted_path == location.encrypted_path
+    assert count_file_references(location) == 2
+
+    delete_file(USERNAME, first)
+    assert count_file_references(location) == 1
+    assert os.path.exists(location.encrypted_path)
+    assert decrypt(USERNAME, second, private_key) == data
+
+    delete_file(USERNAME, second)
+    assert count_file_references(location) == 0
+    assert not os.path.exists(location.encrypted_path)
+
+def test_batch_encryption_shares_containers(workspace, keys):
+    public_key, _ = keys
+    data = os.urandom(5000)
+    paths = [write_file(workspace, f'copy{i}.bin', data) for i in range(3)]
+
+    assert rsa.encrypt_files(USERNAME, paths, public_key) == 3
+
+    assert len(os.listdir(rsa.ENCRYPTED_DIR)) == 1
+    assert count_file_references(get_stored_file(USERNAME, paths[0]).location) == 3
+
+def test_containers_are_not_shared_between_users(workspace, keys):
+    public_key, _ = keys
+    db_handler.add_user('bob')
+    data = os.urandom(5000)
+    mine = write_file(workspace, 'mine.bin', data)
+    theirs = write_file(workspace, 'theirs.bin', data)
+
+    rsa.encrypt_file(USERNAME, mine, public_key)
+    rsa.encrypt_file('bob', theirs, public_key)
+
+    assert get_stored_file(USERNAME, mine).encrypted_path != get_stored_file('bob', theirs).encrypted_path
+
+def test_verify_detects_corruption(workspace, keys):
+    public_key, _ = keys
+    paths = [write_file(workspace, f'file{i}.bin', os.urandom(100000)) for i in range(3)]
+    rsa.encrypt_files(USERNAME, paths, public_key)
+    assert verify_containers(rsa.ENCRYPTED_DIR)['corrupt'] == 0
+
+    corrupted = get_stored_file(USERNAME, paths[0]).encrypted_path
+    with open(corrupted, 'r+b') as f:
+        f.seek(50000)
+        byte = f.read(1)
+        f.seek(50000)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    os.remove(get_stored_file(USERNAME, paths[1]).encrypted_path)
+    write_file(rsa.ENCRYPTED_DIR, 'stray.enc', b'not referenced')
+
+    result = verify_containers(rsa.ENCRYPTED_DIR)
+
+    assert (result['corrupt'], result['missing'], result['orphaned']) == (1, 1, 1)
+
+def test_search(workspace, keys, capsys):
+    public_key, _ = keys
+    index_key = derive_index_key(USERNAME, 'passphrase')
+    report = write_file(workspace, 'report.txt', b'Quarterly revenue grew in the northern region.')
+    notes = write_file(workspace, 'notes.txt', 'Revenue notes, café meeting'.encode())
+    rsa.encrypt_files(USERNAME, [report, notes], public_key, index_key=index_key)
+    capsys.readouterr()
+
+    search_files(USERNAME, 'revenue', index_key)
+    out = capsys.readouterr().out
+    assert report in out and notes in out
+
+    search_files(USERNAME, 'NORTHERN revenue', index_key)
+    out = capsys.readouterr().out
+    assert report in out and notes not in out
+
+    search_files(USERNAME, 'café', index_key)
+    assert notes in capsys.readouterr().out
+
+    search_files(USERNAME, 'revenue', derive_index_key(USERNAME, 'wrong passphrase'))
+    assert "No indexed file contains 'revenue'" in capsys.readouterr().out
@@ -0,0 +1,63 @@
+"""
+Tests of encryption.rotation: rotating files to a new key and resuming an interrupted rotation.
+
+"""
+
+import os
+
+import pytest
+
+from conftest import USERNAME, make_keys, write_file, decrypt
+from database.db_handler import get_stored_file, lookup_public_key
+from encryption import rotation, rsa
+
+@pytest.fixture
+def files(workspace, keys):
+    """Four files encrypted with the first key, by path."""
+    paths = {write_file(workspace, f'file{i}.bin', os.urandom(3000 + i)): None for i in range(4)}
+    for path in paths:
+        with open(path, 'rb') as f:
+            paths[path] = f.read()
+    rsa.encrypt_files(USERNAME, list(paths), keys[0])
+    return paths
+
+def test_rotate_key(files, keys):
+    new_public, new_private = make_keys()
+
+    rotation.rotate_key(USERNAME, keys[1], new_public)
+
+    new_id = lookup_public_key(new_public).key_id
+    for path, data in files.items():
+        assert get_stored_file(USERNAME, path).key_id == new_id
+        assert decrypt(USERNAME, path, new_private) == data
+
+def test_resume_interrupted_rotation(files, keys, monkeypatch, capsys):
+    new_public, new_private = make_keys()
+    rotate_file_job = rotation._rotate_file_job
+    calls = 0
+
+    def interrupted(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls == 3:
+            raise KeyboardInterrupt
+        return rotate_file_job(*args, **kwargs)
+
+    monkeypatch.setattr(rotation, '_rotate_file_job', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        rotation.rotate_key(USERNAME, keys[1], new_public, batch_size=1)
+
+    new_id = lookup_public_key(new_public).key_id
+    rotated = [path for path in files if get_stored_file(USERNAME, path).key_id == new_id]
+    assert rotated == list(files)[:2]
+
+    monkeypatch.setattr(rotation, '_rotate_file_job', rotate_file_job)
+    capsys.readouterr()
+    rotation.rotate_key(USERNAME, keys[1], new_public, batch_size=1)
+
+    assert 'Resuming the rotation' in capsys.readouterr().out
+    for path, data in files.items():
+        assert get_stored_file(USERNAME, path).key_id == new_id
+        assert decrypt(USERNAME, path, new_private) == data
+    # the containers of the old key were released
+    assert len(os.listdir(rsa.ENCRYPTED_DIR)) == len(files)
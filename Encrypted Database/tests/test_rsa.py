@@ -0,0 +1,111 @@
+"""
+Tests of encryption.rsa: round trips, range reads and updates of encrypted files.
+
+"""
+
+import os
+
+import pytest
+
+from conftest import USERNAME, KEY_BITS, make_keys, write_file, decrypt
+from database.db_handler import get_stored_file
+from encryption import rsa
+from encryption.container import CHUNK_SIZE, LAYOUT_FIXED, LAYOUT_PACKED, chunk_range, read_header
+from encryption.defaults import MODE_ENVELOPE, MODE_RSA, MIN_ENVELOPE_KEY_BITS
+
+@pytest.mark.parametrize('mode, layout', [(MODE_RSA, LAYOUT_PACKED), (MODE_RSA, LAYOUT_FIXED),
+                                          (MODE_ENVELOPE, LAYOUT_PACKED)])
+def test_round_trip(workspace, mode, layout):
+    public_key, private_key = make_keys(bits=MIN_ENVELOPE_KEY_BITS if mode == MODE_ENVELOPE else KEY_BITS)
+    data = os.urandom(2 * CHUNK_SIZE + 1234)
+    path = write_file(workspace, 'data.bin', data)
+
+    rsa.encrypt_file(USERNAME, path, public_key, mode=mode, layout=layout)
+
+    assert decrypt(USERNAME, path, private_key) == data
+
+def test_round_trip_empty_file(workspace, keys):
+    public_key, private_key = keys
+    path = write_file(workspace, 'empty.bin', b'')
+
+    rsa.encrypt_file(USERNAME, path, public_key)
+
+    assert decrypt(USERNAME, path, private_key) == b''
+
+@pytest.mark.parametrize('layout', [LAYOUT_PACKED, LAYOUT_FIXED])
+def test_range_read(workspace, keys, layout):
+    public_key, private_key = keys
+    data = os.urandom(2 * CHUNK_SIZE + 1234)
+    path = write_file(workspace, 'data.bin', data)
+    rsa.encrypt_file(USERNAME, path, public_key, layout=layout)
+
+    # within a chunk, across a chunk boundary, whole chunks, to the end, past the end and empty
+    for offset, length in [(0, 10), (CHUNK_SIZE - 5, 10), (CHUNK_SIZE, CHUNK_SIZE), (100, None),
+                           (2 * CHUNK_SIZE + 1000, 5000), (10 ** 9, 10), (50, 0)]:
+        expected = data[offset:] if length is None else data[offset:offset + length]
+        assert decrypt(USERNAME, path, private_key, offset, length) == expected
+
+def test_negative_range_is_rejected(workspace, keys):
+    public_key, private_key = keys
+    path = write_file(workspace, 'data.bin', b'some text')
+    rsa.encrypt_file(USERNAME, path, public_key)
+    with open(get_stored_file(USERNAME, path).encrypted_path, 'rb') as f:
+        header = read_header(f)
+
+    with pytest.raises(ValueError):
+        chunk_range(header, -1, 5)
+    with pytest.raises(ValueError):
+        decrypt(USERNAME, path, private_key, 0, -5)
+
+def test_update_then_read(workspace, keys):
+    public_key, private_key = keys
+    data = bytearray(os.urandom(3 * CHUNK_SIZE + 100))
+    path = write_file(workspace, 'data.bin', bytes(data))
+    rsa.encrypt_file(USERNAME, path, public_key)
+
+    data[CHUNK_SIZE + 10:CHUNK_SIZE + 20] = b'0123456789'
+    data += b'appended tail'
+    write_file(workspace, 'data.bin', bytes(data))
+    assert rsa.update_files(USERNAME, [path], public_key) == 1
+
+    assert decrypt(USERNAME, path, private_key) == bytes(data)
+    assert decrypt(USERNAME, path, private_key, CHUNK_SIZE, 100) == bytes(data[CHUNK_SIZE:CHUNK_SIZE + 100])
+    # the container was patched and renamed, nothing else is left in the directory
+    assert os.listdir(rsa.ENCRYPTED_DIR) == [os.path.basename(get_stored_file(USERNAME, path).encrypted_path)]
+
+def test_update_of_shared_container_keeps_the_other_copy(workspace, keys):
+    public_key, private_key = keys
+    data = os.urandom(2 * CHUNK_SIZE)
+    first = write_file(workspace, 'first.bin', data)
+    second = write_file(workspace, 'second.bin', data)
+    rsa.encrypt_files(USERNAME, [first, second], public_key)
+
+    changed = b'changed' + data[7:]
+    write_file(workspace, 'second.bin', changed)
+    rsa.update_files(USERNAME, [second], public_key)
+
+    assert decrypt(USERNAME, first, private_key) == data
+    assert decrypt(USERNAME, second, private_key) == changed
+
+def test_envelope_detects_modified_chunk(workspace):
+    public_key, private_key = make_keys(bits=MIN_ENVELOPE_KEY_BITS)
+    path = write_file(workspace, 'data.bin', os.urandom(2 * CHUNK_SIZE))
+    rsa.encrypt_file(USERNAME, path, public_key, mode=MODE_ENVELOPE)
+    encrypted_path = get_stored_file(USERNAME, path).encrypted_path
+    with open(encrypted_path, 'r+b') as f:
+        f.seek(CHUNK_SIZE + 1000)
+        byte = f.read(1)
+        f.seek(CHUNK_SIZE + 1000)
+        f.write(bytes([byte[0] ^ 1]))
+
+    with pytest.raises(ValueError, match='integrity'):
+        decrypt(USERNAME, path, private_key)
+
+def test_envelope_refuses_small_keys(workspace, keys, capsys):
+    public_key, _ = keys
+    path = write_file(workspace, 'data.bin', b'some text')
+
+    rsa.encrypt_file(USERNAME, path, public_key, mode=MODE_ENVELOPE)
+
+    assert "'envelope' mode needs a key of at least" in capsys.readouterr().out
+    assert get_stored_file(USERNAME, path) is None